@@ -18,6 +18,15 @@ alg_config = Config(
     lr_schedule=1e-4,
     optimizer_spec="adam",
     max_grad_norm=1.0,
+    pipeline_eval=False,
+    eval_schedule=None,  # e.g. dict(AP=dict(every=5, subsample=0.25))
+    data_parallel_workers=1,  # See auto_yolo.models.data_parallel
+    data_parallel_rank=0,
+    data_parallel_address="localhost:29500",
+    accumulate_steps=1,
+    recompute=False,
+    timing_window=100,
+    metrics_file=None,  # e.g. "metrics.jsonl", see core.Updater
     use_gpu=True,
     gpu_allow_growth=True,
     max_experiments=None,
@@ -86,6 +95,7 @@ baseline_config = alg_config.copy(
     build_object_decoder=lambda scope: MLP(n_units=[256, 512], scope=scope),
     cc_threshold=1e-3,
     object_shape=(21, 21),
+    in_graph_ap=False,
 )
 
 baseline_transfer_config = baseline_config.copy(
@@ -141,6 +151,7 @@ yolo_air_config = alg_config.copy(
     n_passthrough_features=100,
 
     n_lookback=1,
+    sequential_mode="wavefront",  # One of "unroll", "wavefront", "while_loop"
 
     use_concrete_kl=False,
     obj_concrete_temp=1.0,
@@ -159,6 +170,8 @@ yolo_air_config = alg_config.copy(
     obj_logit_scale=2.0,
     alpha_logit_scale=0.1,
     alpha_logit_bias=5.0,
+    skip_inactive_sprites=False,
+    in_graph_ap=False,
 
     training_wheels="Exp(1.0, 0.0, decay_rate=0.0, decay_steps=1000, staircase=True)",
     count_prior_dist=None,
@@ -56,6 +56,9 @@ def run_experiment(
 
     if args.duration == "local":
         _config.exp_name = "alg={}".format(alg_name)
+        if _config.get("data_parallel_workers", 1) > 1:
+            # Each data-parallel worker needs its own experiment directory
+            _config.exp_name += "_rank={}".format(_config.data_parallel_rank)
         with _config:
             return training_loop()
     else:
@@ -22,8 +22,9 @@ from dps.utils import Param
 from dps.utils.tf import build_scheduled_value, RenderHook, tf_mean_sum
 
 from auto_yolo.models.core import (
-    VariationalAutoencoder, normal_vae, mAP, xent_loss,
+    VariationalAutoencoder, normal_vae, AP, csr_splits, xent_loss,
     concrete_binary_pre_sigmoid_sample, concrete_binary_sample_kl)
+from auto_yolo.models.data_parallel import is_chief
 
 
 # ------ transformer.py -------
@@ -186,18 +187,10 @@ def transformer(U, theta, out_size, name='SpatialTransformer', **kwargs):
         return output
 
 
-class AIR_AP(object):
+class AIR_AP(AP):
     keys_accessed = "scale shift predicted_n_digits annotations n_annotations"
 
-    def __init__(self, iou_threshold=None):
-        if iou_threshold is not None:
-            try:
-                iou_threshold = list(iou_threshold)
-            except (TypeError, ValueError):
-                iou_threshold = [float(iou_threshold)]
-        self.iou_threshold = iou_threshold
-
-    def __call__(self, _tensors, updater):
+    def get_boxes(self, _tensors, updater):
         network = updater.network
         w, h = np.split(_tensors['scale'], 2, axis=2)
         x, y = np.split(_tensors['shift'], 2, axis=2)
@@ -205,8 +198,6 @@ class AIR_AP(object):
         annotations = _tensors["annotations"]
         n_annotations = _tensors["n_annotations"]
 
-        batch_size = w.shape[0]
-
         transformed_x = 0.5 * (x + 1.)
         transformed_y = 0.5 * (y + 1.)
 
@@ -219,32 +210,25 @@ class AIR_AP(object):
         bottom = top + height
         right = left + width
 
-        ground_truth_boxes = []
-        predicted_boxes = []
-
-        for idx in range(batch_size):
-            _a = [
-                [0, *rest]
-                for (valid, cls, *rest), _
-                in zip(annotations[idx], range(n_annotations[idx]))
-                if valid]
-            ground_truth_boxes.append(_a)
+        is_predicted = np.arange(top.shape[1])[None, :] < predicted_n_digits[:, None]
+        top = top[is_predicted, 0]
+        left = left[is_predicted, 0]
 
-            _predicted_boxes = []
+        predicted_boxes = np.stack(
+            [np.zeros_like(top), np.ones_like(top),
+             top, bottom[is_predicted, 0],
+             left, right[is_predicted, 0]],
+            axis=1)
 
-            for t in range(predicted_n_digits[idx]):
-                _predicted_boxes.append(
-                    [0, 1,
-                     top[idx, t, 0],
-                     bottom[idx, t, 0],
-                     left[idx, t, 0],
-                     right[idx, t, 0]])
+        valid = np.arange(annotations.shape[1])[None, :] < n_annotations[:, None]
+        valid &= annotations[..., 0] != 0
+        ground_truth_boxes = annotations[valid].astype(np.float64)
+        ground_truth_boxes[:, 1] = 0  # replace `valid, cls` with class 0
+        ground_truth_boxes = ground_truth_boxes[:, 1:]
 
-            predicted_boxes.append(_predicted_boxes)
-
-        return mAP(
-            predicted_boxes, ground_truth_boxes, n_classes=1,
-            iou_threshold=self.iou_threshold)
+        return (
+            predicted_boxes, csr_splits(is_predicted),
+            ground_truth_boxes, csr_splits(valid))
 
 
 class AIR_Network(VariationalAutoencoder):
@@ -279,8 +263,7 @@ class AIR_Network(VariationalAutoencoder):
         super(AIR_Network, self).__init__(env, updater, scope=scope, **kwargs)
 
         ap_iou_values = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-        self.eval_funcs = {"AP_at_point_{}".format(int(10 * v)): AIR_AP(v) for v in ap_iou_values}
-        self.eval_funcs["AP"] = AIR_AP(ap_iou_values)
+        self.eval_funcs = {"AP": AIR_AP(ap_iou_values, per_threshold=True)}
 
         self.training_wheels = build_scheduled_value(self.training_wheels, "training_wheels")
 
@@ -642,6 +625,9 @@ class AIR_RenderHook(RenderHook):
         "predicted_n_digits vae_input vae_output background")
 
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         fetched = self._fetch(updater)
         self._plot_reconstruction(updater, fetched)
 
@@ -13,7 +13,7 @@ from dps.utils.tf import RNNCell, tf_mean_sum
 
 from auto_yolo.tf_ops import render_sprites
 from auto_yolo.models import yolo_air
-from auto_yolo.models.core import xent_loss, AP, VariationalAutoencoder, normal_vae
+from auto_yolo.models.core import xent_loss, AP, InGraphAP, VariationalAutoencoder, normal_vae
 
 
 class BboxCell(RNNCell):
@@ -55,17 +55,20 @@ class BboxCell(RNNCell):
 class Baseline_Network(VariationalAutoencoder):
     cc_threshold = Param()
     object_shape = Param()
+    in_graph_ap = Param(
+        False, help="If True, predicted boxes are matched to ground truth boxes inside the graph during "
+                    "evaluation, and only the resulting statistics are fetched.")
 
     object_encoder = None
     object_decoder = None
 
     def __init__(self, env, updater, scope=None, **kwargs):
-        ap_iou_values = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-        self.eval_funcs = {"AP_at_point_{}".format(int(10 * v)): AP(v) for v in ap_iou_values}
-        self.eval_funcs["AP"] = AP(ap_iou_values)
-
         super(Baseline_Network, self).__init__(env, updater, scope=scope, **kwargs)
 
+        ap_iou_values = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+        ap_class = InGraphAP if self.in_graph_ap else AP
+        self.eval_funcs = {"AP": ap_class(ap_iou_values, per_threshold=True)}
+
     def _build_program_generator(self):
         assert len(self.inp.shape) == 4
         mask = tf.reduce_sum(tf.abs(self.inp - self._tensors["background"]), axis=3) >= self.cc_threshold
@@ -202,6 +205,9 @@ class Baseline_Network(VariationalAutoencoder):
 
         self._build_program_generator()
 
+        if "annotations" in self._tensors:
+            self.build_predicted_boxes()
+
         if self.object_encoder is None:
             self.object_encoder = cfg.build_object_encoder(scope="object_encoder")
             if "object_encoder" in self.fixed_weights:
@@ -1,6 +1,13 @@
 import tensorflow as tf
 import numpy as np
 import collections
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.colors import to_rgb
 import matplotlib.pyplot as plt
 from matplotlib import animation
@@ -14,6 +21,8 @@ from dps.utils.tf import (
 from dps.updater import DataManager
 from dps.train import Hook
 
+from auto_yolo.models.data_parallel import AllReduce, is_chief
+
 
 def normal_kl(mean, std, prior_mean, prior_std):
     var = std**2
@@ -32,8 +41,9 @@ def normal_vae(mean, std, prior_mean, prior_std):
     return sample, kl
 
 
-def concrete_binary_pre_sigmoid_sample(log_odds, temperature, eps=10e-10):
-    u = tf.random_uniform(tf.shape(log_odds), minval=0, maxval=1)
+def concrete_binary_pre_sigmoid_sample(log_odds, temperature, eps=10e-10, u=None):
+    if u is None:
+        u = tf.random_uniform(tf.shape(log_odds), minval=0, maxval=1)
     noise = tf.log(u + eps) - tf.log(1.0 - u + eps)
     return (log_odds + noise) / temperature
 
@@ -76,23 +86,132 @@ def xent_loss(*, pred, label, tf=True):
         return -(label * np_safe_log(pred) + (1. - label) * np_safe_log(1. - pred))
 
 
+class PhaseTimer(object):
+    """ Times the phases of a repeated operation, keeping the durations of the `window` most recent
+        repetitions of each phase (or all of them, if `window` is None).
+
+    Usage:
+        with timer("run"):
+            sess.run(...)
+
+    Phases may be timed from several threads at once (e.g. by a pipelined `Evaluator`).
+
+    """
+    def __init__(self, window=100):
+        self.window = window
+        self.durations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                durations = self.durations.setdefault(phase, collections.deque(maxlen=self.window))
+                durations.append(duration)
+
+    def _snapshot(self):
+        with self._lock:
+            return [(phase, list(d)) for phase, d in self.durations.items()]
+
+    def last(self, phase):
+        with self._lock:
+            return self.durations[phase][-1]
+
+    def totals(self):
+        return {"time_" + phase: np.sum(d) for phase, d in self._snapshot()}
+
+    def record(self, percentiles=(50, 90, 99)):
+        """ The most recent duration of each phase under "time_<phase>", and percentiles of the
+            durations in the window under "time_<phase>_p<percentile>". """
+        record = {}
+        for phase, durations in self._snapshot():
+            record["time_" + phase] = durations[-1]
+            for q in percentiles:
+                record["time_{}_p{}".format(phase, q)] = np.percentile(durations, q)
+        return record
+
+
+def throughput(record, duration, n_images=None):
+    """ Images per second and, if the network records the number of objects per image in `n_objects`,
+        objects per second. `n_images` defaults to the batch size in `record`. """
+    if n_images is None:
+        n_images = record["batch_size"]
+
+    result = dict(images_per_sec=n_images / duration)
+    if "n_objects" in record:
+        result["objects_per_sec"] = record["n_objects"] * n_images / duration
+    return result
+
+
 class Evaluator(object):
     """ A helper object for running a list of functions on a collection of evaluated tensors.
 
+    Functions with a true `streaming` attribute are instead objects with methods `new_state()`,
+    `update(state, fetched, updater)` and `result(state)`; they accumulate state over all the batches
+    of an evaluation pass, and their results are computed once, at the end of the pass. `update` also
+    returns a new state containing just the batch it was given. The state is
+    owned by the evaluator, so one function object can be shared by several evaluators, even ones whose
+    passes overlap (see `run_many`).
+
+    Functions may also have a method `build_fetches(tensors, updater)`, which is called once, here,
+    and returns a dictionary of new tensors computed from `tensors` (e.g. statistics computed inside the
+    graph, so that less has to be fetched). These are fetched along with the keys in `keys_accessed`.
+
+    Expensive functions can be run less often using `schedule`, which maps function names to dictionaries
+    with any of the keys:
+
+        every: run the function only on every `every`-th evaluation pass. On the other passes, the
+            results from the last pass on which it ran are reported again.
+        subsample: run the function only on a random subset of the batches, each batch being included
+            with this probability. The subset is the same on every pass.
+        seed: seed for choosing the subset (default 0).
+
+    For subsampled functions, the standard error of each result is also reported, under the result's
+    key with "_stderr" appended. It is estimated from the spread of the results on individual batches;
+    for streaming functions, these are computed from the states returned by `update`. Results of
+    non-streaming subsampled functions are averaged over the sampled batches weighted by batch size, as
+    for functions that aren't subsampled. If no batch is sampled in a pass, the function is treated
+    as skipped by `every` for that pass.
+
     Parameters
     ----------
     functions: a list of functions, each with an attribute `keys_accessed`
                listing the keys required by that function
     tensors: a (posibly nested) dictionary of tensors which will provide the input to the functions
     updater: the updater object, passed into the functions at eval time
+    pipelined: if True, `run` overlaps running the functions on one batch with fetching the next
+    schedule: a dictionary mapping function names to schedules, as described above; names that
+              are not in `functions` are ignored
 
     """
-    def __init__(self, functions, tensors, updater):
+    def __init__(self, functions, tensors, updater, pipelined=False, schedule=None):
         self.functions = functions
         self.updater = updater
+        self.pipelined = pipelined
+
+        # `schedule` usually comes from the global config, so it may name functions that this network
+        # doesn't have (e.g. "AP" for networks without annotations); those entries are ignored.
+        schedule = schedule or {}
+        unknown = schedule.keys() - functions.keys()
+        if unknown:
+            print("Evaluator: ignoring schedule for functions that are not being evaluated: {}".format(
+                sorted(unknown)))
+        self.schedule = {name: s for name, s in schedule.items() if name in functions}
+
+        self.n_runs = 0
+        self.active = set(functions)
+        self._subsample_rngs = {}
+        self._batch_results = {}
+        self._states = {}
+        self._last_results = {}
 
         if not functions:
             self.fetches = {}
+            self._fetch_keys = {}
             return
 
         fetch_keys = set()
@@ -115,171 +234,726 @@ class Evaluator(object):
                     dst = dst[_key]
                     src = src[_key]
 
+        # Top-level keys of `fetches` that each function needs
+        self._fetch_keys = {
+            name: set(key.split(":")[0] for key in f.keys_accessed.split())
+            for name, f in functions.items()}
+
+        for name, f in functions.items():
+            if hasattr(f, "build_fetches"):
+                in_graph_fetches = f.build_fetches(tensors, updater)
+                intersection = fetches.keys() & in_graph_fetches.keys()
+                assert not intersection, "Key sets have non-zero intersection: {}".format(intersection)
+                fetches.update(in_graph_fetches)
+                self._fetch_keys[name] |= in_graph_fetches.keys()
+
         self.fetches = fetches
 
-    def eval(self, fetched):
+    @staticmethod
+    def _record_result(record, name, result):
+        """ A function may return a dictionary, in which case each of its entries is recorded
+            under its own key (instead of under the name of the function). This lets related
+            values share a single computation. """
+        if isinstance(result, dict):
+            record.update({k: np.mean(v) for k, v in result.items()})
+        else:
+            record[name] = np.mean(result)
+
+    @property
+    def active_fetches(self):
+        """ The subset of `self.fetches` needed by the functions that run in the current pass. """
+        keys = set()
+        for name in self.active:
+            keys |= self._fetch_keys[name]
+        return {k: v for k, v in self.fetches.items() if k in keys}
+
+    def reset(self):
+        """ Start a new evaluation pass, choosing the functions that run in it according to `self.schedule`. """
+        self.active = set(
+            name for name in self.functions
+            if self.n_runs % self.schedule.get(name, {}).get('every', 1) == 0)
+        self.n_runs += 1
+
+        self._subsample_rngs = {
+            name: np.random.RandomState(self.schedule[name].get('seed', 0))
+            for name in self.active if self.schedule.get(name, {}).get('subsample') is not None}
+        self._batch_results = {name: [] for name in self._subsample_rngs}
+
+        self._states = {
+            name: self.functions[name].new_state()
+            for name in self.active if getattr(self.functions[name], "streaming", False)}
+
+    def eval(self, fetched, batch_size=1):
         """ fetched should be a dictionary containing numpy arrays derived by fetching the tensors
-            in self.fetches """
+            in self.fetches, for a batch of size `batch_size`
+
+            Returns the results of the non-streaming functions on this batch, and feeds the batch
+            to the streaming functions. Subsampled functions are handled entirely in `finalize`.
+
+        """
         record = {}
         for name, func in self.functions.items():
-            record[name] = np.mean(func(fetched, self.updater))
+            if name not in self.active:
+                continue
+
+            streaming = getattr(func, "streaming", False)
+
+            if name in self._subsample_rngs:
+                if self._subsample_rngs[name].rand() >= self.schedule[name]['subsample']:
+                    continue
+
+                if streaming:
+                    batch_state = func.update(self._states[name], fetched, self.updater)
+                    self._batch_results[name].append((func.result(batch_state), batch_size))
+                else:
+                    self._batch_results[name].append((func(fetched, self.updater), batch_size))
+
+            elif streaming:
+                func.update(self._states[name], fetched, self.updater)
+            else:
+                self._record_result(record, name, func(fetched, self.updater))
+        return record
+
+    def finalize(self):
+        """ Returns the results of the streaming and subsampled functions over everything passed to
+            `eval` since the last reset. """
+        record = {}
+        for name, func in self.functions.items():
+            if name not in self.active:
+                continue
+
+            streaming = getattr(func, "streaming", False)
+
+            if name in self._batch_results:
+                if not self._batch_results[name]:
+                    # No batches were sampled, so report the results of the last pass instead
+                    continue
+
+                batch_values = collections.defaultdict(list)
+                batch_sizes = collections.defaultdict(list)
+                for result, batch_size in self._batch_results[name]:
+                    _record = {}
+                    self._record_result(_record, name, result)
+                    for k, v in _record.items():
+                        batch_values[k].append(v)
+                        batch_sizes[k].append(batch_size)
+
+                if streaming:
+                    batch_record = {}
+                    self._record_result(batch_record, name, func.result(self._states[name]))
+                else:
+                    batch_record = {
+                        k: np.average(values, weights=batch_sizes[k]) for k, values in batch_values.items()}
+
+                for k, v in batch_record.items():
+                    values = batch_values[k]
+                    record[k] = v
+                    record[k + "_stderr"] = (
+                        np.std(values, ddof=1) / np.sqrt(len(values)) if len(values) > 1 else np.nan)
+            elif streaming:
+                self._record_result(record, name, func.result(self._states[name]))
         return record
 
+    def run(self, recorded_tensors, feed_dict):
+        """ Run an evaluation pass over the dataset that `feed_dict` selects.
+
+        Values of `recorded_tensors` and results of non-streaming functions are averaged over
+        batches, weighted by batch size. Streaming functions are computed over the whole dataset.
+
+        If `self.pipelined` is True, the functions are run on each batch in a worker thread while the
+        session computes the next batch. Batches are still passed to the functions one at a time and
+        in order, so the results are the same.
+
+        Results of functions that `self.schedule` skips on this pass are taken from the last pass they ran on.
+
+        """
+        return self.run_many({None: (self, recorded_tensors)}, feed_dict)[None]
+
+    @staticmethod
+    def run_many(runs, feed_dict):
+        """ Run evaluation passes for several evaluators together, with a single `sess.run` per batch.
+
+        The passes end as soon as any of the datasets runs out, so the datasets should all have the
+        same number of batches. Otherwise behaves like `run`, for each evaluator.
+
+        Parameters
+        ----------
+        runs: a dictionary mapping names to pairs (evaluator, recorded_tensors)
+        feed_dict: selects the dataset of every evaluator
+
+        Returns a dictionary mapping each name to the record from the corresponding pass. Each record
+        also contains the total time spent in `sess.run` ("time_run") and in the evaluation functions
+        ("time_host_eval"), the duration of the whole pass ("time_total") and the throughput.
+
+        """
+        passes = {name: _EvaluationPass(evaluator, recorded_tensors)
+                  for name, (evaluator, recorded_tensors) in runs.items()}
+        fetches = {name: p.fetches for name, p in passes.items()}
+
+        sess = tf.get_default_session()
+        timer = PhaseTimer(window=None)
+        start = time.time()
+
+        def batches():
+            while True:
+                try:
+                    with timer("run"):
+                        fetched = sess.run(fetches, feed_dict=feed_dict)
+                except tf.errors.OutOfRangeError:
+                    return
+                yield fetched
+
+        def evaluate(fetched):
+            with timer("host_eval"):
+                return {
+                    name: p.evaluator.eval(fetched[name][1], fetched[name][0]['batch_size'])
+                    for name, p in passes.items()}
+
+        def accumulate(fetched, eval_records):
+            for name, p in passes.items():
+                p.accumulate(fetched[name][0], eval_records[name])
+
+        if any(p.evaluator.pipelined for p in passes.values()):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                pending = None
+                for fetched in batches():
+                    if pending is not None:
+                        accumulate(pending[0], pending[1].result())
+                    pending = (fetched, executor.submit(evaluate, fetched))
+
+                if pending is not None:
+                    accumulate(pending[0], pending[1].result())
+        else:
+            for fetched in batches():
+                accumulate(fetched, evaluate(fetched))
+
+        records = {}
+        for name, p in passes.items():
+            with timer("host_eval"):
+                records[name] = p.result()
+
+        total_time = time.time() - start
+
+        for name, record in records.items():
+            record.update(timer.totals())
+            record["time_total"] = total_time
+            record.update(throughput(record, total_time, n_images=passes[name].n_points))
+
+        return records
+
+
+class _EvaluationPass(object):
+    """ The state of an `Evaluator` during one evaluation pass. """
+
+    def __init__(self, evaluator, recorded_tensors):
+        evaluator.reset()
+
+        self.evaluator = evaluator
+        self.fetches = [recorded_tensors, evaluator.active_fetches]
+
+        self.record = collections.defaultdict(float)
+        self.n_points = 0
+        self.eval_keys = set()
+
+    def accumulate(self, _record, eval_record):
+        _record.update(eval_record)
+        self.eval_keys.update(eval_record)
+
+        batch_size = _record['batch_size']
+
+        for k, v in _record.items():
+            self.record[k] += batch_size * v
+
+        self.n_points += batch_size
+
+    def result(self):
+        record = {k: v / self.n_points for k, v in self.record.items()}
+
+        final_record = self.evaluator.finalize()
+        record.update(final_record)
+        self.eval_keys.update(final_record)
+
+        last_results = self.evaluator._last_results
+        last_results.update({k: record[k] for k in self.eval_keys})
+        for k, v in last_results.items():
+            record.setdefault(k, v)
+
+        return record
+
+
+def compute_iou_matrix(boxes, others):
+    """ IoU between every box in `boxes` and every box in `others`.
 
-def compute_iou(box, others):
-    # box: y_min, y_max, x_min, x_max, area
-    # others: (n_boxes, 5)
-    top = np.maximum(box[0], others[:, 0])
-    bottom = np.minimum(box[1], others[:, 1])
-    left = np.maximum(box[2], others[:, 2])
-    right = np.minimum(box[3], others[:, 3])
+    boxes: (n_boxes, 4), others: (n_others, 4), both with columns y_min, y_max, x_min, x_max
+    Returns: (n_boxes, n_others)
+
+    """
+    top = np.maximum(boxes[:, None, 0], others[None, :, 0])
+    bottom = np.minimum(boxes[:, None, 1], others[None, :, 1])
+    left = np.maximum(boxes[:, None, 2], others[None, :, 2])
+    right = np.minimum(boxes[:, None, 3], others[None, :, 3])
 
     overlap_height = np.maximum(0., bottom - top)
     overlap_width = np.maximum(0., right - left)
     overlap_area = overlap_height * overlap_width
 
-    return overlap_area / (box[4] + others[:, 4] - overlap_area)
+    area = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+    other_area = (others[:, 1] - others[:, 0]) * (others[:, 3] - others[:, 2])
 
+    return overlap_area / (area[:, None] + other_area[None, :] - overlap_area)
 
-def mAP(pred_boxes, gt_boxes, n_classes, recall_values=None, iou_threshold=None):
-    """ Calculate mean average precision on a dataset.
 
-    Averages over:
-        classes, recall_values, iou_threshold
+def greedy_match(iou, iou_thresholds):
+    """ Greedily match predictions to ground truth boxes within one image, for several IoU thresholds at once.
 
-    pred_boxes: [[class, conf, y_min, y_max, x_min, x_max] * n_boxes] * n_images
-    gt_boxes: [[class, y_min, y_max, x_min, x_max] * n_boxes] * n_images
+    Predictions are visited in order; each is matched to the unmatched ground truth box it overlaps most,
+    if that overlap exceeds the threshold. Once every ground truth box is matched, the remaining
+    predictions are not counted at all.
+
+    iou: (n_pred, n_gt), rows sorted by decreasing confidence
+    iou_thresholds: (n_thresholds,)
+
+    Returns
+    -------
+    is_tp: (n_pred, n_thresholds) bool, whether each prediction is a true positive
+    counted: (n_pred, n_thresholds) bool, whether each prediction counts towards precision
 
     """
-    if recall_values is None:
-        recall_values = np.linspace(0.0, 1.0, 11)
+    n_pred, n_gt = iou.shape
+    n_thresholds = len(iou_thresholds)
+
+    is_tp = np.zeros((n_pred, n_thresholds), dtype=np.bool_)
+
+    if n_gt == 0:
+        return is_tp, np.ones((n_pred, n_thresholds), dtype=np.bool_)
+
+    counted = np.zeros((n_pred, n_thresholds), dtype=np.bool_)
+    unmatched = np.ones((n_thresholds, n_gt), dtype=np.bool_)
+    n_unmatched = np.full(n_thresholds, n_gt)
+    threshold_idx = np.arange(n_thresholds)
+
+    for i in range(n_pred):
+        counted[i] = n_unmatched > 0
+        if not counted[i].any():
+            break
+
+        _iou = np.where(unmatched, iou[i][None, :], -1.)
+        best_idx = np.argmax(_iou, axis=1)
+        best_iou = _iou[threshold_idx, best_idx]
+
+        hit = (best_iou > iou_thresholds) & counted[i]
+        is_tp[i] = hit
+        unmatched[threshold_idx[hit], best_idx[hit]] = False
+        n_unmatched -= hit
+
+    return is_tp, counted
+
+
+def tf_compute_iou_matrix(boxes, others):
+    """ TensorFlow version of `compute_iou_matrix`, batched over leading dimensions.
+
+    boxes: (..., n_boxes, 4), others: (..., n_others, 4)
+    Returns: (..., n_boxes, n_others)
+
+    """
+    top = tf.maximum(boxes[..., :, None, 0], others[..., None, :, 0])
+    bottom = tf.minimum(boxes[..., :, None, 1], others[..., None, :, 1])
+    left = tf.maximum(boxes[..., :, None, 2], others[..., None, :, 2])
+    right = tf.minimum(boxes[..., :, None, 3], others[..., None, :, 3])
+
+    overlap_height = tf.maximum(0., bottom - top)
+    overlap_width = tf.maximum(0., right - left)
+    overlap_area = overlap_height * overlap_width
+
+    area = (boxes[..., 1] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 2])
+    other_area = (others[..., 1] - others[..., 0]) * (others[..., 3] - others[..., 2])
+
+    return overlap_area / (area[..., :, None] + other_area[..., None, :] - overlap_area)
+
+
+def tf_greedy_match(iou, pred_valid, gt_valid, iou_thresholds):
+    """ TensorFlow version of `greedy_match`, for a batch of images padded to a common number of boxes.
+
+    Runs a `tf.scan` over predictions, matching the i-th prediction of every image at every threshold at once.
+
+    iou: (n_images, n_pred, n_gt), rows sorted by decreasing confidence within each image
+    pred_valid: (n_images, n_pred) bool, false for padding
+    gt_valid: (n_images, n_gt) bool, false for padding
+    iou_thresholds: (n_thresholds,)
+
+    Returns
+    -------
+    is_tp: (n_images, n_pred, n_thresholds) bool
+    counted: (n_images, n_pred, n_thresholds) bool
+
+    """
+    n_thresholds = len(iou_thresholds)
+    iou_thresholds = tf.constant(iou_thresholds, dtype=iou.dtype)
+
+    n_images = tf.shape(iou)[0]
+    n_gt = tf.shape(iou)[2]
+
+    has_gt = tf.reduce_any(gt_valid, axis=1)
+    unmatched = tf.tile(gt_valid[:, None, :], (1, n_thresholds, 1))
+    no_match = tf.zeros((n_images, n_thresholds), dtype=tf.bool)
+
+    def step(carry, elems):
+        unmatched, _, _ = carry
+        _iou, valid = elems
 
-    if iou_threshold is None:
-        iou_threshold = np.linspace(0.5, 0.95, 10)
+        counted = tf.logical_and(
+            valid[:, None],
+            tf.logical_or(tf.reduce_any(unmatched, axis=2), tf.logical_not(has_gt)[:, None]))
 
-    ap = []
+        _iou = tf.tile(_iou[:, None, :], (1, n_thresholds, 1))
+        _iou = tf.where(unmatched, _iou, -tf.ones_like(_iou))
+        best_idx = tf.argmax(_iou, axis=2, output_type=tf.int32)
+        best_iou = tf.reduce_max(_iou, axis=2)
 
-    for c in range(n_classes):
-        _ap = []
-        for iou_thresh in iou_threshold:
-            predicted_list = []  # Each element is (confidence, ground-truth (0 or 1))
-            n_positives = 0
+        hit = tf.logical_and(best_iou > iou_thresholds, counted)
+        matched = tf.logical_and(tf.one_hot(best_idx, n_gt, on_value=True, off_value=False), hit[..., None])
+        unmatched = tf.logical_and(unmatched, tf.logical_not(matched))
 
-            for pred, gt in zip(pred_boxes, gt_boxes):
-                # Within a single image
+        return unmatched, hit, counted
 
+    _, is_tp, counted = tf.scan(
+        step, (tf.transpose(iou, (1, 0, 2)), tf.transpose(pred_valid)),
+        initializer=(unmatched, no_match, no_match))
+
+    return tf.transpose(is_tp, (1, 0, 2)), tf.transpose(counted, (1, 0, 2))
+
+
+class APAccumulator(object):
+    """ Accumulates the results of matching predicted to ground truth boxes over many images, so that
+    mean average precision can be computed once for a whole dataset.
+
+    For each predicted box, stores its class, its confidence and whether it is a true positive and is
+    counted at each IoU threshold, in arrays that grow geometrically. Sorting and computing precision
+    and recall happens only in `compute`.
+
+    Parameters
+    ----------
+    n_classes: number of classes
+    iou_threshold: IoU thresholds to compute AP at
+    recall_values: recall values at which precision is averaged
+    capacity: number of predicted boxes to preallocate space for
+
+    """
+    def __init__(self, n_classes=1, iou_threshold=None, recall_values=None, capacity=1024):
+        if recall_values is None:
+            recall_values = np.linspace(0.0, 1.0, 11)
+
+        if iou_threshold is None:
+            iou_threshold = np.linspace(0.5, 0.95, 10)
+
+        self.n_classes = n_classes
+        self.iou_threshold = np.array(iou_threshold, dtype=np.float64).reshape(-1)
+        self.recall_values = np.array(recall_values)
+
+        n_thresholds = len(self.iou_threshold)
+        self._cls = np.zeros(capacity, dtype=np.int32)
+        self._conf = np.zeros(capacity)
+        self._is_tp = np.zeros((capacity, n_thresholds), dtype=np.bool_)
+        self._counted = np.zeros((capacity, n_thresholds), dtype=np.bool_)
+
+        self.reset()
+
+    def reset(self):
+        self.n_records = 0
+        self.n_positives = np.zeros(self.n_classes, dtype=np.int64)
+
+    def _append(self, cls, conf, is_tp, counted):
+        n = self.n_records + conf.shape[0]
+
+        if n > self._conf.shape[0]:
+            capacity = max(n, 2 * self._conf.shape[0])
+            for attr in "_cls _conf _is_tp _counted".split():
+                old = getattr(self, attr)
+                new = np.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+                new[:self.n_records] = old[:self.n_records]
+                setattr(self, attr, new)
+
+        self._cls[self.n_records:n] = cls
+        self._conf[self.n_records:n] = conf
+        self._is_tp[self.n_records:n] = is_tp
+        self._counted[self.n_records:n] = counted
+        self.n_records = n
+
+    def add(self, pred_boxes, pred_splits, gt_boxes, gt_splits):
+        """ Match predicted to ground truth boxes for a collection of images, and store the results.
+
+        Boxes for all images are stored contiguously; the boxes of image i are rows
+        splits[i]:splits[i+1] (see `boxes_to_csr`).
+
+        pred_boxes: (n_pred_boxes, 6), columns class, conf, y_min, y_max, x_min, x_max
+        pred_splits: (n_images + 1,)
+        gt_boxes: (n_gt_boxes, 5), columns class, y_min, y_max, x_min, x_max
+        gt_splits: (n_images + 1,)
+
+        """
+        for i in range(len(pred_splits) - 1):
+            # Within a single image
+            pred = pred_boxes[pred_splits[i]:pred_splits[i+1]]
+            gt = gt_boxes[gt_splits[i]:gt_splits[i+1]]
+
+            for c in range(self.n_classes):
                 # Sort by decreasing confidence within current class.
-                pred_c = sorted([b for cls, *b in pred if cls == c], key=lambda k: -k[0])
-                area = [(ymax - ymin) * (xmax - xmin) for _, ymin, ymax, xmin, xmax in pred_c]
-                pred_c = [(*b, a) for b, a in zip(pred_c, area)]
+                pred_c = pred[pred[:, 0] == c, 1:]
+                pred_c = pred_c[np.argsort(-pred_c[:, 0], kind='mergesort')]
 
-                gt_c = [b for cls, *b in gt if cls == c]
-                n_positives += len(gt_c)
+                gt_c = gt[gt[:, 0] == c, 1:]
+                self.n_positives[c] += gt_c.shape[0]
 
-                if not gt_c:
-                    predicted_list.extend((conf, 0) for conf, *b in pred_c)
+                if not pred_c.shape[0]:
                     continue
 
-                gt_c = np.array(gt_c)
-                gt_c_area = (gt_c[:, 1] - gt_c[:, 0]) * (gt_c[:, 3] - gt_c[:, 2])
-                gt_c = np.concatenate([gt_c, gt_c_area[..., None]], axis=1)
-
-                for conf, *box in pred_c:
-                    iou = compute_iou(box, gt_c)
-                    best_idx = np.argmax(iou)
-                    best_iou = iou[best_idx]
-                    if best_iou > iou_thresh:
-                        predicted_list.append((conf, 1.))
-                        gt_c = np.delete(gt_c, best_idx, axis=0)
-                    else:
-                        predicted_list.append((conf, 0.))
-
-                    if not gt_c.shape[0]:
-                        break
-
-            if not predicted_list:
-                ap.append(0.0)
+                is_tp, counted = greedy_match(compute_iou_matrix(pred_c[:, 1:], gt_c), self.iou_threshold)
+                self._append(c, pred_c[:, 0], is_tp, counted)
+
+    def add_matches(self, conf, is_tp, counted, n_positives, cls=0):
+        """ Store the results of matching that has already been done elsewhere (e.g. by `tf_greedy_match`).
+
+        conf: (n_pred_boxes,)
+        is_tp: (n_pred_boxes, n_thresholds) bool
+        counted: (n_pred_boxes, n_thresholds) bool
+        n_positives: number of ground truth boxes of class `cls` that the predictions were matched against
+
+        """
+        self.n_positives[cls] += n_positives
+        if conf.shape[0]:
+            self._append(cls, conf, is_tp, counted)
+
+    def merge(self, other):
+        """ Add everything stored in another accumulator (with the same classes and thresholds) to this one. """
+        n = other.n_records
+        self.n_positives += other.n_positives
+        self._append(other._cls[:n], other._conf[:n], other._is_tp[:n], other._counted[:n])
+
+    def compute(self, per_threshold=False):
+        """ Mean average precision over everything added since the last reset.
+
+        Averages over classes, recall values and IoU thresholds. If `per_threshold` is True, returns
+        an array giving the AP at each IoU threshold (averaged over classes and recall values) instead.
+
+        """
+        n_thresholds = len(self.iou_threshold)
+        ap = np.zeros((self.n_classes, n_thresholds))
+
+        cls = self._cls[:self.n_records]
+
+        for c in range(self.n_classes):
+            in_class = cls == c
+            conf = self._conf[:self.n_records][in_class]
+
+            if not conf.size:
                 continue
 
             # Sort predictions by decreasing confidence.
-            predicted_list = np.array(sorted(predicted_list, key=lambda k: -k[0]), dtype=np.float32)
+            order = np.argsort(-conf, kind='mergesort')
+            is_tp = self._is_tp[:self.n_records][in_class][order]
+            counted = self._counted[:self.n_records][in_class][order]
+
+            for t in range(n_thresholds):
+                tp = is_tp[counted[:, t], t]
+
+                # Compute AP, in single precision so that e.g. a recall of 3/10 counts as reaching 0.3.
+                cs = np.cumsum(tp).astype(np.float32)
+                precision = cs / (np.arange(tp.shape[0], dtype=np.float32) + 1)
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    recall = cs / np.float32(self.n_positives[c])
+                recall = np.where(np.isnan(recall), -np.inf, recall).astype(np.float32)
+
+                # recall is non-decreasing, so the predictions with recall >= r form a suffix.
+                max_precision = np.maximum.accumulate(precision[::-1])[::-1]
+                idx = np.searchsorted(recall, np.float32(self.recall_values), side='left')
+                in_range = idx < tp.shape[0]
+
+                _ap = np.zeros(len(self.recall_values))
+                _ap[in_range] = max_precision[idx[in_range]]
+                ap[c, t] = _ap.mean()
+
+        ap = ap.mean(axis=0)
+        return ap if per_threshold else ap.mean()
+
+
+def boxes_to_csr(boxes, n_columns):
+    """ Convert a list (over images) of lists of boxes to a single array of boxes and the offsets
+        of each image's boxes within it. """
+    splits = np.concatenate([[0], np.cumsum([len(b) for b in boxes])]).astype(np.int64)
+    rows = [row for b in boxes for row in b]
+    return np.array(rows, dtype=np.float64).reshape(-1, n_columns), splits
+
+
+def mAP(pred_boxes, gt_boxes, n_classes, recall_values=None, iou_threshold=None, per_threshold=False):
+    """ Calculate mean average precision on a dataset.
+
+    Averages over:
+        classes, recall_values, iou_threshold
+
+    The IoU between predicted and ground truth boxes is computed once per image and class, and
+    matching is done for all IoU thresholds together.
+
+    pred_boxes: [[class, conf, y_min, y_max, x_min, x_max] * n_boxes] * n_images
+    gt_boxes: [[class, y_min, y_max, x_min, x_max] * n_boxes] * n_images
+    per_threshold: if True, return an array giving the AP at each IoU threshold (averaged over classes
+        and recall values) instead of the overall average.
+
+    """
+    accumulator = APAccumulator(n_classes, iou_threshold, recall_values)
+    accumulator.add(*boxes_to_csr(pred_boxes, 6), *boxes_to_csr(gt_boxes, 5))
+    return accumulator.compute(per_threshold)
 
-            # Compute AP
-            cs = np.cumsum(predicted_list[:, 1])
-            precision = cs / (np.arange(predicted_list.shape[0]) + 1)
-            recall = cs / n_positives
 
-            for r in recall_values:
-                p = precision[recall >= r]
-                _ap.append(0. if p.size == 0 else p.max())
-        ap.append(np.mean(_ap))
-    return np.mean(ap)
+def csr_splits(mask):
+    """ CSR offsets of the rows selected by a boolean mask of shape (n_images, n_candidates). """
+    return np.concatenate([[0], np.cumsum(mask.sum(axis=1))]).astype(np.int64)
 
 
 class AP:
-    keys_accessed = "box normalized_box obj annotations n_annotations"
+    """ Average precision of the predicted boxes.
+
+    If `per_threshold` is True, the result is a dictionary containing the AP at each IoU threshold
+    under "AP_at_point_<10 * threshold>", as well as the average under "AP", all from a single
+    matching pass. If any threshold is not a multiple of 0.1, the keys are "AP_at_point_<100 * threshold>"
+    instead (e.g. "AP_at_point_55" for 0.55).
+
+    Calling the object computes AP for a single batch. An `Evaluator` instead uses it as a streaming
+    function: `new_state` creates an `APAccumulator` for an evaluation pass, `update` adds each batch
+    of the pass to it, and `result` gives the AP over the whole dataset. The object itself holds no
+    state, so it can be shared between evaluators.
+
+    """
+    keys_accessed = "predicted_boxes predicted_box_splits annotations"
+    streaming = True
 
-    def __init__(self, iou_threshold=None):
+    def __init__(self, iou_threshold=None, per_threshold=False):
         if iou_threshold is not None:
             try:
                 iou_threshold = list(iou_threshold)
             except (TypeError, ValueError):
                 iou_threshold = [float(iou_threshold)]
         self.iou_threshold = iou_threshold
+        self.per_threshold = per_threshold
+
+    def get_boxes(self, _tensors, updater):
+        """ Returns predicted and ground truth boxes in the format expected by `APAccumulator.add`.
+
+        The predicted boxes have already been compacted inside the graph
+        (see `VariationalAutoencoder.build_predicted_boxes`).
+
+        """
+        annotations = _tensors["annotations"]
+        annotations = annotations.reshape(-1, *annotations.shape[-2:])
+
+        valid = annotations[..., 0] != 0
+        ground_truth_boxes = annotations[valid].astype(np.float64)
+        ground_truth_boxes[:, 1] = 0  # replace `valid, cls` with class 0
+        ground_truth_boxes = ground_truth_boxes[:, 1:]
+
+        return (
+            _tensors["predicted_boxes"], _tensors["predicted_box_splits"],
+            ground_truth_boxes, csr_splits(valid))
+
+    def _format(self, ap):
+        if not self.per_threshold:
+            return ap
+
+        iou_threshold = self.iou_threshold or np.linspace(0.5, 0.95, 10)
+        scale = 10 if all(np.isclose(10 * t, round(10 * t)) for t in iou_threshold) else 100
+        record = {"AP_at_point_{}".format(int(round(scale * t))): v for t, v in zip(iou_threshold, ap)}
+        assert len(record) == len(ap), "IoU thresholds must be distinct: {}".format(list(iou_threshold))
+        record["AP"] = np.mean(ap)
+        return record
+
+    def _add(self, accumulator, _tensors, updater):
+        accumulator.add(*self.get_boxes(_tensors, updater))
 
     def __call__(self, _tensors, updater):
+        batch = self.new_state()
+        self._add(batch, _tensors, updater)
+        return self.result(batch)
+
+    def new_state(self):
+        return APAccumulator(1, self.iou_threshold)
+
+    def update(self, state, _tensors, updater):
+        """ Add a batch to `state`. Returns an accumulator holding only that batch, so that the AP on
+            the batch can be computed without matching its boxes again. """
+        batch = self.new_state()
+        self._add(batch, _tensors, updater)
+        state.merge(batch)
+        return batch
+
+    def result(self, state):
+        return self._format(state.compute(self.per_threshold))
+
+
+class InGraphAP(AP):
+    """ Average precision of the predicted boxes, with the matching done inside the graph.
+
+    Instead of fetching the predicted and ground truth boxes, builds (in `build_fetches`) ops that sort the predicted
+    boxes of each image, match them to the ground truth boxes and return only the confidence and match
+    flags of each predicted box, and the number of ground truth boxes. These are merged on the host.
+
+    """
+    keys_accessed = ""
+
+    def build_fetches(self, tensors, updater):
         network = updater.network
+        iou_threshold = self.new_state().iou_threshold
 
-        obj = _tensors['obj']
-        top, left, height, width = np.split(_tensors['normalized_box'], 4, axis=-1)
-        annotations = _tensors["annotations"]
+        annotations = tensors["annotations"]
+        annotations = tf.reshape(annotations, (-1, tf.shape(annotations)[-2], tf.shape(annotations)[-1]))
+        n_images = tf.shape(annotations)[0]
 
-        batch_size = obj.shape[0]
+        obj = tf.reshape(tensors["obj"], (n_images, -1))
+        normalized_box = tf.reshape(tensors["normalized_box"], (n_images, -1, 4))
 
-        n_frames = getattr(network, 'n_frames', 0)
-        if n_frames > 0:
-            shape = (batch_size*n_frames, -1)
-            annotations = annotations.reshape(batch_size*n_frames, *annotations.shape[2:])
-        else:
-            shape = (batch_size, -1)
-            annotations = annotations.reshape(batch_size, *annotations.shape[1:])
+        # Pad with one invalid predicted and one invalid ground truth box, so that neither can be empty.
+        obj = tf.pad(obj, [[0, 0], [0, 1]])
+        normalized_box = tf.pad(normalized_box, [[0, 0], [0, 1], [0, 0]])
+        annotations = tf.pad(annotations, [[0, 0], [0, 1], [0, 0]])
 
-        obj = obj.reshape(*shape)
-        top = network.image_height * top.reshape(*shape)
-        left = network.image_width * left.reshape(*shape)
-        height = network.image_height * height.reshape(*shape)
-        width = network.image_width * width.reshape(*shape)
+        top, left, height, width = tf.unstack(normalized_box, axis=-1)
 
-        bottom = top + height
-        right = left + width
+        top = network.image_height * top
+        left = network.image_width * left
+        height = network.image_height * height
+        width = network.image_width * width
 
-        ground_truth_boxes = []
-        predicted_boxes = []
+        pred_boxes = tf.stack([top, top + height, left, left + width], axis=-1)
 
-        for idx, a in enumerate(annotations):
-            _ground_truth_boxes = [(0, *rest) for valid, cls, *rest in a if valid]
+        # Sort by decreasing confidence, ties broken by index. Predictions with obj <= 0 come last.
+        conf = tf.where(obj > 0.0, obj, -np.inf * tf.ones_like(obj))
+        conf, order = tf.nn.top_k(conf, k=tf.shape(conf)[1])
+        pred_valid = conf > 0.0
 
-            ground_truth_boxes.append(_ground_truth_boxes)
+        # Only need to scan over as many predictions as the image with the most of them has.
+        max_pred = tf.maximum(tf.reduce_max(tf.reduce_sum(tf.to_int32(pred_valid), axis=1)), 1)
+        conf = conf[:, :max_pred]
+        order = order[:, :max_pred]
+        pred_valid = pred_valid[:, :max_pred]
 
-            _predicted_boxes = []
+        order += tf.shape(obj)[1] * tf.range(n_images)[:, None]
+        pred_boxes = tf.gather(tf.reshape(pred_boxes, (-1, 4)), order)
 
-            for i in range(obj.shape[1]):
-                o = obj[idx, i]
+        gt_valid = tf.not_equal(annotations[..., 0], 0)
+        gt_boxes = annotations[..., 2:]
 
-                if o > 0.0:
-                    _predicted_boxes.append(
-                        [0, o,
-                         top[idx, i],
-                         bottom[idx, i],
-                         left[idx, i],
-                         right[idx, i]]
-                    )
+        iou = tf_compute_iou_matrix(tf.to_double(pred_boxes), tf.to_double(gt_boxes))
+        is_tp, counted = tf_greedy_match(iou, pred_valid, gt_valid, iou_threshold)
 
-            predicted_boxes.append(_predicted_boxes)
+        return dict(
+            ap_conf=tf.boolean_mask(conf, pred_valid),
+            ap_is_tp=tf.boolean_mask(is_tp, pred_valid),
+            ap_counted=tf.boolean_mask(counted, pred_valid),
+            ap_n_positives=tf.reduce_sum(tf.to_int32(gt_valid)),
+        )
 
-        return mAP(
-            predicted_boxes, ground_truth_boxes,
-            n_classes=1, iou_threshold=self.iou_threshold)
+    def _add(self, accumulator, _tensors, updater):
+        accumulator.add_matches(
+            _tensors["ap_conf"], _tensors["ap_is_tp"], _tensors["ap_counted"], _tensors["ap_n_positives"])
 
 
 class Updater(_Updater):
@@ -287,6 +961,48 @@ class Updater(_Updater):
     lr_schedule = Param()
     noise_schedule = Param()
     max_grad_norm = Param()
+    pipeline_eval = Param(
+        False, help="If True, host-side evaluation functions run on each batch in a worker thread "
+                    "while the next batch is computed.")
+    eval_schedule = Param(
+        None, help="Dictionary mapping names of the network's eval_funcs to dictionaries with keys `every` "
+                   "(run on every k-th evaluation only) and `subsample` (run on this fraction of the batches). "
+                   "See `Evaluator`.")
+
+    data_parallel_workers = Param(
+        1, help="Number of processes to train with (see `auto_yolo.models.data_parallel`). Each process "
+                "runs the network on a batch of size `batch_size / data_parallel_workers`, and gradients "
+                "are averaged. Evaluation runs on worker 0 only, on batches of size `batch_size`.")
+    data_parallel_rank = Param(0, help="Index of this process among the data-parallel workers.")
+    data_parallel_address = Param(
+        "localhost:29500", help="host:port that the data-parallel worker with rank 0 listens on.")
+    accumulate_steps = Param(
+        1, help="Number of micro-batches to split each update into. Gradients are summed over the "
+                "micro-batches (of size `batch_size / accumulate_steps`) before being applied, so peak "
+                "memory is that of a single micro-batch.")
+    recompute = Param(
+        False, help="If True, gradients are computed by `auto_yolo.models.recompute.recompute_gradients`, "
+                    "using the network's `checkpoints`. Activations between checkpoints are recomputed "
+                    "during the backward pass instead of being kept from the forward pass. Networks "
+                    "that don't define any checkpoints get the usual gradients. Not supported with the object "
+                    "layer's sequential_mode=\"while_loop\".")
+
+    timing_window = Param(
+        100, help="Number of recent updates over which percentiles of the time taken by each phase of "
+                  "an update are computed.")
+    metrics_file = Param(
+        None, help="Name of a file in the experiment directory (e.g. \"metrics.jsonl\") that training and "
+                   "evaluation records are appended to, one JSON object per line. A line is written on "
+                   "every update, so the file grows throughout training. None to disable.")
+
+    all_reduce = None
+    _variables_synced = False
+
+    # If a list, every `sess.run` in an update is traced and its RunMetadata appended (see ProfileHook)
+    run_metadata = None
+
+    # If set (by a ProfileHook), the next update is traced and the hook writes its profile
+    profile_next_update = None
 
     def __init__(self, env, scope=None, **kwargs):
         self.obs_shape = env.obs_shape
@@ -296,66 +1012,202 @@ class Updater(_Updater):
 
         super(Updater, self).__init__(env, scope=scope, **kwargs)
 
+        self.timer = PhaseTimer(self.timing_window)
+
     def trainable_variables(self, for_opt):
         return self.network.trainable_variables(for_opt)
 
     def _update(self, batch_size):
-        feed_dict = self.data_manager.do_train()
+        profile_hook, self.profile_next_update = self.profile_next_update, None
 
-        sess = tf.get_default_session()
-        _, record, train_record = sess.run(
-            [self.train_op, self.recorded_tensors, self.train_records], feed_dict=feed_dict)
-        record.update(train_record)
+        if profile_hook is not None:
+            # Tracing slows the update down, so keep it out of the timing statistics
+            timer, self.timer = self.timer, PhaseTimer()
+            self.run_metadata = []
+
+        try:
+            with self.timer("step"):
+                record = self._run_update()
+
+            record.update(self.timer.record())
+            record.update(throughput(record, self.timer.last("step")))
+        finally:
+            if profile_hook is not None:
+                self.timer = timer
+                run_metadata, self.run_metadata = self.run_metadata, None
+
+        if profile_hook is not None:
+            profile_hook.write_profiles(self, run_metadata)
+
+        self._write_metrics("train", record)
 
         return dict(train=record)
 
-    def _evaluate(self, _batch_size, mode):
-        if mode == "val":
-            feed_dict = self.data_manager.do_val()
-        elif mode == "test":
-            feed_dict = self.data_manager.do_test()
+    def _run_update(self):
+        if self.accumulate_steps == 1 and self.all_reduce is None:
+            # Gradients (recomputed or not) are computed and applied in the same `sess.run`
+            with self.timer("fetch"):
+                feed_dict = self.train_data_manager.do_train()
+            with self.timer("run"):
+                _, record, train_record = self._run(
+                    [self.train_op, self.recorded_tensors, self.train_records], feed_dict=feed_dict)
+            record.update(train_record)
+            return record
+
+        if self.all_reduce is not None and not self._variables_synced:
+            self._sync_variables()
+
+        if self.accumulate_steps > 1:
+            self._run(self.reset_accumulators_op)
+
+            records = []
+            for i in range(self.accumulate_steps):
+                with self.timer("fetch"):
+                    feed_dict = self.train_data_manager.do_train()
+                with self.timer("run"):
+                    _, _record = self._run([self.accumulate_op, self.recorded_tensors], feed_dict=feed_dict)
+                records.append(_record)
+
+            # Micro-batches all have the same size, so these are averages over the whole batch.
+            record = {k: np.mean([r[k] for r in records]) for k in records[0]}
+            record['batch_size'] = np.sum([r['batch_size'] for r in records])
+
+            grads = self._run(self.grads)
         else:
-            raise Exception("Unknown evaluation mode: {}".format(mode))
+            with self.timer("fetch"):
+                feed_dict = self.train_data_manager.do_train()
+            with self.timer("run"):
+                grads, record = self._run([self.grads, self.recorded_tensors], feed_dict=feed_dict)
 
-        record = collections.defaultdict(float)
-        n_points = 0
+        if self.all_reduce is not None:
+            # Average gradients over all workers
+            with self.timer("all_reduce"):
+                grads = self.all_reduce.mean(grads)
 
+        # The gradients are fed in, so this doesn't read from the dataset
+        with self.timer("apply"):
+            _, train_record = self._run(
+                [self.train_op, self.train_records], feed_dict=dict(zip(self.grad_placeholders, grads)))
+
+        record.update(train_record)
+
+        return record
+
+    def _run(self, fetches, feed_dict=None):
         sess = tf.get_default_session()
 
-        while True:
-            try:
-                _record, eval_fetched = sess.run(
-                    [self.recorded_tensors, self.evaluator.fetches], feed_dict=feed_dict)
-            except tf.errors.OutOfRangeError:
-                break
+        if self.run_metadata is None:
+            return sess.run(fetches, feed_dict=feed_dict)
 
-            eval_record = self.evaluator.eval(eval_fetched)
-            _record.update(eval_record)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        self.run_metadata.append(run_metadata)
+        return result
 
-            batch_size = _record['batch_size']
+    def _write_metrics(self, mode, record):
+        """ Append the scalar values in `record` to the metrics file, as a line of JSON. """
+        if not self.metrics_file or not is_chief(self):
+            return
 
-            for k, v in _record.items():
-                record[k] += batch_size * v
+        exp_dir = getattr(self, "exp_dir", None)
+        if exp_dir is None:
+            return
 
-            n_points += batch_size
+        line = dict(mode=mode, time=time.time())
+        for k, v in record.items():
+            if np.ndim(v) == 0:
+                try:
+                    line[k] = float(v)
+                except (TypeError, ValueError):
+                    pass
+
+        with open(exp_dir.path_for(self.metrics_file), "a") as f:
+            f.write(json.dumps(line) + "\n")
+
+    def _sync_variables(self):
+        """ Copy the values of all variables from worker 0 to the other data-parallel workers. """
+        exp_dir = getattr(self, "exp_dir", None)
+        if exp_dir is not None:
+            # Every worker saves checkpoints, so they can't share an experiment directory
+            locations = self.all_reduce.gather((socket.gethostname(), os.path.abspath(exp_dir.path)))
+            if len(set(locations)) != len(locations):
+                raise Exception(
+                    "Data-parallel workers must have separate experiment directories (e.g. include "
+                    "data_parallel_rank in exp_name), got: {}".format(locations))
 
-        return {k: v / n_points for k, v in record.items()}
+        sess = tf.get_default_session()
+        variables = tf.global_variables()
+        values = self.all_reduce.broadcast(sess.run(variables))
+        if self.all_reduce.rank != 0:
+            for v, value in zip(variables, values):
+                v.load(value, sess)
+        self._variables_synced = True
+
+    def _evaluate(self, _batch_size, mode):
+        if mode not in ("val", "test"):
+            raise Exception("Unknown evaluation mode: {}".format(mode))
+
+        if not is_chief(self):
+            record = None
+        else:
+            if mode == "val":
+                feed_dict = self.data_manager.do_val()
+            else:
+                feed_dict = self.data_manager.do_test()
+
+            record = self.evaluator.run(self.eval_recorded_tensors, feed_dict)
+            self._write_metrics(mode, record)
+
+        if self.all_reduce is not None:
+            # Only worker 0 evaluates. The others get its record, so that all workers
+            # make the same decisions based on it (e.g. when to stop).
+            record = self.all_reduce.broadcast(record)
+
+        return record
 
     def _build_graph(self):
+        if self.data_parallel_workers > 1:
+            # Give each worker a different shuffle of the data. Differences in initialization
+            # are removed by `_sync_variables`. Without a seed, the shuffles differ anyway.
+            seed = tf.get_default_graph().seed
+            if seed is not None:
+                tf.set_random_seed(seed + self.data_parallel_rank)
+
+            self.all_reduce = AllReduce(
+                self.data_parallel_rank, self.data_parallel_workers, self.data_parallel_address)
+
+        n_shards = self.data_parallel_workers * self.accumulate_steps
+        assert cfg.batch_size % n_shards == 0, (
+            "batch_size must be divisible by data_parallel_workers * accumulate_steps.")
+
+        # `data_manager` always gives full batches, for evaluation and for hooks that fetch from it
+        # (e.g. render hooks). Training batches are split into `n_shards` by `train_data_manager`.
         self.data_manager = DataManager(self.env.datasets['train'],
                                         self.env.datasets['val'],
                                         self.env.datasets['test'],
                                         cfg.batch_size)
         self.data_manager.build_graph()
 
-        data = self.data_manager.iterator.get_next()
+        if n_shards == 1:
+            self.train_data_manager = self.data_manager
+        else:
+            self.train_data_manager = DataManager(
+                train_dataset=self.env.datasets['train'], batch_size=cfg.batch_size // n_shards)
+            self.train_data_manager.build_graph()
+
+        data = self.train_data_manager.iterator.get_next()
         self.inp = data["image"]
-        network_outputs = self.network(data, self.data_manager.is_training)
+        network_outputs = self.network(data, self.train_data_manager.is_training)
 
         network_tensors = network_outputs["tensors"]
         network_recorded_tensors = network_outputs["recorded_tensors"]
         network_losses = network_outputs["losses"]
 
+        # Taken from this build's outputs, since building the network again (for evaluation, below)
+        # replaces its `checkpoints`
+        checkpoints = network_outputs.get("checkpoints", [])
+
         self.tensors = network_tensors
 
         self.recorded_tensors = recorded_tensors = dict(global_step=tf.train.get_or_create_global_step())
@@ -372,8 +1224,47 @@ class Updater(_Updater):
 
         tvars = self.trainable_variables(for_opt=True)
 
+        train_loss = self.loss
+
+        if self.accumulate_steps > 1 or self.all_reduce is not None or self.recompute:
+            # The train op is driven by gradients computed here (possibly averaged over micro-batches
+            # and/or workers): the gradient of `train_loss` wrt each variable is the corresponding gradient.
+            # If they are applied in a separate `sess.run` from the one that computes them (see
+            # `_run_update`), they are fed in through `grad_placeholders`, so that the train op
+            # doesn't depend on the dataset iterator and can't pull another batch.
+            if self.recompute:
+                object_layer = getattr(self.network, "object_layer", None)
+                if getattr(object_layer, "sequential_mode", None) == "while_loop":
+                    raise Exception(
+                        "recompute=True has no effect with sequential_mode=\"while_loop\": ops inside "
+                        "a while loop can't be recomputed. Use sequential_mode=\"unroll\" or \"wavefront\".")
+
+                # Imports tf.contrib.graph_editor, so only when it's needed
+                from auto_yolo.models.recompute import recompute_gradients
+                grads = recompute_gradients(self.loss, tvars, checkpoints)
+            else:
+                grads = tf.gradients(self.loss, tvars)
+
+            grads = [tf.zeros_like(v) if g is None else tf.convert_to_tensor(g) for v, g in zip(tvars, grads)]
+
+            if self.accumulate_steps > 1:
+                accumulators = [
+                    tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), trainable=False, name="grad_accumulator")
+                    for v in tvars]
+                self.accumulate_op = tf.group(*[a.assign_add(g) for a, g in zip(accumulators, grads)])
+                self.reset_accumulators_op = tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators])
+                grads = [a / self.accumulate_steps for a in accumulators]
+
+            # This worker's gradients
+            self.grads = grads
+
+            if self.accumulate_steps > 1 or self.all_reduce is not None:
+                self.grad_placeholders = grads = [tf.placeholder(v.dtype.base_dtype, v.shape) for v in tvars]
+
+            train_loss = tf.add_n([tf.reduce_sum(v * tf.stop_gradient(g)) for v, g in zip(tvars, grads)])
+
         self.train_op, self.train_records = build_gradient_train_op(
-            self.loss, tvars, self.optimizer_spec, self.lr_schedule,
+            train_loss, tvars, self.optimizer_spec, self.lr_schedule,
             self.max_grad_norm, self.noise_schedule)
 
         # --- recorded values ---
@@ -382,11 +1273,32 @@ class Updater(_Updater):
         assert not intersection, "Key sets have non-zero intersection: {}".format(intersection)
         recorded_tensors.update(network_recorded_tensors)
 
-        intersection = recorded_tensors.keys() & self.network.eval_funcs.keys()
+        # --- evaluation ---
+
+        if n_shards == 1:
+            self.eval_recorded_tensors = recorded_tensors
+            eval_tensors = network_tensors
+        else:
+            # Build the network again on the full batches of `data_manager` (similar to `EvalHook`).
+            # This comes last, so that the network's tensors (which render hooks fetch, feeding
+            # `data_manager`) are those of this build.
+            data = self.data_manager.iterator.get_next()
+            network_outputs = self.network(data, self.data_manager.is_training)
+            eval_tensors = network_outputs["tensors"]
+
+            self.eval_recorded_tensors = dict(global_step=tf.train.get_or_create_global_step())
+            self.eval_recorded_tensors['loss'] = 0.0
+            for name, tensor in network_outputs["losses"].items():
+                self.eval_recorded_tensors['loss'] += tensor
+                self.eval_recorded_tensors['loss_' + name] = tensor
+            self.eval_recorded_tensors.update(network_outputs["recorded_tensors"])
+
+        intersection = self.eval_recorded_tensors.keys() & self.network.eval_funcs.keys()
         assert not intersection, "Key sets have non-zero intersection: {}".format(intersection)
 
         # For running functions, during evaluation, that are not implemented in tensorflow
-        self.evaluator = Evaluator(self.network.eval_funcs, network_tensors, self)
+        self.evaluator = Evaluator(
+            self.network.eval_funcs, eval_tensors, self, self.pipeline_eval, self.eval_schedule)
 
 
 class EvalHook(Hook):
@@ -398,26 +1310,58 @@ class EvalHook(Hook):
         name = dataset_class.__name__ + ("_" + kwarg_string if kwarg_string else "")
         self.name = name.replace(" ", "_")
         self.plot_step = plot_step
+
+        self._datasets = {}
+        self._built = {}
+
         super(EvalHook, self).__init__(final=True, **kwargs)
 
-    def start_stage(self, training_loop, updater, stage_idx):
-        # similar to `build_graph`
+    def _dataset_key(self, updater):
+        """ The image shape, and the values that the dataset class's Params take under the current cfg
+            (e.g. `min_chars` and `max_chars`, which change between the stages of the transfer experiments). """
+        params = {}
+        for name in dir(self.dataset_class):
+            param = getattr(self.dataset_class, name, None)
+            if isinstance(param, Param):
+                params[name] = self.dataset_kwargs.get(name, cfg.get(name, getattr(param, "default", None)))
+        return repr((tuple(updater.obs_shape), sorted(params.items())))
 
+    def start_stage(self, training_loop, updater, stage_idx):
+        """ Datasets are cached by image shape and dataset parameters (see `_dataset_key`), and reused by
+            later stages for which both are the same. Evaluation subgraphs are cached by graph and network
+            as well, and the ones built in an earlier graph or for an earlier network are dropped. """
         self.network = updater.network
+        key = self._dataset_key(updater)
 
-        dataset = self.dataset_class(**self.dataset_kwargs)
-        self.data_manager = DataManager(val_dataset=dataset, batch_size=cfg.batch_size)
-        self.data_manager.build_graph()
+        if key not in self._datasets:
+            self._datasets[key] = self.dataset_class(**self.dataset_kwargs)
 
-        data = self.data_manager.iterator.get_next()  # a dict mapping from names to tensors
-        self.inp = data["image"]
-        network_outputs = self.network(data, self.data_manager.is_training)
+        graph = tf.get_default_graph()
+        self._built = {
+            k: v for k, v in self._built.items()
+            if k[0] is graph and k[1] is self.network}
+
+        built_key = (graph, self.network, key)
+        if built_key not in self._built:
+            self._built[built_key] = self._build_eval_graph(self._datasets[key])
+
+        for attr, value in self._built[built_key].items():
+            setattr(self, attr, value)
+
+    def _build_eval_graph(self, dataset):
+        # similar to `Updater._build_graph`
+
+        data_manager = DataManager(val_dataset=dataset, batch_size=cfg.batch_size)
+        data_manager.build_graph()
+
+        data = data_manager.iterator.get_next()  # a dict mapping from names to tensors
+        network_outputs = self.network(data, data_manager.is_training)
 
         network_tensors = network_outputs["tensors"]
         network_recorded_tensors = network_outputs["recorded_tensors"]
         network_losses = network_outputs["losses"]
 
-        self.recorded_tensors = recorded_tensors = dict(global_step=tf.train.get_or_create_global_step())
+        recorded_tensors = dict(global_step=tf.train.get_or_create_global_step())
 
         # --- loss ---
 
@@ -425,7 +1369,6 @@ class EvalHook(Hook):
         for name, tensor in network_losses.items():
             recorded_tensors['loss'] += tensor
             recorded_tensors['loss_' + name] = tensor
-        self.loss = recorded_tensors['loss']
 
         intersection = recorded_tensors.keys() & network_recorded_tensors.keys()
         assert not intersection, "Key sets have non-zero intersection: {}".format(intersection)
@@ -435,33 +1378,25 @@ class EvalHook(Hook):
         assert not intersection, "Key sets have non-zero intersection: {}".format(intersection)
 
         # For running functions, during evaluation, that are not implemented in tensorflow
-        self.evaluator = Evaluator(self.network.eval_funcs, network_tensors, self)
+        evaluator = Evaluator(
+            self.network.eval_funcs, network_tensors, self,
+            cfg.get('pipeline_eval', False), cfg.get('eval_schedule', None))
 
-    def step(self, training_loop, updater, step_idx=None):
-        feed_dict = self.data_manager.do_val()
-        record = collections.defaultdict(float)
-        n_points = 0
-
-        sess = tf.get_default_session()
-
-        while True:
-            try:
-                _record, eval_fetched = sess.run(
-                    [self.recorded_tensors, self.evaluator.fetches], feed_dict=feed_dict)
-            except tf.errors.OutOfRangeError:
-                break
-
-            eval_record = self.evaluator.eval(eval_fetched)
-            _record.update(eval_record)
-
-            batch_size = _record['batch_size']
-
-            for k, v in _record.items():
-                record[k] += batch_size * v
+        return dict(
+            data_manager=data_manager,
+            inp=data["image"],
+            recorded_tensors=recorded_tensors,
+            loss=recorded_tensors['loss'],
+            evaluator=evaluator,
+        )
 
-            n_points += batch_size
+    def step(self, training_loop, updater, step_idx=None):
+        # The graph is still built on every data-parallel worker, so that all workers have the same variables
+        if not is_chief(updater):
+            return {}
 
-        return {self.name: {k: v / n_points for k, v in record.items()}}
+        feed_dict = self.data_manager.do_val()
+        return {self.name: self.evaluator.run(self.recorded_tensors, feed_dict)}
 
     def _plot(self, updater, rollouts):
         plt.ion()
@@ -493,6 +1428,122 @@ class EvalHook(Hook):
         plt.close(fig)
 
 
+def summarize_step_stats(step_stats, graph=None, scope_depth=4):
+    """ Summarize the time taken by the ops in a traced `sess.run`, by op type and by name scope.
+
+    Time spent in an op is counted towards each of its enclosing name scopes up to depth
+    `scope_depth` (e.g. "network", "network/representation", "network/representation/objects", ...).
+
+    Returns a string containing a table for each.
+
+    """
+    graph = graph or tf.get_default_graph()
+
+    by_type = collections.defaultdict(lambda: [0, 0])
+    by_scope = collections.defaultdict(lambda: [0, 0])
+    total = 0
+
+    for dev_stats in step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            name = node_stats.node_name.split(":")[0]
+            micros = node_stats.all_end_rel_micros
+            total += micros
+
+            try:
+                op_type = graph.get_operation_by_name(name).type
+            except KeyError:
+                op_type = "<{}>".format(name)
+
+            by_type[op_type][0] += micros
+            by_type[op_type][1] += 1
+
+            scopes = name.split("/")[:-1]
+            for d in range(1, min(len(scopes), scope_depth) + 1):
+                by_scope["/".join(scopes[:d])][0] += micros
+                by_scope["/".join(scopes[:d])][1] += 1
+
+    lines = []
+    for title, table in [("op type", by_type), ("name scope", by_scope)]:
+        lines.append("{:<70} {:>12} {:>8} {:>8}".format("--- by " + title, "ms", "%", "n_ops"))
+        for key, (micros, count) in sorted(table.items(), key=lambda item: -item[1][0]):
+            lines.append("{:<70} {:>12.3f} {:>8.2f} {:>8}".format(
+                key, micros / 1000., 100. * micros / max(total, 1), count))
+        lines.append("")
+    lines.append("total: {:.3f} ms".format(total / 1000.))
+    return "\n".join(lines)
+
+
+class ProfileHook(Hook):
+    """ Every `n` steps, have the next training update run with full tracing, and write a Chrome trace
+    (viewable at chrome://tracing) and a summary of the time taken by each op type and name scope
+    (see `summarize_step_stats`) to `exp_dir/profiles/`. One trace and summary is written for each
+    `sess.run` in the update.
+
+    The traced update is one of the training loop's own updates, so profiling doesn't change the
+    course of training; it is left out of the updater's timing statistics.
+
+    """
+    def __init__(self, scope_depth=4, **kwargs):
+        self.scope_depth = scope_depth
+        super(ProfileHook, self).__init__(**kwargs)
+
+    def step(self, training_loop, updater, step_idx=None):
+        if is_chief(updater):
+            updater.profile_next_update = self
+
+    def write_profiles(self, updater, all_run_metadata):
+        from tensorflow.python.client import timeline
+
+        global_step = tf.get_default_session().run(tf.train.get_or_create_global_step())
+
+        for i, run_metadata in enumerate(all_run_metadata):
+            suffix = "step={}_run={}".format(global_step, i)
+
+            trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+            with open(updater.exp_dir.path_for('profiles', 'timeline_{}.json'.format(suffix)), 'w') as f:
+                f.write(trace)
+
+            summary = summarize_step_stats(run_metadata.step_stats, scope_depth=self.scope_depth)
+            with open(updater.exp_dir.path_for('profiles', 'summary_{}.txt'.format(suffix)), 'w') as f:
+                f.write(summary)
+
+
+class MultiEvalHook(Hook):
+    """ Evaluate on the datasets of several `EvalHook`s in a single pass.
+
+    Each batch of the pass is one `sess.run` that runs the network on a batch from every dataset, and
+    the results are recorded separately for each dataset, under the name of its hook. Every `EvalHook`
+    uses `n_val` examples, so the datasets all run out on the same batch.
+
+    Parameters
+    ----------
+    hooks: a list of `EvalHook`s; only their datasets are used, so their other arguments are ignored
+
+    """
+    def __init__(self, hooks, **kwargs):
+        self.hooks = hooks
+
+        names = [hook.name for hook in hooks]
+        assert len(set(names)) == len(names), "Hooks must have distinct names: {}".format(names)
+
+        super(MultiEvalHook, self).__init__(final=True, **kwargs)
+
+    def start_stage(self, training_loop, updater, stage_idx):
+        for hook in self.hooks:
+            hook.start_stage(training_loop, updater, stage_idx)
+
+    def step(self, training_loop, updater, step_idx=None):
+        if not is_chief(updater):
+            return {}
+
+        feed_dict = {}
+        for hook in self.hooks:
+            feed_dict.update(hook.data_manager.do_val())
+
+        return Evaluator.run_many(
+            {hook.name: (hook.evaluator, hook.recorded_tensors) for hook in self.hooks}, feed_dict)
+
+
 class TensorRecorder(ScopedFunction):
     _recorded_tensors = None
 
@@ -534,6 +1585,10 @@ class VariationalAutoencoder(TensorRecorder):
 
     eval_funcs = dict()
 
+    # Lists of tensors that divide the forward pass into segments, for recomputing gradients
+    # (see `auto_yolo.models.recompute`). With none, gradients are computed as usual.
+    checkpoints = []
+
     background_encoder = None
     background_decoder = None
 
@@ -556,6 +1611,37 @@ class VariationalAutoencoder(TensorRecorder):
 
         super(VariationalAutoencoder, self).__init__(scope=scope, **kwargs)
 
+    def build_predicted_boxes(self):
+        """ Compact the predicted boxes, for evaluation.
+
+        A box is predicted for every object with obj > 0, with obj as its confidence. Stores these in
+        `predicted_boxes`, shape (n_on, 6), with columns class (always 0), conf, y_min, y_max, x_min, x_max
+        in pixels, and `predicted_box_splits`, shape (n_images + 1,); the boxes of image i are rows
+        splits[i]:splits[i+1]. Fetching these instead of the dense `obj` and `normalized_box` tensors
+        moves an amount of data proportional to the number of objects that are on.
+
+        """
+        obj = self._tensors["obj"]
+        n_frames = getattr(self, 'n_frames', 0)
+        n_images = tf.shape(obj)[0] * max(n_frames, 1)
+
+        obj = tf.reshape(obj, (n_images, -1))
+        normalized_box = tf.reshape(self._tensors["normalized_box"], (n_images, -1, 4))
+        top, left, height, width = tf.unstack(normalized_box, axis=-1)
+
+        top = self.image_height * top
+        left = self.image_width * left
+        height = self.image_height * height
+        width = self.image_width * width
+
+        boxes = tf.stack([tf.zeros_like(obj), obj, top, top + height, left, left + width], axis=-1)
+
+        is_predicted = obj > 0.0
+        n_predicted = tf.reduce_sum(tf.to_int32(is_predicted), axis=1)
+
+        self._tensors["predicted_boxes"] = tf.boolean_mask(boxes, is_predicted)
+        self._tensors["predicted_box_splits"] = tf.concat([[0], tf.cumsum(n_predicted)], axis=0)
+
     def build_math_representation(self):
         attr_shape = tf.shape(self._tensors['attr'])
         attr = tf.reshape(self._tensors['attr'], (-1, self.A))
@@ -635,6 +1721,7 @@ class VariationalAutoencoder(TensorRecorder):
             tensors=self._tensors,
             recorded_tensors=self.recorded_tensors,
             losses=self.losses,
+            checkpoints=self.checkpoints,
         )
 
     def build_background(self):
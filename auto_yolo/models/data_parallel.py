@@ -0,0 +1,165 @@
+""" Synchronous data-parallel training over `multiprocessing.connection`.
+
+Each worker process builds the full graph and computes gradients on its own shard of the batch
+(`batch_size / data_parallel_workers` examples, drawn from its own shuffle of the data). Gradients are then
+averaged over all workers, and every worker applies the same averaged gradients, so that all copies of
+the variables stay identical. Variables are copied from worker 0 to the others before the first update.
+Evaluation runs on worker 0 alone, with full batches, and its results are sent to the other workers.
+
+Only worker 0 runs hooks (evaluation, profiling and rendering) and writes the metrics file (see
+`is_chief`). Every worker still saves checkpoints, so that each one can restore the same weights,
+and so each worker needs its own experiment directory; this is checked before the first update.
+`auto_yolo.envs.run_experiment` adds the rank to the experiment name.
+
+Workers talk to worker 0 over TCP, so they can be spread over several hosts, as long as every host
+can reach `data_parallel_address` on the host running worker 0. To run all workers on one host:
+
+    from auto_yolo.models.data_parallel import spawn
+
+    def run(rank):
+        config.update(data_parallel_workers=4, data_parallel_rank=rank)
+        run_experiment(...)
+
+    spawn(run, 4)
+
+On several hosts, start one process per worker with `data_parallel_rank` set to 0, ..., n-1 and the
+same `data_parallel_workers` and `data_parallel_address` everywhere.
+
+"""
+import multiprocessing
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+def is_chief(updater):
+    """ False if `updater` is a data-parallel worker other than worker 0. Hooks that evaluate or write
+        files only run on worker 0, which avoids duplicated work and output. """
+    all_reduce = getattr(updater, "all_reduce", None)
+    return all_reduce is None or all_reduce.rank == 0
+
+
+def parse_address(address):
+    """ "host:port" -> (host, port) """
+    if isinstance(address, str):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return tuple(address)
+
+
+class AllReduce(object):
+    """ Sums lists of numpy arrays over a group of processes.
+
+    Worker 0 listens on `address`; the other workers connect to it. Worker 0 receives the arrays of
+    every worker, sums them in order of rank (so the result does not depend on arrival order) and
+    sends the result back to each worker.
+
+    Parameters
+    ----------
+    rank: index of this worker, in [0, world_size)
+    world_size: number of workers
+    address: "host:port" or (host, port) that worker 0 listens on
+    authkey: bytes used to authenticate connections
+    timeout: seconds that workers other than 0 keep trying to connect for
+
+    """
+    def __init__(self, rank, world_size, address, authkey=b"auto_yolo", timeout=300):
+        assert 0 <= rank < world_size, "Invalid rank {} for world size {}.".format(rank, world_size)
+
+        self.rank = rank
+        self.world_size = world_size
+        address = parse_address(address)
+
+        if rank == 0:
+            self.connections = [None] * world_size
+            with Listener(address, authkey=authkey) as listener:
+                for _ in range(world_size - 1):
+                    conn = listener.accept()
+                    other_rank = conn.recv()
+                    assert self.connections[other_rank] is None, "Rank {} connected twice.".format(other_rank)
+                    self.connections[other_rank] = conn
+            self.connections = self.connections[1:]
+        else:
+            start = time.time()
+            while True:
+                try:
+                    self.connection = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    if time.time() - start > timeout:
+                        raise
+                    time.sleep(0.1)
+            self.connection.send(rank)
+
+    def sum(self, arrays):
+        if self.world_size == 1:
+            return arrays
+
+        if self.rank == 0:
+            total = [np.array(a, copy=True) for a in arrays]
+            for conn in self.connections:
+                for t, a in zip(total, conn.recv()):
+                    t += a
+            for conn in self.connections:
+                conn.send(total)
+            return total
+        else:
+            self.connection.send(arrays)
+            return self.connection.recv()
+
+    def mean(self, arrays):
+        return [a / self.world_size for a in self.sum(arrays)]
+
+    def broadcast(self, arrays):
+        """ Returns the arrays given by worker 0 (the arrays passed in by other workers are ignored). """
+        if self.world_size == 1:
+            return arrays
+
+        if self.rank == 0:
+            for conn in self.connections:
+                conn.send(arrays)
+            return arrays
+        else:
+            return self.connection.recv()
+
+    def gather(self, obj):
+        """ Returns a list of the objects passed in by all workers, in order of rank, on every worker. """
+        if self.world_size == 1:
+            return [obj]
+
+        if self.rank == 0:
+            objs = [obj] + [conn.recv() for conn in self.connections]
+            for conn in self.connections:
+                conn.send(objs)
+            return objs
+        else:
+            self.connection.send(obj)
+            return self.connection.recv()
+
+    def close(self):
+        if self.rank == 0:
+            for conn in self.connections:
+                conn.close()
+        else:
+            self.connection.close()
+
+
+def spawn(target, n_workers):
+    """ Run `target(rank)` for every rank in [0, n_workers), rank 0 in this process and the rest in
+        new processes. `target` must be picklable. Raises an exception if any of the workers fail. """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=(rank,)) for rank in range(1, n_workers)]
+
+    for p in processes:
+        p.start()
+
+    try:
+        target(0)
+    finally:
+        for p in processes:
+            p.join()
+
+    failed = [rank for rank, p in enumerate(processes, 1) if p.exitcode != 0]
+    if failed:
+        raise Exception("Data-parallel workers with ranks {} failed.".format(failed))
@@ -15,6 +15,8 @@ from dps import cfg
 from dps.utils import Param
 from dps.utils.tf import ScopedFunction
 
+from auto_yolo.models.data_parallel import is_chief
+
 
 # -------------------------------- utils.py -------------------------------------
 
@@ -625,8 +627,7 @@ class NEM_Network(ScopedFunction):
         self.obs_shape = env.obs_shape
         self.image_height, self.image_width, self.image_depth = self.obs_shape
         # ap_iou_values = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-        # self.eval_funcs = {"AP_at_point_{}".format(int(10 * v)): AP(v) for v in ap_iou_values}
-        # self.eval_funcs["AP"] = AP(ap_iou_values)
+        # self.eval_funcs = {"AP": AP(ap_iou_values, per_threshold=True)}
         self.eval_funcs = dict()
 
         self.input_network = None
@@ -780,6 +781,9 @@ class NeuralEM_RenderHook(object):
         self.N = N
 
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         fetched = self._fetch(self.N, updater)
         self._plot(updater, fetched)
 
@@ -2,7 +2,6 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 import numpy as np
 import collections
-import sonnet as snt
 import itertools
 
 from dps import cfg
@@ -37,6 +36,10 @@ class GridObjectLayer(ObjectLayer):
     n_passthrough_features = Param()
     training_wheels = Param()
     n_lookback = Param()
+    sequential_mode = Param(
+        "unroll", help="How the sequential program is built. One of: 'unroll' (a subgraph per grid cell), "
+                       "'wavefront' (a subgraph per group of mutually independent grid cells), "
+                       "'while_loop' (a single subgraph, run once per grid cell inside a tf.while_loop).")
 
     yx_prior_mean = Param()
     yx_prior_std = Param()
@@ -65,9 +68,19 @@ class GridObjectLayer(ObjectLayer):
     obj_logit_scale = Param()
     alpha_logit_scale = Param()
     alpha_logit_bias = Param()
+    skip_inactive_sprites = Param(
+        False, help="If True, objects with obj == 0 are not passed to the renderer. Their alpha is 0, "
+                    "but they still have importance 0.01, so this changes the output wherever they overlap an "
+                    "active object. Mostly useful at evaluation time, when obj is rounded to 0 or 1.")
 
     edge_weights = None
 
+    # Tensors, and distributions whose parameters, are kept as checkpoints for recomputing gradients
+    checkpoint_keys = ["box", "attr", "z", "obj", "obj_pre_sigmoid", "obj_log_odds"]
+    checkpoint_dist_keys = [
+        "cell_y_logit_dist", "cell_x_logit_dist", "height_logit_dist", "width_logit_dist",
+        "attr_dist", "z_logit_dist"]
+
     def __init__(self, pixels_per_cell, scope=None, **kwargs):
         super(GridObjectLayer, self).__init__(scope=scope, **kwargs)
 
@@ -162,7 +175,7 @@ class GridObjectLayer(ObjectLayer):
             **obj_kl_tensors,
         )
 
-    def _build_box(self, box_params, h, w, b, is_training):
+    def _build_box(self, box_params, h, w, anchor_box, is_training, noise):
         mean, log_std = tf.split(box_params, 2, axis=-1)
 
         std = self.std_nonlinearity(log_std)
@@ -173,17 +186,19 @@ class GridObjectLayer(ObjectLayer):
         cy_mean, cx_mean, height_mean, width_mean = tf.split(mean, 4, axis=-1)
         cy_std, cx_std, height_std, width_std = tf.split(std, 4, axis=-1)
 
+        cy_noise, cx_noise, height_noise, width_noise = tf.split(noise, 4, axis=-1)
+
         cy_logit_dist = Normal(loc=cy_mean, scale=cy_std)
-        cy_logits = cy_logit_dist.sample()
+        cy_logits = cy_mean + cy_std * cy_noise
 
         cx_logit_dist = Normal(loc=cx_mean, scale=cx_std)
-        cx_logits = cx_logit_dist.sample()
+        cx_logits = cx_mean + cx_std * cx_noise
 
         height_logit_dist = Normal(loc=height_mean, scale=height_std)
-        height_logits = height_logit_dist.sample()
+        height_logits = height_mean + height_std * height_noise
 
         width_logit_dist = Normal(loc=width_mean, scale=width_std)
-        width_logits = width_logit_dist.sample()
+        width_logits = width_mean + width_std * width_noise
 
         # --- cell y/x transform ---
 
@@ -221,8 +236,8 @@ class GridObjectLayer(ObjectLayer):
         # --- Compute image-normalized box parameters ---
 
         # box height and width normalized to image height and width
-        ys = height * self.anchor_boxes[b, 0] / self.image_height
-        xs = width * self.anchor_boxes[b, 1] / self.image_width
+        ys = height * anchor_box[0] / self.image_height
+        xs = width * anchor_box[1] / self.image_width
 
         # box centre normalized to image height and width
         yt = (self.pixels_per_cell[0] / self.image_height) * (cell_y + h)
@@ -255,14 +270,14 @@ class GridObjectLayer(ObjectLayer):
             normalized_box=normalized_box
         )
 
-    def _build_obj(self, obj_logits, is_training, **kwargs):
+    def _build_obj(self, obj_logits, is_training, noise, **kwargs):
         obj_logits = self.training_wheels * tf.stop_gradient(obj_logits) + (1-self.training_wheels) * obj_logits
         obj_logits = obj_logits / self.obj_temp
 
         obj_log_odds = tf.clip_by_value(obj_logits, -10., 10.)
 
         obj_pre_sigmoid = concrete_binary_pre_sigmoid_sample(
-            obj_log_odds, self.obj_concrete_temp
+            obj_log_odds, self.obj_concrete_temp, u=noise
         )
         raw_obj = tf.nn.sigmoid(obj_pre_sigmoid)
 
@@ -289,6 +304,7 @@ class GridObjectLayer(ObjectLayer):
         )
 
     def _get_sequential_context(self, program, h, w, b, edge_element):
+        """ Returns a list containing the program tensors that cell (h, w, b) is conditioned on. """
         context = []
         grid_size = 2 * self.n_lookback + 1
         n_grid_locs = int((grid_size**2) / 2)
@@ -313,13 +329,349 @@ class GridObjectLayer(ObjectLayer):
             else:
                 context.append(program[h, w, _k])
 
-        if context:
-            return tf.concat(context, axis=1)
+        return context
+
+    def _get_step_context(self, program, cells, edge_element):
+        """ Returns the context for a group of cells, with shape (batch_size, n_cells, context_size). """
+        contexts = [self._get_sequential_context(program, h, w, b, edge_element) for h, w, b in cells]
+
+        if not contexts[0]:
+            return tf.zeros((self.batch_size, len(cells), 0))
+
+        if len(cells) == 1:
+            return tf.concat(contexts[0], axis=1)[:, None, :]
+
+        return tf.concat([tf.stack(slot, axis=1) for slot in zip(*contexts)], axis=2)
+
+    def _build_schedule(self):
+        """ Returns a list of steps, each of which is a list of (h, w, b) grid cells that are built together.
+
+        Every cell in a step has the same anchor box index, and depends only on cells from earlier steps.
+
+        """
+        cells = list(itertools.product(range(self.H), range(self.W), range(self.B)))
+
+        if self.sequential_mode == "unroll":
+            return [[cell] for cell in cells]
+
+        elif self.sequential_mode == "wavefront":
+            # The context of a cell contains cells from the previous `n_lookback` rows (extending up to
+            # `n_lookback` columns to the right) and earlier cells from its own row, so cells that share a
+            # value of (n_lookback+1) * h + w are independent of one another. Earlier anchor boxes at
+            # the same location are also part of the context, so each anchor box gets its own step.
+            steps = collections.defaultdict(list)
+            for h, w, b in cells:
+                wavefront = 0 if self.n_lookback == 0 else (self.n_lookback + 1) * h + w
+                steps[wavefront, b].append((h, w, b))
+            return [steps[key] for key in sorted(steps)]
+
+        else:
+            raise Exception("Unknown value for sequential_mode: '{}'".format(self.sequential_mode))
+
+    def _flat_index(self, h, w, b):
+        return (h * self.W + w) * self.B + b
+
+    def _gather_cells(self, tensor, indices):
+        """ Select cells from a tensor with shape (batch_size, H*W*B, ...), using a slice when
+            `indices` are contiguous. """
+        if list(indices) == list(range(indices[0], indices[0] + len(indices))):
+            return tensor[:, indices[0]:indices[0] + len(indices)]
+        return tf.gather(tensor, indices, axis=1)
+
+    def _map_tensors(self, value, func):
+        """ Apply `func` to a tensor, or to the tensor-valued parameters of a distribution. """
+        if isinstance(value, tfp.distributions.Distribution):
+            dist_class = type(value)
+            params = value.parameters.copy()
+            tensor_keys = sorted(key for key, t in params.items() if isinstance(t, tf.Tensor))
+            params.update({key: func(key) for key in tensor_keys})
+            return dist_class(**params)
+        return func(None)
+
+    def _to_grid(self, value):
+        """ (batch_size, H*W*B, ...) -> (batch_size, H, W, B, ...) """
+        def func(key):
+            t = value if key is None else value.parameters[key]
+            return tf.reshape(t, (self.batch_size, self.H, self.W, self.B, *[int(d) for d in t.shape[2:]]))
+        return self._map_tensors(value, func)
+
+    def _merge_cells(self, values, order):
+        """ Merge a list of per-step values, each with shape (batch_size, n_cells, ...), into a single
+            value with shape (batch_size, H, W, B, ...). `order` gives the flat index of each cell,
+            in the order that the cells appear in the concatenation of `values`. """
+        def func(key):
+            _values = values if key is None else [v.parameters[key] for v in values]
+            t = tf.concat(_values, axis=1) if len(_values) > 1 else _values[0]
+            if list(order) != list(range(self.HWB)):
+                t = tf.gather(t, np.argsort(order), axis=1)
+            return t
+        return self._to_grid(self._map_tensors(values[0], func))
+
+    def _extract_glimpses(self, inp, normalized_box):
+        """ Extract a glimpse for each box with a single resampler call.
+
+        Parameters
+        ----------
+        inp: (batch_size, image_height, image_width, image_depth)
+        normalized_box: (batch_size, n_boxes, 4)
+            Boxes as (yt, xt, ys, xs), in a coordinate frame where (0, 0) is image top-left
+            and (1, 1) is image bottom-right.
+
+        Returns
+        -------
+        glimpses: (batch_size, n_boxes, *object_shape, image_depth)
+
+        """
+        yt, xt, ys, xs = tf.split(normalized_box, 4, axis=-1)
+
+        # yt/xt give top/left but here we need center
+        yc = yt + ys / 2
+        xc = xt + xs / 2
+
+        # Same sampling grid as snt.AffineGridWarper with no_shear_2d constraints and
+        # parameters (xs, 2*xc-1, ys, 2*yc-1), computed directly in pixel coordinates.
+        out_h, out_w = self.object_shape
+        v = np.linspace(-1, 1, out_h, dtype=np.float32)
+        u = np.linspace(-1, 1, out_w, dtype=np.float32)
+
+        y = (ys * v + 2 * yc) * ((self.image_height - 1) / 2)
+        x = (xs * u + 2 * xc) * ((self.image_width - 1) / 2)
+
+        y = tf.tile(y[:, :, :, None], (1, 1, 1, out_w))
+        x = tf.tile(x[:, :, None, :], (1, 1, out_h, 1))
+
+        grid_coords = tf.stack([x, y], axis=-1)
+
+        return resampler_edge.resampler_edge(inp, grid_coords)
+
+    def _cell_locations(self, cells):
+        """ Returns the `h`, `w` and `anchor_box` arguments to `_build_program_step` for a list of cells. """
+        b = cells[0][2]
+        assert all(_b == b for _, _, _b in cells)
+
+        h = np.array([_h for _h, _, _ in cells], dtype=np.float32).reshape(1, len(cells), 1)
+        w = np.array([_w for _, _w, _ in cells], dtype=np.float32).reshape(1, len(cells), 1)
+        return h, w, self.anchor_boxes[b]
+
+    def _apply_lateral(self, network, inp, output_size):
+        """ Apply a network to an input with shape (batch_size, n_cells, n_features),
+            treating the cells as additional batch elements. """
+        n_cells = int(inp.shape[1])
+        output = network(tf.reshape(inp, (-1, int(inp.shape[-1]))), output_size, self.is_training)
+        return tf.reshape(output, (self.batch_size, n_cells, output_size))
+
+    def _sample_noise(self):
+        """ Draw the noise for every cell up front so that the sampled values
+            do not depend on the order in which the cells are built. """
+        return dict(
+            box=tf.random_normal((self.batch_size, self.HWB, 4)),
+            attr=tf.random_normal((self.batch_size, self.HWB, self.A)),
+            z=tf.random_normal((self.batch_size, self.HWB, 1)),
+            obj=tf.random_uniform((self.batch_size, self.HWB, 1), minval=0, maxval=1),
+        )
+
+    def _build_program_step(self, h, w, anchor_box, inp, inp_features, context, noise, is_posterior):
+        """ Build the program for a group of grid cells that are independent of one another.
+
+        `inp_features`, `context` and the values in `noise` have shape (batch_size, n_cells, ...),
+        as do all returned tensors. `h` and `w` give the grid location of each cell, with shape
+        (1, n_cells, 1), and all cells must use the same anchor box.
+
+        """
+        n_cells = int(inp_features.shape[1])
+
+        is_posterior_tf = tf.ones((self.batch_size, n_cells, 2))
+        if is_posterior:
+            is_posterior_tf = is_posterior_tf * [1, 0]
         else:
-            return tf.zeros_like(edge_element[:, 0:0])
+            is_posterior_tf = is_posterior_tf * [0, 1]
+
+        base_features = tf.concat([inp_features, context, is_posterior_tf], axis=2)
+
+        tensors = {}
+
+        # --- box ---
+
+        layer_inp = base_features
+        n_features = self.n_passthrough_features
+        output_size = 8
+
+        network_output = self._apply_lateral(self.box_network, layer_inp, output_size + n_features)
+        rep_input, features = tf.split(network_output, (output_size, n_features), axis=2)
+
+        built = self._build_box(rep_input, h, w, anchor_box, self.is_training, noise["box"])
+
+        tensors.update(built)
+        partial_program = built['box']
+
+        # --- attr ---
+
+        if is_posterior:
+            # --- Get object attributes using object encoder ---
 
-    def _make_empty(self):
-        return np.array([{} for i in range(self.H * self.W * self.B)]).reshape(self.H, self.W, self.B)
+            input_glimpses = self._extract_glimpses(inp, built['normalized_box'])
+            tensors["input_glimpses"] = input_glimpses
+
+            encoded_glimpse = self.object_encoder(
+                tf.reshape(input_glimpses, (-1, *self.object_shape, self.image_depth)),
+                (1, 1, self.A), self.is_training)
+            encoded_glimpse = tf.reshape(encoded_glimpse, (self.batch_size, n_cells, self.A))
+
+        else:
+            encoded_glimpse = tf.zeros((self.batch_size, n_cells, self.A))
+
+        layer_inp = tf.concat(
+            [base_features, features, encoded_glimpse, partial_program], axis=2)
+        network_output = self._apply_lateral(self.attr_network, layer_inp, 2 * self.A + n_features)
+        attr_mean, attr_log_std, features = tf.split(network_output, (self.A, self.A, n_features), axis=2)
+
+        attr_std = self.std_nonlinearity(attr_log_std)
+
+        attr_dist = Normal(loc=attr_mean, scale=attr_std)
+        attr = attr_mean + attr_std * noise["attr"]
+
+        if "attr" in self.no_gradient:
+            attr = tf.stop_gradient(attr)
+
+        tensors.update(attr_dist=attr_dist, attr=attr)
+        partial_program = tf.concat([partial_program, attr], axis=2)
+
+        # --- z ---
+
+        layer_inp = tf.concat([base_features, features, partial_program], axis=2)
+        n_features = self.n_passthrough_features
+
+        network_output = self._apply_lateral(self.z_network, layer_inp, 2 + n_features)
+        z_mean, z_log_std, features = tf.split(network_output, (1, 1, n_features), axis=2)
+        z_std = self.std_nonlinearity(z_log_std)
+
+        z_mean = self.training_wheels * tf.stop_gradient(z_mean) + (1-self.training_wheels) * z_mean
+        z_std = self.training_wheels * tf.stop_gradient(z_std) + (1-self.training_wheels) * z_std
+        z_logit_dist = Normal(loc=z_mean, scale=z_std)
+        z_logits = z_mean + z_std * noise["z"]
+        z = self.z_nonlinearity(z_logits)
+
+        if "z" in self.no_gradient:
+            z = tf.stop_gradient(z)
+
+        if "z" in self.fixed_values:
+            z = self.fixed_values['z'] * tf.ones_like(z)
+
+        tensors.update(z_logit_dist=z_logit_dist, z=z)
+        partial_program = tf.concat([partial_program, z], axis=2)
+
+        # --- obj ---
+
+        layer_inp = tf.concat([base_features, features, partial_program], axis=2)
+        rep_input = self._apply_lateral(self.obj_network, layer_inp, 1)
+
+        built = self._build_obj(rep_input, self.is_training, noise["obj"])
+
+        tensors.update(built)
+        partial_program = tf.concat([partial_program, built['obj']], axis=2)
+
+        return partial_program, tensors
+
+    def _build_program_while_loop(self, inp, cell_features, noise, edge_element, is_posterior):
+        """ Build the program one cell at a time inside a tf.while_loop, so that the size of the graph
+            does not depend on the size of the grid. Built programs are stored in a TensorArray whose
+            final element is the edge element, and each cell reads its context from that array using
+            a pre-computed table of indices. """
+
+        # --- table of context indices for each cell ---
+
+        flat_indices = np.arange(self.HWB).reshape(self.H, self.W, self.B)
+        context_table = np.array(
+            [self._get_sequential_context(flat_indices, h, w, b, self.HWB)
+             for h, w, b in itertools.product(range(self.H), range(self.W), range(self.B))],
+            dtype=np.int32).reshape(self.HWB, -1)
+        n_context = context_table.shape[1]
+        context_table = tf.constant(context_table)
+
+        anchor_boxes = tf.constant(self.anchor_boxes, dtype=tf.float32)
+        program_size = int(edge_element.shape[1])
+
+        def build_cell(i, program_ta):
+            h = i // (self.W * self.B)
+            w = (i // self.B) % self.W
+            b = i % self.B
+
+            if n_context:
+                context = program_ta.gather(context_table[i])
+                context = tf.reshape(
+                    tf.transpose(context, (1, 0, 2)), (self.batch_size, 1, n_context * program_size))
+            else:
+                context = tf.zeros((self.batch_size, 1, 0))
+
+            return self._build_program_step(
+                tf.reshape(tf.to_float(h), (1, 1, 1)),
+                tf.reshape(tf.to_float(w), (1, 1, 1)),
+                tf.gather(anchor_boxes, b),
+                inp,
+                tf.gather(cell_features, i[None], axis=1),
+                context,
+                {k: tf.gather(v, i[None], axis=1) for k, v in noise.items()},
+                is_posterior)
+
+        def flatten(built):
+            """ Returns a list of (key, param_name, tensor) triples, one for each tensor in `built`. """
+            flat = []
+            for key in sorted(built):
+                value = built[key]
+                if isinstance(value, tfp.distributions.Distribution):
+                    for name in sorted(n for n, t in value.parameters.items() if isinstance(t, tf.Tensor)):
+                        flat.append((key, name, value.parameters[name]))
+                else:
+                    flat.append((key, None, value))
+            return flat
+
+        program_ta = tf.TensorArray(
+            tf.float32, size=self.HWB+1, clear_after_read=False,
+            element_shape=tf.TensorShape([None, program_size]))
+        program_ta = program_ta.write(self.HWB, edge_element)
+
+        # The first cell is built outside the loop, so that variables are not created inside it.
+
+        i = tf.constant(0)
+        partial_program, built = build_cell(i, program_ta)
+        program_ta = program_ta.write(0, partial_program[:, 0])
+
+        first_flat = flatten(built)
+        output_tas = [
+            tf.TensorArray(t.dtype, size=self.HWB, element_shape=t.shape[:1].concatenate(t.shape[2:]))
+            .write(0, t[:, 0])
+            for _, _, t in first_flat]
+
+        def cond(i, program_ta, output_tas):
+            return i < self.HWB
+
+        def body(i, program_ta, output_tas):
+            partial_program, built = build_cell(i, program_ta)
+            program_ta = program_ta.write(i, partial_program[:, 0])
+            output_tas = [ta.write(i, t[:, 0]) for ta, (_, _, t) in zip(output_tas, flatten(built))]
+            return i + 1, program_ta, output_tas
+
+        _, _, output_tas = tf.while_loop(cond, body, (i + 1, program_ta, output_tas))
+
+        # --- convert from (H*W*B, batch_size, ...) to (batch_size, H, W, B, ...) ---
+
+        tensors = {}
+        for ta, (key, name, t) in zip(output_tas, first_flat):
+            value = tf.transpose(ta.stack(), [1, 0] + list(range(2, len(t.shape))))
+            value = self._to_grid(value)
+            if name is None:
+                tensors[key] = value
+            else:
+                tensors.setdefault(key, {})[name] = value
+
+        for key, value in list(tensors.items()):
+            if isinstance(value, dict):
+                dist = built[key]
+                params = dist.parameters.copy()
+                params.update(value)
+                tensors[key] = type(dist)(**params)
+
+        return tensors
 
     def _call(self, inp, inp_features, background, is_training, is_posterior=True):
 
@@ -346,9 +698,11 @@ class GridObjectLayer(ObjectLayer):
             self.H = H
             self.W = W
             self.HWB = H*W*self.B
-            self.batch_size = tf.shape(inp)[0]
-            self.is_training = is_training
-            self.float_is_training = tf.to_float(is_training)
+
+        # These can differ between calls, e.g. when an EvalHook calls the network on its own dataset
+        self.batch_size = tf.shape(inp)[0]
+        self.is_training = is_training
+        self.float_is_training = tf.to_float(is_training)
 
         # --- set up the edge element ---
 
@@ -368,163 +722,69 @@ class GridObjectLayer(ObjectLayer):
         edge_element = tf.concat(_edge_weights, axis=0)
         edge_element = tf.tile(edge_element[None, :], (self.batch_size, 1))
 
-        # --- containers for storing built program ---
-
-        _tensors = collections.defaultdict(self._make_empty)
-        program = np.empty((H, W, self.B), dtype=np.object)
-
         # --- build the program ---
 
-        is_posterior_tf = tf.ones((self.batch_size, 2))
-        if is_posterior:
-            is_posterior_tf = is_posterior_tf * [1, 0]
-        else:
-            is_posterior_tf = is_posterior_tf * [0, 1]
-
-        for h, w, b in itertools.product(range(H), range(W), range(self.B)):
-            partial_program, features = None, None
-            context = self._get_sequential_context(program, h, w, b, edge_element)
-            base_features = tf.concat([inp_features[:, h, w, b, :], context, is_posterior_tf], axis=1)
-
-            # --- box ---
-
-            layer_inp = base_features
-            n_features = self.n_passthrough_features
-            output_size = 8
-
-            network_output = self.box_network(layer_inp, output_size + n_features, self. is_training)
-            rep_input, features = tf.split(network_output, (output_size, n_features), axis=1)
-
-            built = self._build_box(rep_input, h, w, b, self.is_training)
-
-            for key, value in built.items():
-                _tensors[key][h, w, b] = value
-            partial_program = built['box']
-
-            # --- attr ---
-
-            if is_posterior:
-                # --- Get object attributes using object encoder ---
-
-                yt, xt, ys, xs = tf.split(built['normalized_box'], 4, axis=-1)
-
-                # yt/xt give top/left but here we need center
-                yt += ys / 2
-                xt += xs / 2
-
-                transform_constraints = snt.AffineWarpConstraints.no_shear_2d()
-                warper = snt.AffineGridWarper(
-                    (self.image_height, self.image_width), self.object_shape, transform_constraints)
-
-                _boxes = tf.concat([xs, 2*xt - 1, ys, 2*yt - 1], axis=-1)
+        noise = self._sample_noise()
+        cell_features = tf.reshape(
+            inp_features, (self.batch_size, self.HWB, int(inp_features.shape[-1])))
 
-                grid_coords = warper(_boxes)
-                grid_coords = tf.reshape(grid_coords, (self.batch_size, 1, *self.object_shape, 2,))
-                input_glimpses = resampler_edge.resampler_edge(inp, grid_coords)
-                input_glimpses = tf.reshape(input_glimpses, (-1, *self.object_shape, self.image_depth))
+        if self.n_lookback == 0 and self.B == 1:
+            # No cell depends on any other, so the whole grid is built in a single step,
+            # with the networks applied to all cells at once.
 
-                encoded_glimpse = self.object_encoder(input_glimpses, (1, 1, self.A), self.is_training)
-                encoded_glimpse = tf.reshape(encoded_glimpse, (-1, self.A))
+            cells = list(itertools.product(range(H), range(W), range(self.B)))
+            context = tf.zeros((self.batch_size, self.HWB, 0))
+            _, built = self._build_program_step(
+                *self._cell_locations(cells), inp, cell_features, context, noise, is_posterior)
 
-            else:
-                encoded_glimpse = tf.zeros((self.batch_size, self.A))
-
-            layer_inp = tf.concat(
-                [base_features, features, encoded_glimpse, partial_program], axis=1)
-            network_output = self.attr_network(layer_inp, 2 * self.A + n_features, self. is_training)
-            attr_mean, attr_log_std, features = tf.split(network_output, (self.A, self.A, n_features), axis=1)
-
-            attr_std = self.std_nonlinearity(attr_log_std)
-
-            attr_dist = Normal(loc=attr_mean, scale=attr_std)
-            attr = attr_dist.sample()
-
-            if "attr" in self.no_gradient:
-                attr = tf.stop_gradient(attr)
-
-            built = dict(attr_dist=attr_dist, attr=attr, input_glimpses=input_glimpses)
-
-            for key, value in built.items():
-                _tensors[key][h, w, b] = value
-            partial_program = tf.concat([partial_program, built['attr']], axis=1)
-
-            # --- z ---
-
-            layer_inp = tf.concat([base_features, features, partial_program], axis=1)
-            n_features = self.n_passthrough_features
+            tensors = dict(background=background)
+            for k, v in built.items():
+                tensors[k] = self._to_grid(v)
 
-            network_output = self.z_network(layer_inp, 2 + n_features, self.is_training)
-            z_mean, z_log_std, features = tf.split(network_output, (1, 1, n_features), axis=1)
-            z_std = self.std_nonlinearity(z_log_std)
+        elif self.sequential_mode == "while_loop":
+            tensors = self._build_program_while_loop(inp, cell_features, noise, edge_element, is_posterior)
+            tensors["background"] = background
 
-            z_mean = self.training_wheels * tf.stop_gradient(z_mean) + (1-self.training_wheels) * z_mean
-            z_std = self.training_wheels * tf.stop_gradient(z_std) + (1-self.training_wheels) * z_std
-            z_logit_dist = Normal(loc=z_mean, scale=z_std)
-            z_logits = z_logit_dist.sample()
-            z = self.z_nonlinearity(z_logits)
-
-            if "z" in self.no_gradient:
-                z = tf.stop_gradient(z)
-
-            if "z" in self.fixed_values:
-                z = self.fixed_values['z'] * tf.ones_like(z)
-
-            built = dict(z_logit_dist=z_logit_dist, z=z)
-
-            for key, value in built.items():
-                _tensors[key][h, w, b] = value
-            partial_program = tf.concat([partial_program, built['z']], axis=1)
-
-            # --- obj ---
+        else:
+            _tensors = collections.defaultdict(list)
+            program = np.empty((H, W, self.B), dtype=np.object)
+            schedule = self._build_schedule()
 
-            layer_inp = tf.concat([base_features, features, partial_program], axis=1)
-            rep_input = self.obj_network(layer_inp, 1, self.is_training)
+            for cells in schedule:
+                indices = [self._flat_index(*cell) for cell in cells]
 
-            built = self._build_obj(rep_input, self.is_training)
+                partial_program, built = self._build_program_step(
+                    *self._cell_locations(cells), inp,
+                    self._gather_cells(cell_features, indices),
+                    self._get_step_context(program, cells, edge_element),
+                    {k: self._gather_cells(v, indices) for k, v in noise.items()},
+                    is_posterior)
 
-            for key, value in built.items():
-                _tensors[key][h, w, b] = value
-            partial_program = tf.concat([partial_program, built['obj']], axis=1)
+                for key, value in built.items():
+                    _tensors[key].append(value)
 
-            # --- final ---
+                for (h, w, b), cell_program in zip(cells, tf.unstack(partial_program, axis=1)):
+                    program[h, w, b] = cell_program
+                    assert program[h, w, b].shape[1] == total_sample_size
 
-            program[h, w, b] = partial_program
-            assert program[h, w, b].shape[1] == total_sample_size
+            # --- merge tensors from different grid cells ---
 
-        # --- merge tensors from different grid cells ---
+            order = [self._flat_index(*cell) for cells in schedule for cell in cells]
 
-        tensors = dict(background=background)
-        for k, v in _tensors.items():
-            if k.endswith('_dist'):
-                dist = v[0, 0, 0]
-                dist_class = type(dist)
-                params = dist.parameters.copy()
-                tensor_keys = sorted(key for key, t in params.items() if isinstance(t, tf.Tensor))
-                tensor_params = {}
-
-                for key in tensor_keys:
-                    t1 = []
-                    for h in range(H):
-                        t2 = []
-                        for w in range(W):
-                            t2.append(tf.stack([v[h, w, b].parameters[key] for b in range(self.B)], axis=1))
-                        t1.append(tf.stack(t2, axis=1))
-                    tensor_params[key] = tf.stack(t1, axis=1)
-
-                params.update(tensor_params)
-                tensors[k] = dist_class(**params)
-            else:
-                t1 = []
-                for h in range(H):
-                    t2 = []
-                    for w in range(W):
-                        t2.append(tf.stack([v[h, w, b] for b in range(self.B)], axis=1))
-                    t1.append(tf.stack(t2, axis=1))
-                tensors[k] = tf.stack(t1, axis=1)
+            tensors = dict(background=background)
+            for k, v in _tensors.items():
+                tensors[k] = self._merge_cells(v, order)
 
         tensors["all"] = tf.concat(
             [tensors["box"], tensors["attr"], tensors["z"], tensors["obj"]], axis=-1)
 
+        # Checkpoints for recomputing gradients (see `auto_yolo.models.recompute`): the sampled
+        # program, and the values that `compute_kl` needs. Other activations of the layer are recomputed.
+        self.program_tensors = [tensors[k] for k in self.checkpoint_keys]
+        for key in self.checkpoint_dist_keys:
+            self.program_tensors.extend(
+                t for _, t in sorted(tensors[key].parameters.items()) if isinstance(t, tf.Tensor))
+
         # --- compute sprite appearances from attr using object decoder ---
 
         object_decoder_in = tf.reshape(tensors["attr"], (self.batch_size * self.HWB, 1, 1, self.A))
@@ -567,11 +827,19 @@ class GridObjectLayer(ObjectLayer):
         count_distribution = tf.tile(count_distribution[None, :], (self.batch_size, 1))
         count_so_far = tf.zeros((self.batch_size, 1), dtype=tf.float32)
 
-        i = 0
+        # --- compute the prior probability of each cell being on, by scanning over cells in raster order ---
+
+        def cell_major(t):
+            # (batch_size, H, W, B, 1) -> (H*W*B, batch_size, 1)
+            return tf.transpose(tf.reshape(t, (self.batch_size, self.HWB, 1)), (1, 0, 2))
 
-        obj_kl = []
+        samples = tf.to_float(cell_major(tensors["obj"]) > 0.5)
+        cell_indices = tf.range(self.HWB, dtype=tf.float32)
+
+        def step(state, elems):
+            count_distribution, count_so_far, _ = state
+            sample, i = elems
 
-        for h, w, b in itertools.product(range(self.H), range(self.W), range(self.B)):
             p_z_given_Cz = tf.maximum(count_support[None, :] - count_so_far, 0) / (self.HWB - i)
 
             # Reshape for batch matmul
@@ -580,25 +848,6 @@ class GridObjectLayer(ObjectLayer):
 
             p_z = tf.matmul(_count_distribution, _p_z_given_Cz)[:, :, 0]
 
-            if self.use_concrete_kl:
-                prior_log_odds = tf_safe_log(p_z) - tf_safe_log(1-p_z)
-                _obj_kl = concrete_binary_sample_kl(
-                    tensors["obj_pre_sigmoid"][:, h, w, b, :],
-                    prior_log_odds, self.obj_concrete_temp,
-                    tensors["obj_log_odds"][:, h, w, b, :],
-                    self.obj_concrete_temp
-                )
-            else:
-                prob = tensors["obj_prob"][:, h, w, b, :]
-
-                _obj_kl = (
-                    prob * (tf_safe_log(prob) - tf_safe_log(p_z))
-                    + (1-prob) * (tf_safe_log(1-prob) - tf_safe_log(1-p_z))
-                )
-
-            obj_kl.append(_obj_kl)
-
-            sample = tf.to_float(tensors["obj"][:, h, w, b, :] > 0.5)
             mult = sample * p_z_given_Cz + (1-sample) * (1-p_z_given_Cz)
             count_distribution = mult * count_distribution
             normalizer = tf.reduce_sum(count_distribution, axis=1, keepdims=True)
@@ -607,14 +856,37 @@ class GridObjectLayer(ObjectLayer):
 
             count_so_far += sample
 
-            i += 1
+            return count_distribution, count_so_far, p_z
+
+        _, _, p_z = tf.scan(
+            step, (samples, cell_indices),
+            initializer=(count_distribution, count_so_far, tf.zeros((self.batch_size, 1))))
+
+        # (H*W*B, batch_size, 1) -> (batch_size, H, W, B, 1)
+        p_z = tf.reshape(tf.transpose(p_z, (1, 0, 2)), (self.batch_size, self.H, self.W, self.B, 1))
+
+        # --- compute obj_kl for all cells at once ---
+
+        if self.use_concrete_kl:
+            prior_log_odds = tf_safe_log(p_z) - tf_safe_log(1-p_z)
+            obj_kl = concrete_binary_sample_kl(
+                tensors["obj_pre_sigmoid"],
+                prior_log_odds, self.obj_concrete_temp,
+                tensors["obj_log_odds"],
+                self.obj_concrete_temp
+            )
+        else:
+            prob = tensors["obj_prob"]
+
+            obj_kl = (
+                prob * (tf_safe_log(prob) - tf_safe_log(p_z))
+                + (1-prob) * (tf_safe_log(1-prob) - tf_safe_log(1-p_z))
+            )
 
         if "obj" in self.no_gradient:
             obj_kl = tf.stop_gradient(obj_kl)
 
-        obj_kl_tensors["obj_kl"] = tf.reshape(
-            tf.concat(obj_kl, axis=1),
-            (self.batch_size, self.H, self.W, self.B, 1))
+        obj_kl_tensors["obj_kl"] = obj_kl
 
         return obj_kl_tensors
 
@@ -652,12 +924,17 @@ class GridObjectLayer(ObjectLayer):
         offsets = tf.concat([yt, xt], axis=-1)
         offsets = tf.reshape(offsets, (self.batch_size, self.HWB, 2))
 
+        active = None
+        if self.skip_inactive_sprites:
+            active = tf.reshape(tensors['obj'], (self.batch_size, self.HWB)) > 0
+
         output = render_sprites.render_sprites(
             objects,
             tensors["n_objects"],
             scales,
             offsets,
-            background
+            background,
+            active=active,
         )
 
         # --- Store values ---
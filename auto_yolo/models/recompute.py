@@ -0,0 +1,131 @@
+import tensorflow as tf
+from tensorflow.contrib import graph_editor as ge
+
+
+# Ops that are never recomputed: copying them would either change their results (stateful ops,
+# e.g. random sampling) or break them (control flow, TensorArrays). Their outputs are kept from
+# the forward pass instead.
+_CONTROL_FLOW_OPS = {"Enter", "RefEnter", "Exit", "RefExit", "Merge", "RefMerge", "Switch", "RefSwitch",
+                     "NextIteration", "RefNextIteration", "LoopCond"}
+
+
+def _can_recompute(op):
+    return not (
+        op.op_def.is_stateful
+        or op.type in _CONTROL_FLOW_OPS
+        or op.type.startswith("TensorArray")
+        or op._get_control_flow_context() is not None)
+
+
+def _is_variable_read(t):
+    op = t.op
+    return op.type in ("VariableV2", "VarHandleOp") or (
+        op.type == "Identity" and op.inputs[0].op.type in ("VariableV2", "VarHandleOp"))
+
+
+def _segment_ops(boundary, ys):
+    """ Ops that depend on a tensor in `boundary` and that a tensor in `ys` depends on. """
+    downstream = set()
+    stack = [op for t in boundary for op in t.consumers()]
+    while stack:
+        op = stack.pop()
+        if op not in downstream:
+            downstream.add(op)
+            stack.extend(c for t in op.outputs for c in t.consumers())
+
+    boundary = set(boundary)
+    segment = set()
+    stack = [y.op for y in ys if y.op in downstream]
+    while stack:
+        op = stack.pop()
+        if op not in segment:
+            segment.add(op)
+            stack.extend(t.op for t in op.inputs if t not in boundary and t.op in downstream)
+
+    return segment, downstream
+
+
+def recompute_gradients(ys, xs, checkpoints):
+    """ Gradients of sum(ys) wrt xs, recomputing activations during the backward pass to save memory.
+
+    `checkpoints` is a list of lists of tensors, in the order they are computed in the forward pass.
+    It divides the graph into segments: segment k contains the ops that depend on `checkpoints[k]`
+    and that the tensors downstream of it depend on. Working backwards from `ys`, each segment is
+    copied and backpropagated through, starting from the gradients wrt its outputs; the copy only runs
+    once those gradients are available. So, except for the checkpoints (and the outputs of ops that
+    can't be recomputed, see `_can_recompute`), activations within a segment are not kept alive from
+    the forward pass until the backward pass. Everything upstream of the first checkpoints is
+    backpropagated through as usual.
+
+    Returns a list with the same length as `xs`, containing None for xs that ys do not depend on.
+
+    """
+    if not isinstance(ys, (list, tuple)):
+        ys = [ys]
+    xs = list(xs)
+
+    # Tensors still to be backpropagated through, mapped to the gradient of sum(ys) wrt them
+    pending = {y: None for y in ys}
+    grads = [None] * len(xs)
+
+    def add(total, grad):
+        if grad is None:
+            return total
+        if isinstance(grad, tf.IndexedSlices):
+            grad = tf.convert_to_tensor(grad)
+        return grad if total is None else total + grad
+
+    for boundary in reversed(checkpoints):
+        segment, downstream = _segment_ops(boundary, list(pending))
+        segment = [op for op in segment if _can_recompute(op)]
+
+        seg_ys = [y for y in pending if y.op in downstream]
+        if not seg_ys:
+            continue
+        seg_grad_ys = [pending.pop(y) for y in seg_ys]
+
+        # Inputs to the segment from outside it. Gradients stop at these, and are passed on to later
+        # iterations. Variables are handled by `xs`.
+        segment_set = set(segment)
+        external = set(boundary)
+        for op in segment:
+            external.update(
+                t for t in op.inputs
+                if t.op not in segment_set and t.dtype.is_floating and not _is_variable_read(t))
+        external = sorted(external, key=lambda t: t.name)
+
+        if segment:
+            _, info = ge.copy_with_input_replacements(ge.sgv(segment), {})
+
+            # Only start recomputing once the gradients wrt the outputs of the segment are available
+            # (or, for the last segment, once the forward pass is done).
+            triggers = [(g if g is not None else y).op for y, g in zip(seg_ys, seg_grad_ys)]
+            for op in segment:
+                copy = info.transformed(op)
+                if all(t.op not in segment_set for t in op.inputs):
+                    ge.add_control_inputs(copy, triggers)
+
+            seg_ys_copied = [info.transformed(y) if y.op in segment_set else y for y in seg_ys]
+        else:
+            seg_ys_copied = seg_ys
+
+        seg_grads = tf.gradients(
+            seg_ys_copied, external + xs,
+            grad_ys=[g if g is not None else tf.ones_like(y) for y, g in zip(seg_ys, seg_grad_ys)],
+            stop_gradients=external)
+
+        for t, g in zip(external, seg_grads[:len(external)]):
+            if g is not None:
+                pending[t] = add(pending.get(t), g)
+
+        grads = [add(total, g) for total, g in zip(grads, seg_grads[len(external):])]
+
+    # --- everything upstream of the first checkpoints ---
+
+    if pending:
+        rest_ys = list(pending)
+        rest_grads = tf.gradients(
+            rest_ys, xs, grad_ys=[pending[y] if pending[y] is not None else tf.ones_like(y) for y in rest_ys])
+        grads = [add(total, g) for total, g in zip(grads, rest_grads)]
+
+    return grads
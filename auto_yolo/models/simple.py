@@ -6,6 +6,7 @@ from dps import cfg
 from dps.utils.tf import tf_mean_sum, RenderHook
 
 from auto_yolo.models.core import xent_loss, normal_vae, VariationalAutoencoder
+from auto_yolo.models.data_parallel import is_chief
 
 
 class SimpleVAE(VariationalAutoencoder):
@@ -62,6 +63,9 @@ class SimpleVAE(VariationalAutoencoder):
 
 class SimpleVAE_RenderHook(RenderHook):
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         self.fetches = "inp output"
 
         if 'prediction' in updater.network._tensors:
@@ -7,13 +7,17 @@ from matplotlib.colors import to_rgb
 from dps.utils import Param
 from dps.utils.tf import tf_mean_sum, RenderHook, GridConvNet
 
-from auto_yolo.models.core import AP, xent_loss, VariationalAutoencoder
+from auto_yolo.models.core import AP, InGraphAP, xent_loss, VariationalAutoencoder
+from auto_yolo.models.data_parallel import is_chief
 from auto_yolo.models.object_layer import GridObjectLayer
 
 
 class YoloAir_Network(VariationalAutoencoder):
     n_backbone_features = Param()
     anchor_boxes = Param()
+    in_graph_ap = Param(
+        False, help="If True, predicted boxes are matched to ground truth boxes inside the graph during "
+                    "evaluation, and only the resulting statistics are fetched.")
 
     backbone = None
     object_layer = None
@@ -29,9 +33,8 @@ class YoloAir_Network(VariationalAutoencoder):
         if "annotations" in self._tensors:
             if self._eval_funcs is None:
                 ap_iou_values = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-                eval_funcs = {"AP_at_point_{}".format(int(10 * v)): AP(v) for v in ap_iou_values}
-                eval_funcs["AP"] = AP(ap_iou_values)
-                self._eval_funcs = eval_funcs
+                ap_class = InGraphAP if self.in_graph_ap else AP
+                self._eval_funcs = {"AP": ap_class(ap_iou_values, per_threshold=True)}
             return self._eval_funcs
         else:
             return {}
@@ -61,12 +64,18 @@ class YoloAir_Network(VariationalAutoencoder):
             self.inp, backbone_output, self._tensors["background"], self.is_training)
         self._tensors.update(objects)
 
+        # Used by the updater when recomputing gradients
+        self.checkpoints = [[backbone_output], self.object_layer.program_tensors]
+
         kl_tensors = self.object_layer.compute_kl(objects)
         self._tensors.update(kl_tensors)
 
         render_tensors = self.object_layer.render(objects, self._tensors["background"])
         self._tensors.update(render_tensors)
 
+        if "annotations" in self._tensors:
+            self.build_predicted_boxes()
+
         # --- specify values to record ---
 
         obj = self._tensors["obj"]
@@ -138,6 +147,9 @@ class YoloAir_RenderHook(RenderHook):
     fetches = "obj raw_obj z inp output objects n_objects normalized_box input_glimpses"
 
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         network = updater.network
         if "n_annotations" in network._tensors:
             self.fetches += " annotations n_annotations"
@@ -316,6 +328,9 @@ class YoloAir_ComparisonRenderHook(RenderHook):
     show_zero_boxes = True
 
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         fetched = self._fetch(updater)
         self._plot_reconstruction(updater, fetched)
 
@@ -363,6 +378,9 @@ class YoloAir_PaperSetRenderHook(RenderHook):
     do_annotations = True
 
     def __call__(self, updater):
+        if not is_chief(updater):
+            return
+
         self.fetches += " annotations n_annotations"
         fetched = self._fetch(updater)
 
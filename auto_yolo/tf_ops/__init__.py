@@ -1 +1,55 @@
-# tf_ops
\ No newline at end of file
+import os
+
+import tensorflow as tf
+
+
+def load_op_library(name, directory):
+    """ Load the compiled library for custom op `name` from `directory`.
+
+    Prefers the full build (`_<name>.so`, built by `make`, includes GPU kernels) and falls
+    back to the CPU-only build (`_<name>_cpu.so`, built by `make cpu` or `python setup.py build_ext`).
+    A library that exists but can't be loaded (e.g. a GPU build on a host without CUDA, or a build
+    against a different version of TensorFlow) is skipped.
+
+    """
+    candidates = [
+        os.path.join(directory, "_{}.so".format(name)),
+        os.path.join(directory, "_{}_cpu.so".format(name)),
+    ]
+
+    errors = []
+    for loc in candidates:
+        if os.path.exists(loc):
+            print("\nLoading {} library at {}.".format(name, loc))
+            try:
+                so = tf.load_op_library(loc)
+            except tf.errors.NotFoundError as e:
+                print("Failed: {}\n".format(e))
+                errors.append("{}: {}".format(loc, e))
+                continue
+            print("Success.\n")
+            return so
+
+    if errors:
+        raise IOError(
+            "No compiled library for op `{}` could be loaded: {}. "
+            "Rebuild with `make` (GPU) or `make cpu` (CPU-only) in {}.".format(name, "; ".join(errors), directory))
+
+    raise IOError(
+        "No compiled library found for op `{}`, looked for: {}. "
+        "Run `make` (GPU) or `make cpu` (CPU-only) in {}.".format(name, candidates, directory))
+
+
+def supported_dtypes(so, op_name):
+    """ The dtypes allowed for the attr `T` of op `op_name`, as defined by the loaded library `so`.
+
+    A GPU build of an op accepts fewer dtypes than a CPU-only build, since its GPU kernels
+    don't support half or bfloat16.
+
+    """
+    for op_def in so.OP_LIST.op:
+        if op_def.name == op_name:
+            for attr in op_def.attr:
+                if attr.name == "T":
+                    return set(tf.as_dtype(t) for t in attr.allowed_values.list.type)
+    raise ValueError("Op `{}` has no attr `T` in the loaded library.".format(op_name))
@@ -20,6 +20,8 @@
 #include <algorithm>
 #include <cmath>
 #include <memory>
+#include <type_traits>
+#include <vector>
 
 #include "tensorflow/core/framework/op_kernel.h"
 #include "tensorflow/core/framework/register_types.h"
@@ -35,6 +37,121 @@ using GPUDevice = Eigen::GpuDevice;
 
 namespace functor {
 
+// Type in which the CPU kernels do their arithmetic. Reduced-precision inputs are widened to float, so that the
+// weighted sums, importance sums and gradient accumulators don't lose precision.
+template <typename T>
+struct AccumulatorType { typedef T type; };
+
+template <>
+struct AccumulatorType<Eigen::half> { typedef float type; };
+
+template <>
+struct AccumulatorType<bfloat16> { typedef float type; };
+
+// Flat (CSR-style) index from the pixels of an image to the sprites that affect them.
+// The ids of the sprites affecting pixel p are sprite_ids[begin(p)], ..., sprite_ids[end(p) - 1],
+// in increasing order. The buffers keep their capacity between calls to `build`, so after the first
+// few batch elements, building the index for a new image performs no heap allocations.
+template <typename T>
+struct SpriteIndex {
+  std::vector<int> pixel_start;  // Size n_pixels + 1; offsets into sprite_ids.
+  std::vector<int> sprite_ids;
+  std::vector<int> bounds;       // top, bottom, left, right (inclusive) of the pixels affected by each sprite.
+  std::vector<int> cursor;
+
+  int begin(const int pixel_id) const { return pixel_start[pixel_id]; }
+  int end(const int pixel_id) const { return pixel_start[pixel_id + 1]; }
+  int size(const int pixel_id) const { return end(pixel_id) - begin(pixel_id); }
+
+  // `scales` and `offsets` point to the entries for the first sprite of the image.
+  template <typename U>
+  void build(const U* __restrict__ scales,
+             const U* __restrict__ offsets,
+             const int n_sprites,
+             const int sprite_height,
+             const int sprite_width,
+             const int img_height,
+             const int img_width) {
+
+    const T sprite_height_T = static_cast<T>(sprite_height);
+    const T sprite_width_T = static_cast<T>(sprite_width);
+
+    const T img_height_T = static_cast<T>(img_height);
+    const T img_width_T = static_cast<T>(img_width);
+
+    const T _left = static_cast<T>(-1.0);
+    const T _right = sprite_width_T;
+    const T _top = static_cast<T>(-1.0);
+    const T _bottom = sprite_height_T;
+
+    const int n_pixels = img_height * img_width;
+
+    pixel_start.assign(n_pixels + 1, 0);
+    bounds.resize(4 * n_sprites);
+
+    // --- for each sprite, compute the range of pixels it affects, and count the sprites affecting each pixel ---
+
+    for (int sprite_id = 0; sprite_id < n_sprites; ++sprite_id) {
+      const T scale_y = static_cast<T>(scales[sprite_id * 2]);
+      const T scale_x = static_cast<T>(scales[sprite_id * 2 + 1]);
+
+      const T offset_y = static_cast<T>(offsets[sprite_id * 2]);
+      const T offset_x = static_cast<T>(offsets[sprite_id * 2 + 1]);
+
+      const T left = -0.5 + img_width_T * ((_left + 0.5) * scale_x / sprite_width_T + offset_x);
+      const T right = -0.5 + img_width_T * ((_right + 0.5) * scale_x / sprite_width_T + offset_x);
+
+      const T top = -0.5 + img_height_T * ((_top + 0.5) * scale_y / sprite_height_T + offset_y);
+      const T bottom = -0.5 + img_height_T * ((_bottom + 0.5) * scale_y / sprite_height_T + offset_y);
+
+      const int left_i = static_cast<int>(fmax(0.0, ceil(left)));
+      const int right_i = static_cast<int>(fmin(img_width_T-1, floor(right)));
+
+      const int top_i = static_cast<int>(fmax(0.0, ceil(top)));
+      const int bottom_i = static_cast<int>(fmin(img_height_T-1, floor(bottom)));
+
+      bounds[4 * sprite_id] = top_i;
+      bounds[4 * sprite_id + 1] = bottom_i;
+      bounds[4 * sprite_id + 2] = left_i;
+      bounds[4 * sprite_id + 3] = right_i;
+
+      if (left_i <= right_i && top_i <= bottom_i) {
+        for (int i = top_i; i <= bottom_i; i++) {
+          for (int j = left_i; j <= right_i; j++) {
+            pixel_start[i * img_width + j + 1]++;
+          }
+        }
+      }
+    }
+
+    // --- prefix sum to get the offset of each pixel's list ---
+
+    for (int pixel_id = 0; pixel_id < n_pixels; ++pixel_id) {
+      pixel_start[pixel_id + 1] += pixel_start[pixel_id];
+    }
+
+    // --- fill in sprite ids, visiting sprites in increasing order ---
+
+    sprite_ids.resize(pixel_start[n_pixels]);
+    cursor.assign(pixel_start.begin(), pixel_start.end() - 1);
+
+    for (int sprite_id = 0; sprite_id < n_sprites; ++sprite_id) {
+      const int top_i = bounds[4 * sprite_id];
+      const int bottom_i = bounds[4 * sprite_id + 1];
+      const int left_i = bounds[4 * sprite_id + 2];
+      const int right_i = bounds[4 * sprite_id + 3];
+
+      if (left_i <= right_i && top_i <= bottom_i) {
+        for (int i = top_i; i <= bottom_i; i++) {
+          for (int j = left_i; j <= right_i; j++) {
+            sprite_ids[cursor[i * img_width + j]++] = sprite_id;
+          }
+        }
+      }
+    }
+  }
+};
+
 template <typename T>
 struct RenderSprites2DFunctor<CPUDevice, T>{
   void operator ()(::tensorflow::OpKernelContext* ctx,
@@ -59,6 +176,8 @@ struct RenderSprites2DFunctor<CPUDevice, T>{
 
                    const int n_channels){
 
+    typedef typename AccumulatorType<T>::type A;
+
     const int sprites_batch_stride = max_sprites * sprite_height * sprite_width * (n_channels + 2);
     const int sprites_sprite_stride = sprite_height * sprite_width * (n_channels + 2);
     const int sprites_row_stride = sprite_width * (n_channels + 2);
@@ -69,194 +188,225 @@ struct RenderSprites2DFunctor<CPUDevice, T>{
     const int img_batch_stride = img_height * img_width * n_channels;
     const int img_row_stride = img_width * n_channels;
 
-    const T sprite_height_T = static_cast<T>(sprite_height);
-    const T sprite_width_T = static_cast<T>(sprite_width);
+    const A sprite_height_T = static_cast<A>(sprite_height);
+    const A sprite_width_T = static_cast<A>(sprite_width);
 
-    const T img_height_T = static_cast<T>(img_height);
-    const T img_width_T = static_cast<T>(img_width);
+    const A img_height_T = static_cast<A>(img_height);
+    const A img_width_T = static_cast<A>(img_width);
 
-    const T zero = static_cast<T>(0.0);
-    const T one = static_cast<T>(1.0);
+    const A zero = static_cast<A>(0.0);
+    const A one = static_cast<A>(1.0);
 
     if (max_sprites == 0) {
         memcpy(output, backgrounds, sizeof(T) * batch_size * img_height * img_width * n_channels);
         return;
     }
 
-    auto resample_batches = [&](const int start, const int limit) {
-
-      auto get_sprite_data = [&](const int batch_id,
-                                 const int sprite_id,
-                                 const int x,
-                                 const int y,
-                                 const int chan,
-                                 const T default_value=static_cast<T>(0.0)){
-
-        // Assumes that x and y are in the sprite's co-ordinate system
-
-        const bool point_is_in_range =
-            (x >= 0 && y >= 0 && x <= sprite_width - 1 && y <= sprite_height - 1);
-
-        return point_is_in_range
-               ? sprites[batch_id * sprites_batch_stride +
-                         sprite_id * sprites_sprite_stride +
-                         y * sprites_row_stride +
-                         x * (n_channels + 2) +
-                         chan]
-               : default_value;
-      };
-
-      std::vector<T> weighted_sum(n_channels, zero);
-      std::vector<T> bg(n_channels, zero);
-      std::vector<T> last_value(n_channels, zero);
-
-      for (int batch_id = start; batch_id < limit; ++batch_id) {
-
-        // --- for each sprite, compute which pixels it affects ---
-
-        std::vector< std::vector<T> > affecting(img_width * img_height);
-
-        const T _left = static_cast<T>(-1.0);
-        const T _right = sprite_width_T;
-        const T _top = static_cast<T>(-1.0);
-        const T _bottom = sprite_height_T;
-
-        for (int sprite_id = 0; sprite_id < n_sprites[batch_id]; ++sprite_id) {
-          const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-          const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
+    auto get_sprite_data = [&](const int batch_id,
+                               const int sprite_id,
+                               const int x,
+                               const int y,
+                               const int chan,
+                               const A default_value=static_cast<A>(0.0)){
+
+      // Assumes that x and y are in the sprite's co-ordinate system
+
+      const bool point_is_in_range =
+          (x >= 0 && y >= 0 && x <= sprite_width - 1 && y <= sprite_height - 1);
+
+      return point_is_in_range
+             ? static_cast<A>(sprites[batch_id * sprites_batch_stride +
+                                      sprite_id * sprites_sprite_stride +
+                                      y * sprites_row_stride +
+                                      x * (n_channels + 2) +
+                                      chan])
+             : default_value;
+    };
 
-          const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-          const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+    // Renders rows [row_start, row_limit) of image `batch_id`, given the pixel-to-sprite index for that image.
+    auto render_rows = [&](const int batch_id,
+                           const int row_start,
+                           const int row_limit,
+                           const SpriteIndex<A>& index) {
 
-          const T left = -0.5 + img_width_T * ((_left + 0.5) * scale_x / sprite_width_T + offset_x);
-          const T right = -0.5 + img_width_T * ((_right + 0.5) * scale_x / sprite_width_T + offset_x);
+      std::vector<A> weighted_sum(n_channels, zero);
+      std::vector<A> bg(n_channels, zero);
+      std::vector<A> last_value(n_channels, zero);
 
-          const T top = -0.5 + img_height_T * ((_top + 0.5) * scale_y / sprite_height_T + offset_y);
-          const T bottom = -0.5 + img_height_T * ((_bottom + 0.5) * scale_y / sprite_height_T + offset_y);
+      // --- for each pixel, iterate over all affecting sprites ---
 
-          const int left_i = static_cast<int>(fmax(0.0, ceil(left)));
-          const int right_i = static_cast<int>(fmin(img_width_T-1, floor(right)));
+      for (int img_y = row_start; img_y < row_limit; ++img_y) {
+        const A img_y_T = static_cast<A>(img_y);
 
-          const int top_i = static_cast<int>(fmax(0.0, ceil(top)));
-          const int bottom_i = static_cast<int>(fmin(img_height_T-1, floor(bottom)));
+        for (int img_x = 0; img_x < img_width; ++img_x) {
+          const A img_x_T = static_cast<A>(img_x);
 
-          if (left_i <= right_i && top_i <= bottom_i) {
-            for (int i = top_i; i <= bottom_i; i++) {
-              for (int j = left_i; j <= right_i; j++) {
-                affecting[i * img_width + j].push_back(sprite_id);
-              }
-            }
+          for(int chan = 0; chan < n_channels; ++chan){
+              weighted_sum[chan] = 0.0;
+              bg[chan] = static_cast<A>(backgrounds[batch_id * img_batch_stride +
+                                                    img_y * img_row_stride +
+                                                    img_x * n_channels + chan]);
           }
-        }
-
-        // --- for each pixel, iterate over all affecting sprites ---
-
-        for (int img_y = 0; img_y < img_height; ++img_y) {
-          const T img_y_T = static_cast<T>(img_y);
 
-          for (int img_x = 0; img_x < img_width; ++img_x) {
-            const T img_x_T = static_cast<T>(img_x);
-
-            for(int chan = 0; chan < n_channels; ++chan){
-                weighted_sum[chan] = 0.0;
-                bg[chan] = backgrounds[batch_id * img_batch_stride +
-                                       img_y * img_row_stride +
-                                       img_x * n_channels + chan];
-            }
+          A importance_sum = 0.0;
+          const int pixel_id = img_y * img_width + img_x;
+          const int n_writes = index.size(pixel_id);
+
+          for (int k = index.begin(pixel_id); k < index.end(pixel_id); ++k) {
+            const int sprite_id = index.sprite_ids[k];
+            const A scale_y = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2]);
+            const A scale_x = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2 + 1]);
+
+            const A offset_y = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2]);
+            const A offset_x = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1]);
+
+            // The pixel location represented in the sprites's co-ordinate frame
+            const A y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
+            const A x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+
+            const int fx = std::floor(static_cast<float>(x));
+            const int fy = std::floor(static_cast<float>(y));
+
+            const int cx = fx + 1;
+            const int cy = fy + 1;
+
+            const A dx = static_cast<A>(cx) - x;
+            const A dy = static_cast<A>(cy) - y;
+
+            const A alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
+            const A alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
+            const A alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
+            const A alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
+            const A alpha = dx * dy * alpha_fxfy +
+                            (one - dx) * (one - dy) * alpha_cxcy +
+                            dx * (one - dy) * alpha_fxcy +
+                            (one - dx) * dy * alpha_cxfy;
+
+            const A imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
+            const A imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
+            const A imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
+            const A imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
+            const A imp = dx * dy * imp_fxfy +
+                          (one - dx) * (one - dy) * imp_cxcy +
+                          dx * (one - dy) * imp_fxcy +
+                          (one - dx) * dy * imp_cxfy;
+
+            importance_sum += imp;
+
+            for (int chan = 0; chan < n_channels; ++chan) {
+              const A img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
+              const A img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
+              const A img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
+              const A img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
+              const A interp = dx * dy * img_fxfy +
+                               (one - dx) * (one - dy) * img_cxcy +
+                               dx * (one - dy) * img_fxcy +
+                               (one - dx) * dy * img_cxfy;
+
+              const A value = alpha * interp + (1-alpha) * bg[chan];
+              weighted_sum[chan] += imp * value;
+              last_value[chan] = value;
+            } // channel
+          } // sprite_id
+
+          for(int chan = 0; chan < n_channels; ++chan) {
+              if(n_writes == 0){
+                  output[batch_id * img_batch_stride +
+                         img_y * img_row_stride +
+                         img_x * n_channels + chan] = static_cast<T>(bg[chan]);
+              }else if(n_writes == 1){
+                  output[batch_id * img_batch_stride +
+                         img_y * img_row_stride +
+                         img_x * n_channels + chan] = static_cast<T>(last_value[chan]);
+              }else{
+                  output[batch_id * img_batch_stride +
+                         img_y * img_row_stride +
+                         img_x * n_channels + chan] = static_cast<T>(weighted_sum[chan] / importance_sum);
+              }
+          } // channel
+        } // img_x
+      } // img_y
+    };
 
-            T importance_sum = 0.0;
-            int n_writes = affecting[img_y * img_width + img_x].size();
+    auto worker_threads = *(ctx->device()->tensorflow_cpu_worker_threads());
 
-            for (int sprite_id : affecting[img_y * img_width + img_x]) {
-              const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-              const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
+    if (batch_size >= worker_threads.num_threads) {
+      auto resample_batches = [&](const int64 start, const int64 limit) {
+        // Scratch space for the pixel-to-sprite index, reused for every batch element in this shard.
+        SpriteIndex<A> index;
 
-              const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-              const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+        for (int batch_id = start; batch_id < limit; ++batch_id) {
 
-              // The pixel location represented in the sprites's co-ordinate frame
-              const T y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
-              const T x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+          // --- for each sprite, compute which pixels it affects ---
 
-              const int fx = std::floor(static_cast<float>(x));
-              const int fy = std::floor(static_cast<float>(y));
+          index.build(scales + batch_id * scales_batch_stride,
+                      offsets + batch_id * offsets_batch_stride,
+                      n_sprites[batch_id],
+                      sprite_height, sprite_width,
+                      img_height, img_width);
 
-              const int cx = fx + 1;
-              const int cy = fy + 1;
+          render_rows(batch_id, 0, img_height, index);
+        }
+      };
 
-              const T dx = static_cast<T>(cx) - x;
-              const T dy = static_cast<T>(cy) - y;
+      // Rough estimate of work for each batch entry.
+      // From third_party/tensorflow/core/util/work_sharder.cc we gather that an
+      // estimate of the cost of each work unit is needed to correctly shard the
+      // workload. Shard assumes each cost unit is 1ns, minimum cost per shard
+      // being 10us.
+      const int64 cost = max_sprites * img_height * img_width * n_channels * 1000;
+
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size,
+                          cost,
+                          resample_batches);
+
+    } else {
+      // Too few images to keep all worker threads busy, so additionally split each image into rows.
+      // Each unit of work is a single row of a single image.
+
+      std::vector<SpriteIndex<A>> indices(batch_size);
+
+      auto build_indices = [&](const int64 start, const int64 limit) {
+        for (int batch_id = start; batch_id < limit; ++batch_id) {
+          indices[batch_id].build(scales + batch_id * scales_batch_stride,
+                                  offsets + batch_id * offsets_batch_stride,
+                                  n_sprites[batch_id],
+                                  sprite_height, sprite_width,
+                                  img_height, img_width);
+        }
+      };
 
-              const T alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
-              const T alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
-              const T alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
-              const T alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
-              const T alpha = dx * dy * alpha_fxfy +
-                              (one - dx) * (one - dy) * alpha_cxcy +
-                              dx * (one - dy) * alpha_fxcy +
-                              (one - dx) * dy * alpha_cxfy;
+      const int64 index_cost = max_sprites * sprite_height * sprite_width * 100;
 
-              const T imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
-              const T imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
-              const T imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
-              const T imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
-              const T imp = dx * dy * imp_fxfy +
-                            (one - dx) * (one - dy) * imp_cxcy +
-                            dx * (one - dy) * imp_fxcy +
-                            (one - dx) * dy * imp_cxfy;
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size,
+                          index_cost,
+                          build_indices);
 
-              importance_sum += imp;
+      auto resample_rows = [&](const int64 start, const int64 limit) {
+        int64 unit = start;
+        while (unit < limit) {
+          const int batch_id = unit / img_height;
+          const int row_start = unit % img_height;
+          const int row_limit = std::min<int64>(img_height, row_start + (limit - unit));
 
-              for (int chan = 0; chan < n_channels; ++chan) {
-                const T img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
-                const T img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
-                const T img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
-                const T img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
-                const T interp = dx * dy * img_fxfy +
-                                 (one - dx) * (one - dy) * img_cxcy +
-                                 dx * (one - dy) * img_fxcy +
-                                 (one - dx) * dy * img_cxfy;
-
-                const T value = alpha * interp + (1-alpha) * bg[chan];
-                weighted_sum[chan] += imp * value;
-                last_value[chan] = value;
-              } // channel
-            } // sprite_id
-
-            for(int chan = 0; chan < n_channels; ++chan) {
-                if(n_writes == 0){
-                    output[batch_id * img_batch_stride +
-                           img_y * img_row_stride +
-                           img_x * n_channels + chan] = bg[chan];
-                }else if(n_writes == 1){
-                    output[batch_id * img_batch_stride +
-                           img_y * img_row_stride +
-                           img_x * n_channels + chan] = last_value[chan];
-                }else{
-                    output[batch_id * img_batch_stride +
-                           img_y * img_row_stride +
-                           img_x * n_channels + chan] = weighted_sum[chan] / importance_sum;
-                }
-            } // channel
-          } // img_x
-        } // img_y
-      } // batch_id
-    };
+          render_rows(batch_id, row_start, row_limit, indices[batch_id]);
 
-    // Rough estimate of work for each batch entry.
-    // From third_party/tensorflow/core/util/work_sharder.cc we gather that an
-    // estimate of the cost of each work unit is needed to correctly shard the
-    // workload. Shard assumes each cost unit is 1ns, minimum cost per shard
-    // being 10us.
-    const int64 cost = max_sprites * img_height * img_width * n_channels * 1000;
+          unit += row_limit - row_start;
+        }
+      };
 
-    auto worker_threads = *(ctx->device()->tensorflow_cpu_worker_threads());
+      const int64 row_cost = max_sprites * img_width * n_channels * 1000;
 
-    ::tensorflow::Shard(worker_threads.num_threads,
-                        worker_threads.workers,
-                        batch_size,
-                        cost,
-                        resample_batches);
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size * img_height,
+                          row_cost,
+                          resample_rows);
+    }
   }
 };
 
@@ -390,7 +540,10 @@ class RenderSpritesOp : public ::tensorflow::OpKernel {
           .TypeConstraint<TYPE>("T"),        \
       RenderSpritesOp<CPUDevice, TYPE>);
 
-// TF_CALL_half(REGISTER);
+#if !GOOGLE_CUDA  // see ops/render_sprites_ops.cc
+TF_CALL_half(REGISTER);
+TF_CALL_bfloat16(REGISTER);
+#endif
 // TF_CALL_double(REGISTER);
 TF_CALL_float(REGISTER);
 #undef REGISTER
@@ -438,6 +591,8 @@ struct RenderSpritesGrad2DFunctor<CPUDevice, T>{
 
                    const int n_channels){
 
+    typedef typename AccumulatorType<T>::type A;
+
     // Set gradients to 0, because the kernel incrementally updates the tensor entries by adding partial contributions.
     // (Except for grad_backgrounds, which is only set once)
     memset(grad_sprites, 0, sizeof(T) * batch_size * max_sprites * sprite_height * sprite_width * (n_channels + 2));
@@ -460,456 +615,526 @@ struct RenderSpritesGrad2DFunctor<CPUDevice, T>{
     int img_batch_stride = img_height * img_width * n_channels;
     int img_row_stride = img_width * n_channels;
 
-    T sprite_height_T = static_cast<T>(sprite_height);
-    T sprite_width_T = static_cast<T>(sprite_width);
+    A sprite_height_T = static_cast<A>(sprite_height);
+    A sprite_width_T = static_cast<A>(sprite_width);
 
-    T img_height_T = static_cast<T>(img_height);
-    T img_width_T = static_cast<T>(img_width);
+    A img_height_T = static_cast<A>(img_height);
+    A img_width_T = static_cast<A>(img_width);
 
-    T zero = static_cast<T>(0.0);
-    T one = static_cast<T>(1.0);
+    A zero = static_cast<A>(0.0);
+    A one = static_cast<A>(1.0);
 
-    auto update_grads_for_batches = [&](const int start, const int limit){
+    auto get_sprite_data = [&](const int batch_id,
+                               const int sprite_id,
+                               const int x,
+                               const int y,
+                               const int chan,
+                               const A default_value=static_cast<A>(0.0)){
 
-      auto get_sprite_data = [&](const int batch_id,
-                                 const int sprite_id,
-                                 const int x,
-                                 const int y,
-                                 const int chan,
-                                 const T default_value=static_cast<T>(0.0)){
+      // Assumes that x and y are in the sprite's co-ordinate system
 
-        // Assumes that x and y are in the sprite's co-ordinate system
-
-        const bool point_is_in_range =
-            (x >= 0 && y >= 0 && x <= sprite_width - 1 && y <= sprite_height - 1);
+      const bool point_is_in_range =
+          (x >= 0 && y >= 0 && x <= sprite_width - 1 && y <= sprite_height - 1);
 
-        return point_is_in_range
-               ? sprites[batch_id * sprites_batch_stride +
-                         sprite_id * sprites_sprite_stride +
-                         y * sprites_row_stride +
-                         x * (n_channels + 2) +
-                         chan]
-               : default_value;
-      };
+      return point_is_in_range
+             ? static_cast<A>(sprites[batch_id * sprites_batch_stride +
+                                      sprite_id * sprites_sprite_stride +
+                                      y * sprites_row_stride +
+                                      x * (n_channels + 2) +
+                                      chan])
+             : default_value;
+    };
 
-      auto update_grad_sprites = [&](const int batch_id,
-                                     const int sprite_id,
+    // Accumulates gradients for rows [row_start, row_limit) of image `batch_id`, given the pixel-to-sprite
+    // index for that image. Gradients with respect to the sprites, scales and offsets of the image are added
+    // to `g_sprites`, `g_scales` and `g_offsets`, which are laid out like one batch element of the
+    // corresponding outputs.
+    auto update_grads_for_rows = [&](const int batch_id,
+                                     const int row_start,
+                                     const int row_limit,
+                                     const SpriteIndex<A>& index,
+                                     A* __restrict__ g_sprites,
+                                     A* __restrict__ g_scales,
+                                     A* __restrict__ g_offsets){
+
+      auto update_grad_sprites = [&](const int sprite_id,
                                      const int x,
                                      const int y,
                                      const int chan,
-                                     const T value) {
+                                     const A value) {
 
         const bool point_is_in_range =
             (x >= 0 && y >= 0 && x <= sprite_width - 1 && y <= sprite_height - 1);
 
         if (point_is_in_range){
-          grad_sprites[batch_id * sprites_batch_stride +
-                       sprite_id * sprites_sprite_stride +
-                       y * sprites_row_stride +
-                       x * (n_channels + 2) +
-                       chan] += value;
+          g_sprites[sprite_id * sprites_sprite_stride +
+                    y * sprites_row_stride +
+                    x * (n_channels + 2) +
+                    chan] += value;
         }
 
       };
 
-      auto update_grad_scales_y = [&](const int batch_id,
-                                      const int sprite_id,
-                                      const T value) {
+      auto update_grad_scales_y = [&](const int sprite_id,
+                                      const A value) {
 
-        grad_scales[batch_id * scales_batch_stride +
-                    sprite_id * 2] += value;
+        g_scales[sprite_id * 2] += value;
       };
 
-      auto update_grad_scales_x = [&](const int batch_id,
-                                      const int sprite_id,
-                                      const T value) {
+      auto update_grad_scales_x = [&](const int sprite_id,
+                                      const A value) {
 
-        grad_scales[batch_id * scales_batch_stride +
-                    sprite_id * 2 + 1] += value;
+        g_scales[sprite_id * 2 + 1] += value;
       };
 
-      auto update_grad_offsets_y = [&](const int batch_id,
-                                       const int sprite_id,
-                                       const T value) {
+      auto update_grad_offsets_y = [&](const int sprite_id,
+                                       const A value) {
 
-        grad_offsets[batch_id * offsets_batch_stride +
-                     sprite_id * 2] += value;
+        g_offsets[sprite_id * 2] += value;
       };
 
-      auto update_grad_offsets_x = [&](const int batch_id,
-                                       const int sprite_id,
-                                       const T value) {
+      auto update_grad_offsets_x = [&](const int sprite_id,
+                                       const A value) {
 
-        grad_offsets[batch_id * offsets_batch_stride +
-                     sprite_id * 2 + 1] += value;
+        g_offsets[sprite_id * 2 + 1] += value;
       };
 
-      std::vector<T> weighted_sum(n_channels, zero);
-      std::vector<T> bg(n_channels, zero);
-      std::vector<T> last_value(n_channels, zero);
-
-      for (int batch_id = start; batch_id < limit; ++batch_id) {
-
-        // --- for each sprite, compute which pixels it affects ---
-
-        std::vector< std::vector<T> > affecting(img_width * img_height);
-
-        const T _left = static_cast<T>(-1.0);
-        const T _right = sprite_width_T;
-        const T _top = static_cast<T>(-1.0);
-        const T _bottom = sprite_height_T;
-
-        for (int sprite_id = 0; sprite_id < n_sprites[batch_id]; ++sprite_id) {
-          const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-          const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
-
-          const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-          const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+      std::vector<A> weighted_sum(n_channels, zero);
+      std::vector<A> bg(n_channels, zero);
+      std::vector<A> last_value(n_channels, zero);
 
-          const T left = -0.5 + img_width_T * ((_left + 0.5) * scale_x / sprite_width_T + offset_x);
-          const T right = -0.5 + img_width_T * ((_right + 0.5) * scale_x / sprite_width_T + offset_x);
+      // --- for each pixel, iterate over all affecting sprites ---
 
-          const T top = -0.5 + img_height_T * ((_top + 0.5) * scale_y / sprite_height_T + offset_y);
-          const T bottom = -0.5 + img_height_T * ((_bottom + 0.5) * scale_y / sprite_height_T + offset_y);
+      for (int img_y = row_start; img_y < row_limit; ++img_y) {
+        const A img_y_T = static_cast<A>(img_y);
 
-          const int left_i = static_cast<int>(fmax(0.0, ceil(left)));
-          const int right_i = static_cast<int>(fmin(img_width_T-1, floor(right)));
+        for (int img_x = 0; img_x < img_width; ++img_x) {
+          const A img_x_T = static_cast<A>(img_x);
 
-          const int top_i = static_cast<int>(fmax(0.0, ceil(top)));
-          const int bottom_i = static_cast<int>(fmin(img_height_T-1, floor(bottom)));
+          for(int chan = 0; chan < n_channels; ++chan){
+              weighted_sum[chan] = 0.0;
+              bg[chan] = static_cast<A>(backgrounds[batch_id * img_batch_stride +
+                                                    img_y * img_row_stride +
+                                                    img_x * n_channels + chan]);
+          }
 
-          if (left_i <= right_i && top_i <= bottom_i) {
-            for (int i = top_i; i <= bottom_i; i++) {
-              for (int j = left_i; j <= right_i; j++) {
-                affecting[i * img_width + j].push_back(sprite_id);
-              }
+          A importance_sum = 0.0;
+          const int pixel_id = img_y * img_width + img_x;
+          const int n_writes = index.size(pixel_id);
+
+          for (int k = index.begin(pixel_id); k < index.end(pixel_id); ++k) {
+            const int sprite_id = index.sprite_ids[k];
+            const A scale_y = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2]);
+            const A scale_x = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2 + 1]);
+
+            const A offset_y = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2]);
+            const A offset_x = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1]);
+
+            // The pixel location represented in the sprites's co-ordinate frame
+            const A y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
+            const A x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+
+            const int fx = std::floor(static_cast<float>(x));
+            const int fy = std::floor(static_cast<float>(y));
+
+            const int cx = fx + 1;
+            const int cy = fy + 1;
+
+            const A dx = static_cast<A>(cx) - x;
+            const A dy = static_cast<A>(cy) - y;
+
+            const A alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
+            const A alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
+            const A alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
+            const A alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
+            const A alpha = dx * dy * alpha_fxfy +
+                            (one - dx) * (one - dy) * alpha_cxcy +
+                            dx * (one - dy) * alpha_fxcy +
+                            (one - dx) * dy * alpha_cxfy;
+
+            const A imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
+            const A imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
+            const A imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
+            const A imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
+            const A imp = dx * dy * imp_fxfy +
+                          (one - dx) * (one - dy) * imp_cxcy +
+                          dx * (one - dy) * imp_fxcy +
+                          (one - dx) * dy * imp_cxfy;
+
+            importance_sum += imp;
+
+            for (int chan = 0; chan < n_channels; ++chan) {
+              const A img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
+              const A img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
+              const A img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
+              const A img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
+              const A interp = dx * dy * img_fxfy +
+                               (one - dx) * (one - dy) * img_cxcy +
+                               dx * (one - dy) * img_fxcy +
+                               (one - dx) * dy * img_cxfy;
+
+              const A value = alpha * interp + (1-alpha) * bg[chan];
+              weighted_sum[chan] += imp * value;
+              last_value[chan] = value;
+            } // channel
+          } // sprite_id
+
+          if(n_writes == 0){
+            for (int chan = 0; chan < n_channels; ++chan) {
+              const A go = static_cast<A>(grad_output[batch_id * img_batch_stride +
+                                                      img_y * img_row_stride +
+                                                      img_x * n_channels + chan]);
+              grad_backgrounds[batch_id * img_batch_stride +
+                               img_y * img_row_stride +
+                               img_x * n_channels + chan] = static_cast<T>(go);
             }
-          }
-        }
+          }else if(n_writes == 1){
+            const int sprite_id = index.sprite_ids[index.begin(pixel_id)];
+            const A scale_y = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2]);
+            const A scale_x = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2 + 1]);
 
-        // --- for each pixel, iterate over all affecting sprites ---
+            const A offset_y = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2]);
+            const A offset_x = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1]);
 
-        for (int img_y = 0; img_y < img_height; ++img_y) {
-          const T img_y_T = static_cast<T>(img_y);
+            const A y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
+            const A x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
 
-          for (int img_x = 0; img_x < img_width; ++img_x) {
-            const T img_x_T = static_cast<T>(img_x);
+            const int fx = std::floor(static_cast<float>(x));
+            const int fy = std::floor(static_cast<float>(y));
 
-            for(int chan = 0; chan < n_channels; ++chan){
-                weighted_sum[chan] = 0.0;
-                bg[chan] = backgrounds[batch_id * img_batch_stride +
-                                       img_y * img_row_stride +
-                                       img_x * n_channels + chan];
-            }
+            const int cx = fx + 1;
+            const int cy = fy + 1;
 
-            T importance_sum = 0.0;
-            int n_writes = affecting[img_y * img_width + img_x].size();
+            const A dx = static_cast<A>(cx) - x;
+            const A dy = static_cast<A>(cy) - y;
 
-            for (int sprite_id : affecting[img_y * img_width + img_x]) {
-              const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-              const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
+            const A alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
+            const A alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
+            const A alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
+            const A alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
 
-              const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-              const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+            const A alpha = dx * dy * alpha_fxfy +
+                            (one - dx) * (one - dy) * alpha_cxcy +
+                            dx * (one - dy) * alpha_fxcy +
+                            (one - dx) * dy * alpha_cxfy;
 
-              // The pixel location represented in the sprites's co-ordinate frame
-              const T y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
-              const T x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+            const A alpha_y_factor = dx * (alpha_fxcy - alpha_fxfy) + (1 - dx) * (alpha_cxcy - alpha_cxfy);
+            const A alpha_x_factor = dy * (alpha_cxfy - alpha_fxfy) + (1 - dy) * (alpha_cxcy - alpha_fxcy);
 
-              const int fx = std::floor(static_cast<float>(x));
-              const int fy = std::floor(static_cast<float>(y));
+            const A grad_y_wrt_scale_y = -sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / (scale_y * scale_y);
+            const A grad_x_wrt_scale_x = -sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / (scale_x * scale_x);
 
-              const int cx = fx + 1;
-              const int cy = fy + 1;
+            const A grad_y_wrt_offset_y = -sprite_height_T / scale_y;
+            const A grad_x_wrt_offset_x = -sprite_width_T / scale_x;
 
-              const T dx = static_cast<T>(cx) - x;
-              const T dy = static_cast<T>(cy) - y;
+            for (int chan = 0; chan < n_channels; ++chan) {
+              const A go = static_cast<A>(grad_output[batch_id * img_batch_stride +
+                                                      img_y * img_row_stride +
+                                                      img_x * n_channels + chan]);
 
-              const T alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
-              const T alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
-              const T alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
-              const T alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
-              const T alpha = dx * dy * alpha_fxfy +
-                              (one - dx) * (one - dy) * alpha_cxcy +
-                              dx * (one - dy) * alpha_fxcy +
-                              (one - dx) * dy * alpha_cxfy;
+              grad_backgrounds[batch_id * img_batch_stride +
+                               img_y * img_row_stride +
+                               img_x * n_channels + chan] = static_cast<T>(go * (1-alpha));
 
-              const T imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
-              const T imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
-              const T imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
-              const T imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
-              const T imp = dx * dy * imp_fxfy +
-                            (one - dx) * (one - dy) * imp_cxcy +
-                            dx * (one - dy) * imp_fxcy +
-                            (one - dx) * dy * imp_cxfy;
+              const A img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
+              const A img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
+              const A img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
+              const A img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
 
-              importance_sum += imp;
+              const A interp = dx * dy * img_fxfy +
+                               (one - dx) * (one - dy) * img_cxcy +
+                               dx * (one - dy) * img_fxcy +
+                               (one - dx) * dy * img_cxfy;
 
-              for (int chan = 0; chan < n_channels; ++chan) {
-                const T img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
-                const T img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
-                const T img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
-                const T img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
-                const T interp = dx * dy * img_fxfy +
-                                 (one - dx) * (one - dy) * img_cxcy +
-                                 dx * (one - dy) * img_fxcy +
-                                 (one - dx) * dy * img_cxfy;
-
-                const T value = alpha * interp + (1-alpha) * bg[chan];
-                weighted_sum[chan] += imp * value;
-                last_value[chan] = value;
-              } // channel
-            } // sprite_id
-
-            if(n_writes == 0){
-              for (int chan = 0; chan < n_channels; ++chan) {
-                const T go = grad_output[batch_id * img_batch_stride +
-                                         img_y * img_row_stride +
-                                         img_x * n_channels + chan];
-                grad_backgrounds[batch_id * img_batch_stride +
-                                 img_y * img_row_stride +
-                                 img_x * n_channels + chan] = go;
-              }
-            }else if(n_writes == 1){
-              const int sprite_id = affecting[img_y * img_width + img_x][0];
-              const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-              const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
+              // ------ update gradient through alpha ------
 
-              const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-              const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+              const A alpha_premult = go * (interp - bg[chan]);
 
-              const T y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
-              const T x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+              update_grad_scales_y(sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_scale_y);
+              update_grad_scales_x(sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_scale_x);
 
-              const int fx = std::floor(static_cast<float>(x));
-              const int fy = std::floor(static_cast<float>(y));
+              update_grad_offsets_y(sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_offset_y);
+              update_grad_offsets_x(sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_offset_x);
 
-              const int cx = fx + 1;
-              const int cy = fy + 1;
+              update_grad_sprites(sprite_id, fx, fy, n_channels, alpha_premult * dx * dy);
+              update_grad_sprites(sprite_id, cx, cy, n_channels, alpha_premult * (1-dx) * (1-dy));
+              update_grad_sprites(sprite_id, fx, cy, n_channels, alpha_premult * dx * (1-dy));
+              update_grad_sprites(sprite_id, cx, fy, n_channels, alpha_premult * (1-dx) * dy);
 
-              const T dx = static_cast<T>(cx) - x;
-              const T dy = static_cast<T>(cy) - y;
+              // ------ update gradient through sprites ------
 
-              const T alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
-              const T alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
-              const T alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
-              const T alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
+              const A sprite_premult = go * alpha;
 
-              const T alpha = dx * dy * alpha_fxfy +
-                              (one - dx) * (one - dy) * alpha_cxcy +
-                              dx * (one - dy) * alpha_fxcy +
-                              (one - dx) * dy * alpha_cxfy;
+              const A y_factor = dx * (img_fxcy - img_fxfy) + (1 - dx) * (img_cxcy - img_cxfy);
+              const A x_factor = dy * (img_cxfy - img_fxfy) + (1 - dy) * (img_cxcy - img_fxcy);
 
-              const T alpha_y_factor = dx * (alpha_fxcy - alpha_fxfy) + (1 - dx) * (alpha_cxcy - alpha_cxfy);
-              const T alpha_x_factor = dy * (alpha_cxfy - alpha_fxfy) + (1 - dy) * (alpha_cxcy - alpha_fxcy);
+              update_grad_scales_y(sprite_id, sprite_premult * y_factor * grad_y_wrt_scale_y);
+              update_grad_scales_x(sprite_id, sprite_premult * x_factor * grad_x_wrt_scale_x);
 
-              const T grad_y_wrt_scale_y = -sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / (scale_y * scale_y);
-              const T grad_x_wrt_scale_x = -sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / (scale_x * scale_x);
+              update_grad_offsets_y(sprite_id, sprite_premult * y_factor * grad_y_wrt_offset_y);
+              update_grad_offsets_x(sprite_id, sprite_premult * x_factor * grad_x_wrt_offset_x);
 
-              const T grad_y_wrt_offset_y = -sprite_height_T / scale_y;
-              const T grad_x_wrt_offset_x = -sprite_width_T / scale_x;
+              update_grad_sprites(sprite_id, fx, fy, chan, sprite_premult * dx * dy);
+              update_grad_sprites(sprite_id, cx, cy, chan, sprite_premult * (1-dx) * (1-dy));
+              update_grad_sprites(sprite_id, fx, cy, chan, sprite_premult * dx * (1-dy));
+              update_grad_sprites(sprite_id, cx, fy, chan, sprite_premult * (1-dx) * dy);
+            }
+          }else{ // n_writes > 1
+              A bg_sum = 0.0;
+              for (int k = index.begin(pixel_id); k < index.end(pixel_id); ++k) {
+                const int sprite_id = index.sprite_ids[k];
+                const A scale_y = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2]);
+                const A scale_x = static_cast<A>(scales[batch_id * scales_batch_stride + sprite_id * 2 + 1]);
 
-              for (int chan = 0; chan < n_channels; ++chan) {
-                const T go = grad_output[batch_id * img_batch_stride +
-                                         img_y * img_row_stride +
-                                         img_x * n_channels + chan];
+                const A offset_y = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2]);
+                const A offset_x = static_cast<A>(offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1]);
 
-                grad_backgrounds[batch_id * img_batch_stride +
-                                 img_y * img_row_stride +
-                                 img_x * n_channels + chan] = go * (1-alpha);
+                const A y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
+                const A x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
 
-                const T img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
-                const T img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
-                const T img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
-                const T img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
+                const int fx = std::floor(static_cast<float>(x));
+                const int fy = std::floor(static_cast<float>(y));
 
-                const T interp = dx * dy * img_fxfy +
-                                 (one - dx) * (one - dy) * img_cxcy +
-                                 dx * (one - dy) * img_fxcy +
-                                 (one - dx) * dy * img_cxfy;
+                const int cx = fx + 1;
+                const int cy = fy + 1;
 
-                // ------ update gradient through alpha ------
+                const A dx = static_cast<A>(cx) - x;
+                const A dy = static_cast<A>(cy) - y;
 
-                const T alpha_premult = go * (interp - bg[chan]);
+                const A alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
+                const A alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
+                const A alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
+                const A alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
 
-                update_grad_scales_y(batch_id, sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_scale_y);
-                update_grad_scales_x(batch_id, sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_scale_x);
+                const A alpha = dx * dy * alpha_fxfy +
+                                (one - dx) * (one - dy) * alpha_cxcy +
+                                dx * (one - dy) * alpha_fxcy +
+                                (one - dx) * dy * alpha_cxfy;
 
-                update_grad_offsets_y(batch_id, sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_offset_y);
-                update_grad_offsets_x(batch_id, sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_offset_x);
+                const A imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
+                const A imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
+                const A imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
+                const A imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
+                const A imp = dx * dy * imp_fxfy +
+                              (one - dx) * (one - dy) * imp_cxcy +
+                              dx * (one - dy) * imp_fxcy +
+                              (one - dx) * dy * imp_cxfy;
 
-                update_grad_sprites(batch_id, sprite_id, fx, fy, n_channels, alpha_premult * dx * dy);
-                update_grad_sprites(batch_id, sprite_id, cx, cy, n_channels, alpha_premult * (1-dx) * (1-dy));
-                update_grad_sprites(batch_id, sprite_id, fx, cy, n_channels, alpha_premult * dx * (1-dy));
-                update_grad_sprites(batch_id, sprite_id, cx, fy, n_channels, alpha_premult * (1-dx) * dy);
+                bg_sum += imp * (1-alpha);
 
-                // ------ update gradient through sprites ------
+                const A alpha_y_factor = dx * (alpha_fxcy - alpha_fxfy) + (1 - dx) * (alpha_cxcy - alpha_cxfy);
+                const A alpha_x_factor = dy * (alpha_cxfy - alpha_fxfy) + (1 - dy) * (alpha_cxcy - alpha_fxcy);
 
-                const T sprite_premult = go * alpha;
+                const A imp_y_factor = dx * (imp_fxcy - imp_fxfy) + (1 - dx) * (imp_cxcy - imp_cxfy);
+                const A imp_x_factor = dy * (imp_cxfy - imp_fxfy) + (1 - dy) * (imp_cxcy - imp_fxcy);
 
-                const T y_factor = dx * (img_fxcy - img_fxfy) + (1 - dx) * (img_cxcy - img_cxfy);
-                const T x_factor = dy * (img_cxfy - img_fxfy) + (1 - dy) * (img_cxcy - img_fxcy);
+                const A grad_y_wrt_scale_y = -sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / (scale_y * scale_y);
+                const A grad_x_wrt_scale_x = -sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / (scale_x * scale_x);
 
-                update_grad_scales_y(batch_id, sprite_id, sprite_premult * y_factor * grad_y_wrt_scale_y);
-                update_grad_scales_x(batch_id, sprite_id, sprite_premult * x_factor * grad_x_wrt_scale_x);
+                const A grad_y_wrt_offset_y = -sprite_height_T / scale_y;
+                const A grad_x_wrt_offset_x = -sprite_width_T / scale_x;
 
-                update_grad_offsets_y(batch_id, sprite_id, sprite_premult * y_factor * grad_y_wrt_offset_y);
-                update_grad_offsets_x(batch_id, sprite_id, sprite_premult * x_factor * grad_x_wrt_offset_x);
+                for (int chan = 0; chan < n_channels; ++chan) {
+                  const A go = static_cast<A>(grad_output[batch_id * img_batch_stride +
+                                                          img_y * img_row_stride +
+                                                          img_x * n_channels + chan]);
 
-                update_grad_sprites(batch_id, sprite_id, fx, fy, chan, sprite_premult * dx * dy);
-                update_grad_sprites(batch_id, sprite_id, cx, cy, chan, sprite_premult * (1-dx) * (1-dy));
-                update_grad_sprites(batch_id, sprite_id, fx, cy, chan, sprite_premult * dx * (1-dy));
-                update_grad_sprites(batch_id, sprite_id, cx, fy, chan, sprite_premult * (1-dx) * dy);
-              }
-            }else{ // n_writes > 1
-                T bg_sum = 0.0;
-                for (const int sprite_id : affecting[img_y * img_width + img_x]) {
-                  const T scale_y = scales[batch_id * scales_batch_stride + sprite_id * 2];
-                  const T scale_x = scales[batch_id * scales_batch_stride + sprite_id * 2 + 1];
+                  const A img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
+                  const A img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
+                  const A img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
+                  const A img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
 
-                  const T offset_y = offsets[batch_id * offsets_batch_stride + sprite_id * 2];
-                  const T offset_x = offsets[batch_id * offsets_batch_stride + sprite_id * 2 + 1];
+                  const A interp = dx * dy * img_fxfy +
+                                   (one - dx) * (one - dy) * img_cxcy +
+                                   dx * (one - dy) * img_fxcy +
+                                   (one - dx) * dy * img_cxfy;
 
-                  const T y = -0.5 + sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / scale_y;
-                  const T x = -0.5 + sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / scale_x;
+                  const A value = alpha * interp + (1-alpha) * bg[chan];
 
-                  const int fx = std::floor(static_cast<float>(x));
-                  const int fy = std::floor(static_cast<float>(y));
+                  // ------ update gradient through alpha ------
 
-                  const int cx = fx + 1;
-                  const int cy = fy + 1;
+                  const A alpha_premult = go * (interp - bg[chan]) * (imp / importance_sum);
 
-                  const T dx = static_cast<T>(cx) - x;
-                  const T dy = static_cast<T>(cy) - y;
+                  update_grad_scales_y(sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_scale_y);
+                  update_grad_scales_x(sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_scale_x);
 
-                  const T alpha_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels);
-                  const T alpha_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels);
-                  const T alpha_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels);
-                  const T alpha_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels);
+                  update_grad_offsets_y(sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_offset_y);
+                  update_grad_offsets_x(sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_offset_x);
 
-                  const T alpha = dx * dy * alpha_fxfy +
-                                  (one - dx) * (one - dy) * alpha_cxcy +
-                                  dx * (one - dy) * alpha_fxcy +
-                                  (one - dx) * dy * alpha_cxfy;
+                  update_grad_sprites(sprite_id, fx, fy, n_channels, alpha_premult * dx * dy);
+                  update_grad_sprites(sprite_id, cx, cy, n_channels, alpha_premult * (1-dx) * (1-dy));
+                  update_grad_sprites(sprite_id, fx, cy, n_channels, alpha_premult * dx * (1-dy));
+                  update_grad_sprites(sprite_id, cx, fy, n_channels, alpha_premult * (1-dx) * dy);
 
-                  const T imp_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, n_channels+1);
-                  const T imp_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, n_channels+1);
-                  const T imp_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, n_channels+1);
-                  const T imp_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, n_channels+1);
-                  const T imp = dx * dy * imp_fxfy +
-                                (one - dx) * (one - dy) * imp_cxcy +
-                                dx * (one - dy) * imp_fxcy +
-                                (one - dx) * dy * imp_cxfy;
+                  // ------ update gradient through imp ------
 
-                  bg_sum += imp * (1-alpha);
+                  const A imp_premult = go * (value / importance_sum - weighted_sum[chan] / (importance_sum * importance_sum));
 
-                  const T alpha_y_factor = dx * (alpha_fxcy - alpha_fxfy) + (1 - dx) * (alpha_cxcy - alpha_cxfy);
-                  const T alpha_x_factor = dy * (alpha_cxfy - alpha_fxfy) + (1 - dy) * (alpha_cxcy - alpha_fxcy);
+                  update_grad_scales_y(sprite_id, imp_premult * imp_y_factor * grad_y_wrt_scale_y);
+                  update_grad_scales_x(sprite_id, imp_premult * imp_x_factor * grad_x_wrt_scale_x);
 
-                  const T imp_y_factor = dx * (imp_fxcy - imp_fxfy) + (1 - dx) * (imp_cxcy - imp_cxfy);
-                  const T imp_x_factor = dy * (imp_cxfy - imp_fxfy) + (1 - dy) * (imp_cxcy - imp_fxcy);
+                  update_grad_offsets_y(sprite_id, imp_premult * imp_y_factor * grad_y_wrt_offset_y);
+                  update_grad_offsets_x(sprite_id, imp_premult * imp_x_factor * grad_x_wrt_offset_x);
 
-                  const T grad_y_wrt_scale_y = -sprite_height_T * ((img_y_T + 0.5) / img_height_T - offset_y) / (scale_y * scale_y);
-                  const T grad_x_wrt_scale_x = -sprite_width_T * ((img_x_T + 0.5) / img_width_T - offset_x) / (scale_x * scale_x);
+                  update_grad_sprites(sprite_id, fx, fy, n_channels+1, imp_premult * dx * dy);
+                  update_grad_sprites(sprite_id, cx, cy, n_channels+1, imp_premult * (1-dx) * (1-dy));
+                  update_grad_sprites(sprite_id, fx, cy, n_channels+1, imp_premult * dx * (1-dy));
+                  update_grad_sprites(sprite_id, cx, fy, n_channels+1, imp_premult * (1-dx) * dy);
 
-                  const T grad_y_wrt_offset_y = -sprite_height_T / scale_y;
-                  const T grad_x_wrt_offset_x = -sprite_width_T / scale_x;
+                  // ------ update gradient through sprites ------
 
-                  for (int chan = 0; chan < n_channels; ++chan) {
-                    const T go = grad_output[batch_id * img_batch_stride +
-                                             img_y * img_row_stride +
-                                             img_x * n_channels + chan];
+                  const A sprite_premult = go * alpha * (imp / importance_sum);
 
-                    const T img_fxfy = get_sprite_data(batch_id, sprite_id, fx, fy, chan, bg[chan]);
-                    const T img_cxcy = get_sprite_data(batch_id, sprite_id, cx, cy, chan, bg[chan]);
-                    const T img_fxcy = get_sprite_data(batch_id, sprite_id, fx, cy, chan, bg[chan]);
-                    const T img_cxfy = get_sprite_data(batch_id, sprite_id, cx, fy, chan, bg[chan]);
+                  const A y_factor = dx * (img_fxcy - img_fxfy) + (1 - dx) * (img_cxcy - img_cxfy);
+                  const A x_factor = dy * (img_cxfy - img_fxfy) + (1 - dy) * (img_cxcy - img_fxcy);
 
-                    const T interp = dx * dy * img_fxfy +
-                                     (one - dx) * (one - dy) * img_cxcy +
-                                     dx * (one - dy) * img_fxcy +
-                                     (one - dx) * dy * img_cxfy;
+                  update_grad_scales_y(sprite_id, sprite_premult * y_factor * grad_y_wrt_scale_y);
+                  update_grad_scales_x(sprite_id, sprite_premult * x_factor * grad_x_wrt_scale_x);
 
-                    const T value = alpha * interp + (1-alpha) * bg[chan];
+                  update_grad_offsets_y(sprite_id, sprite_premult * y_factor * grad_y_wrt_offset_y);
+                  update_grad_offsets_x(sprite_id, sprite_premult * x_factor * grad_x_wrt_offset_x);
 
-                    // ------ update gradient through alpha ------
+                  update_grad_sprites(sprite_id, fx, fy, chan, sprite_premult * dx * dy);
+                  update_grad_sprites(sprite_id, cx, cy, chan, sprite_premult * (1-dx) * (1-dy));
+                  update_grad_sprites(sprite_id, fx, cy, chan, sprite_premult * dx * (1-dy));
+                  update_grad_sprites(sprite_id, cx, fy, chan, sprite_premult * (1-dx) * dy);
+                } // channel
+              } // sprite_id - second pass
 
-                    const T alpha_premult = go * (interp - bg[chan]) * (imp / importance_sum);
+              for (int chan = 0; chan < n_channels; ++chan) {
+                const A go = static_cast<A>(grad_output[batch_id * img_batch_stride +
+                                                        img_y * img_row_stride +
+                                                        img_x * n_channels + chan]);
+                grad_backgrounds[batch_id * img_batch_stride +
+                                 img_y * img_row_stride +
+                                 img_x * n_channels + chan] = static_cast<T>(go * bg_sum / importance_sum);
+              }
+          }
+        } // img_x
+      } // img_y
+    };
 
-                    update_grad_scales_y(batch_id, sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_scale_y);
-                    update_grad_scales_x(batch_id, sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_scale_x);
+    auto worker_threads = *(ctx->device()->tensorflow_cpu_worker_threads());
 
-                    update_grad_offsets_y(batch_id, sprite_id, alpha_premult * alpha_y_factor * grad_y_wrt_offset_y);
-                    update_grad_offsets_x(batch_id, sprite_id, alpha_premult * alpha_x_factor * grad_x_wrt_offset_x);
+    // Accumulating directly into the outputs is only possible when they have the accumulation type; reduced-precision
+    // gradients always go through the float buffers of the block path below.
+    if (std::is_same<T, A>::value && batch_size >= worker_threads.num_threads) {
+      auto update_grads_for_batches = [&](const int64 start, const int64 limit){
+        // Scratch space for the pixel-to-sprite index, reused for every batch element in this shard.
+        SpriteIndex<A> index;
 
-                    update_grad_sprites(batch_id, sprite_id, fx, fy, n_channels, alpha_premult * dx * dy);
-                    update_grad_sprites(batch_id, sprite_id, cx, cy, n_channels, alpha_premult * (1-dx) * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, fx, cy, n_channels, alpha_premult * dx * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, cx, fy, n_channels, alpha_premult * (1-dx) * dy);
+        for (int batch_id = start; batch_id < limit; ++batch_id) {
 
-                    // ------ update gradient through imp ------
+          // --- for each sprite, compute which pixels it affects ---
 
-                    const T imp_premult = go * (value / importance_sum - weighted_sum[chan] / (importance_sum * importance_sum));
+          index.build(scales + batch_id * scales_batch_stride,
+                      offsets + batch_id * offsets_batch_stride,
+                      n_sprites[batch_id],
+                      sprite_height, sprite_width,
+                      img_height, img_width);
 
-                    update_grad_scales_y(batch_id, sprite_id, imp_premult * imp_y_factor * grad_y_wrt_scale_y);
-                    update_grad_scales_x(batch_id, sprite_id, imp_premult * imp_x_factor * grad_x_wrt_scale_x);
+          update_grads_for_rows(batch_id, 0, img_height, index,
+                                reinterpret_cast<A*>(grad_sprites + batch_id * sprites_batch_stride),
+                                reinterpret_cast<A*>(grad_scales + batch_id * scales_batch_stride),
+                                reinterpret_cast<A*>(grad_offsets + batch_id * offsets_batch_stride));
+        }
+      };
 
-                    update_grad_offsets_y(batch_id, sprite_id, imp_premult * imp_y_factor * grad_y_wrt_offset_y);
-                    update_grad_offsets_x(batch_id, sprite_id, imp_premult * imp_x_factor * grad_x_wrt_offset_x);
+      // Rough estimate of work for each batch entry.
+      // From third_party/tensorflow/core/util/work_sharder.cc we gather that an
+      // estimate of the cost of each work unit is needed to correctly shard the
+      // workload. Shard assumes each cost unit is 1ns, minimum cost per shard
+      // being 10us.
+      const int64 cost = max_sprites * img_height * img_width * n_channels * 1000;
+
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size,
+                          cost,
+                          update_grads_for_batches);
+
+    } else {
+      // Too few images to keep all worker threads busy, so additionally split each image into blocks of rows
+      // (or the gradients need float buffers, in which case there is one block per image).
+      // Blocks of the same image would race on the gradients for that image's sprites, scales and offsets,
+      // so each block accumulates into private buffers, which are summed once all blocks are done.
+
+      const int n_blocks = std::min(img_height, (worker_threads.num_threads + batch_size - 1) / batch_size);
+      const int rows_per_block = (img_height + n_blocks - 1) / n_blocks;
+      const int block_stride = sprites_batch_stride + scales_batch_stride + offsets_batch_stride;
+
+      std::vector<SpriteIndex<A>> indices(batch_size);
+      std::vector<A> block_grads(static_cast<int64>(batch_size) * n_blocks * block_stride, zero);
+
+      auto build_indices = [&](const int64 start, const int64 limit) {
+        for (int batch_id = start; batch_id < limit; ++batch_id) {
+          indices[batch_id].build(scales + batch_id * scales_batch_stride,
+                                  offsets + batch_id * offsets_batch_stride,
+                                  n_sprites[batch_id],
+                                  sprite_height, sprite_width,
+                                  img_height, img_width);
+        }
+      };
 
-                    update_grad_sprites(batch_id, sprite_id, fx, fy, n_channels+1, imp_premult * dx * dy);
-                    update_grad_sprites(batch_id, sprite_id, cx, cy, n_channels+1, imp_premult * (1-dx) * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, fx, cy, n_channels+1, imp_premult * dx * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, cx, fy, n_channels+1, imp_premult * (1-dx) * dy);
+      const int64 index_cost = max_sprites * sprite_height * sprite_width * 100;
 
-                    // ------ update gradient through sprites ------
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size,
+                          index_cost,
+                          build_indices);
 
-                    const T sprite_premult = go * alpha * (imp / importance_sum);
+      auto update_grads_for_blocks = [&](const int64 start, const int64 limit) {
+        for (int64 block = start; block < limit; ++block) {
+          const int batch_id = block / n_blocks;
+          const int row_start = std::min(img_height, static_cast<int>(block % n_blocks) * rows_per_block);
+          const int row_limit = std::min(img_height, row_start + rows_per_block);
 
-                    const T y_factor = dx * (img_fxcy - img_fxfy) + (1 - dx) * (img_cxcy - img_cxfy);
-                    const T x_factor = dy * (img_cxfy - img_fxfy) + (1 - dy) * (img_cxcy - img_fxcy);
+          A* g = block_grads.data() + block * block_stride;
 
-                    update_grad_scales_y(batch_id, sprite_id, sprite_premult * y_factor * grad_y_wrt_scale_y);
-                    update_grad_scales_x(batch_id, sprite_id, sprite_premult * x_factor * grad_x_wrt_scale_x);
+          update_grads_for_rows(batch_id, row_start, row_limit, indices[batch_id],
+                                g,
+                                g + sprites_batch_stride,
+                                g + sprites_batch_stride + scales_batch_stride);
+        }
+      };
 
-                    update_grad_offsets_y(batch_id, sprite_id, sprite_premult * y_factor * grad_y_wrt_offset_y);
-                    update_grad_offsets_x(batch_id, sprite_id, sprite_premult * x_factor * grad_x_wrt_offset_x);
+      const int64 block_cost = max_sprites * rows_per_block * img_width * n_channels * 1000;
 
-                    update_grad_sprites(batch_id, sprite_id, fx, fy, chan, sprite_premult * dx * dy);
-                    update_grad_sprites(batch_id, sprite_id, cx, cy, chan, sprite_premult * (1-dx) * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, fx, cy, chan, sprite_premult * dx * (1-dy));
-                    update_grad_sprites(batch_id, sprite_id, cx, fy, chan, sprite_premult * (1-dx) * dy);
-                  } // channel
-                } // sprite_id - second pass
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          batch_size * n_blocks,
+                          block_cost,
+                          update_grads_for_blocks);
 
-                for (int chan = 0; chan < n_channels; ++chan) {
-                  const T go = grad_output[batch_id * img_batch_stride +
-                                           img_y * img_row_stride +
-                                           img_x * n_channels + chan];
-                  grad_backgrounds[batch_id * img_batch_stride +
-                                   img_y * img_row_stride +
-                                   img_x * n_channels + chan] = go * bg_sum / importance_sum;
-                }
-            }
-          } // img_x
-        } // img_y
-      } // batch_id
-    };
+      // --- sum the per-block gradients ---
 
-    // Rough estimate of work for each batch entry.
-    // From third_party/tensorflow/core/util/work_sharder.cc we gather that an
-    // estimate of the cost of each work unit is needed to correctly shard the
-    // workload. Shard assumes each cost unit is 1ns, minimum cost per shard
-    // being 10us.
-    const int64 cost = max_sprites * img_height * img_width * n_channels * 1000;
+      auto reduce_blocks = [&](const int64 start, const int64 limit) {
+        for (int64 i = start; i < limit; ++i) {
+          const int batch_id = i / block_stride;
+          const int k = i % block_stride;
 
-    auto worker_threads = *(ctx->device()->tensorflow_cpu_worker_threads());
+          A total = zero;
+          for (int block = 0; block < n_blocks; ++block) {
+            total += block_grads[(static_cast<int64>(batch_id) * n_blocks + block) * block_stride + k];
+          }
+
+          if (k < sprites_batch_stride) {
+            grad_sprites[batch_id * sprites_batch_stride + k] = static_cast<T>(total);
+          } else if (k < sprites_batch_stride + scales_batch_stride) {
+            grad_scales[batch_id * scales_batch_stride + k - sprites_batch_stride] = static_cast<T>(total);
+          } else {
+            grad_offsets[batch_id * offsets_batch_stride + k - sprites_batch_stride - scales_batch_stride] = static_cast<T>(total);
+          }
+        }
+      };
 
-    ::tensorflow::Shard(worker_threads.num_threads,
-                        worker_threads.workers,
-                        batch_size,
-                        cost,
-                        update_grads_for_batches);
+      ::tensorflow::Shard(worker_threads.num_threads,
+                          worker_threads.workers,
+                          static_cast<int64>(batch_size) * block_stride,
+                          n_blocks * 10,
+                          reduce_blocks);
+    }
   }
 };
 
@@ -1062,7 +1287,10 @@ class RenderSpritesGradOp : public ::tensorflow::OpKernel {
           .TypeConstraint<TYPE>("T"),        \
       RenderSpritesGradOp<CPUDevice, TYPE>);
 
-// TF_CALL_half(REGISTER);
+#if !GOOGLE_CUDA  // see ops/render_sprites_ops.cc
+TF_CALL_half(REGISTER);
+TF_CALL_bfloat16(REGISTER);
+#endif
 // TF_CALL_double(REGISTER);
 TF_CALL_float(REGISTER);
 #undef REGISTER
@@ -21,6 +21,14 @@ namespace tensorflow {
 using ::tensorflow::shape_inference::InferenceContext;
 using ::tensorflow::shape_inference::ShapeHandle;
 
+// The GPU kernels only support float, so a GPU build only accepts float. half and bfloat16 are
+// accepted by the CPU-only build, and render_sprites_ops.py casts them to float for a GPU build.
+#if GOOGLE_CUDA
+#define RENDER_SPRITES_TYPES "T: {float}"
+#else
+#define RENDER_SPRITES_TYPES "T: {half, bfloat16, float}"
+#endif
+
 REGISTER_OP("RenderSprites")
     .Input("sprites: T")
     .Input("n_sprites: int32")
@@ -30,8 +38,7 @@ REGISTER_OP("RenderSprites")
 
     .Output("output: T")
 
-    .Attr("T: {float}")
-    // .Attr("T: {half, float, double}")
+    .Attr(RENDER_SPRITES_TYPES)
 
     .SetShapeFn([](InferenceContext* c) {
       ShapeHandle sprites;
@@ -65,8 +72,7 @@ REGISTER_OP("RenderSpritesGrad")
     .Output("grad_offsets: T")
     .Output("grad_backgrounds: T")
 
-    .Attr("T: {float}")
-    // .Attr("T: {half, float, double}")
+    .Attr(RENDER_SPRITES_TYPES)
 
     .SetShapeFn([](InferenceContext* c) {
       ShapeHandle sprites;
@@ -21,31 +21,185 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import traceback
 
 import tensorflow as tf
 from tensorflow.python.framework import ops
 
+from auto_yolo.tf_ops import load_op_library, supported_dtypes
+
 _render_sprites_so = None
+_lib_avail = None
 
 
 def render_sprites_so():
     global _render_sprites_so
     if _render_sprites_so is None:
-        loc = os.path.join(os.path.split(__file__)[0], "_render_sprites.so")
-        print("\nLoading render_sprites library at {}.".format(loc))
-        _render_sprites_so = tf.load_op_library(loc)
-        print("Success.\n")
+        _render_sprites_so = load_op_library("render_sprites", os.path.split(__file__)[0])
 
     return _render_sprites_so
 
 
 def lib_avail():
-    so = render_sprites_so()
-    return so is not None
+    global _lib_avail
+    if _lib_avail is None:
+        try:
+            render_sprites_so()
+            _lib_avail = True
+        except (IOError, tf.errors.NotFoundError) as e:
+            print("render_sprites library not available, using the pure-TensorFlow implementation ({})".format(e))
+            _lib_avail = False
+    return _lib_avail
+
+
+def _interpolation_weights(coords, size):
+  """ Bilinear interpolation weights for sampling along one axis of a sprite.
+
+  Args:
+    coords: Tensor of shape `[..., n_pixels]`, giving locations in the sprite's co-ordinate frame.
+    size: Size of the sprite along the axis.
+
+  Returns:
+    Tensor of shape `[..., n_pixels, size]`. Weights for locations that fall off the sprite are 0.
+  """
+  floor = tf.floor(coords)
+  d = floor + 1 - coords
+
+  # Clip so that the cast is safe for pixels far from the sprite; those get all-zero weights anyway.
+  floor_idx = tf.to_int32(tf.clip_by_value(floor, -2, tf.cast(size, coords.dtype)))
+
+  return (
+    d[..., None] * tf.one_hot(floor_idx, size, dtype=coords.dtype) +
+    (1 - d)[..., None] * tf.one_hot(floor_idx + 1, size, dtype=coords.dtype))
+
+
+def render_sprites_tf(sprites, n_sprites, scales, offsets, backgrounds, name="render_sprites_tf"):
+  """ Pure-TensorFlow implementation of `render_sprites`.
+
+  Computes the same output as the compiled op, and (through automatic differentiation) the same
+  gradients. Used automatically when the compiled library is not available, and as a reference
+  against which to check and benchmark the kernels.
+
+  Every sprite is sampled at every pixel of the image, so memory use is proportional to
+  `batch_size * n_sprites * output_height * output_width * n_channels`.
+
+  Sampling is separable: for each sprite, the rows of the image depend only on the sprite's y
+  scale and offset, and the columns only on its x scale and offset. So bilinear sampling is done
+  with two batched matrix multiplications by per-axis weight matrices, rather than by gathering.
+  """
+  with ops.name_scope(name, "render_sprites_tf", [sprites, n_sprites, scales, offsets, backgrounds]):
+    sprites = ops.convert_to_tensor(sprites, name="sprites")
+    n_sprites = ops.convert_to_tensor(n_sprites, dtype=tf.int32, name="n_sprites")
+    scales = tf.cast(ops.convert_to_tensor(scales, name="scales"), sprites.dtype)
+    offsets = tf.cast(ops.convert_to_tensor(offsets, name="offsets"), sprites.dtype)
+    backgrounds = tf.cast(ops.convert_to_tensor(backgrounds, name="backgrounds"), sprites.dtype)
+
+    dtype = sprites.dtype
+
+    batch_size, max_sprites, sprite_height, sprite_width, sprite_channels = tf.unstack(tf.shape(sprites))
+    _, img_height, img_width, n_channels = tf.unstack(tf.shape(backgrounds))
+
+    sprite_height_f = tf.cast(sprite_height, dtype)
+    sprite_width_f = tf.cast(sprite_width, dtype)
+    img_height_f = tf.cast(img_height, dtype)
+    img_width_f = tf.cast(img_width, dtype)
+
+    scale_y, scale_x = scales[..., 0:1], scales[..., 1:2]
+    offset_y, offset_x = offsets[..., 0:1], offsets[..., 1:2]
+
+    img_y = tf.cast(tf.range(img_height), dtype)
+    img_x = tf.cast(tf.range(img_width), dtype)
+
+    # --- which pixels each sprite affects, shape (batch_size, max_sprites, img_height, img_width) ---
+
+    top = -0.5 + img_height_f * (-0.5 * scale_y / sprite_height_f + offset_y)
+    bottom = -0.5 + img_height_f * ((sprite_height_f + 0.5) * scale_y / sprite_height_f + offset_y)
+    left = -0.5 + img_width_f * (-0.5 * scale_x / sprite_width_f + offset_x)
+    right = -0.5 + img_width_f * ((sprite_width_f + 0.5) * scale_x / sprite_width_f + offset_x)
+
+    row_mask = tf.logical_and(img_y >= top, img_y <= bottom)
+    col_mask = tf.logical_and(img_x >= left, img_x <= right)
+    sprite_mask = tf.sequence_mask(n_sprites, max_sprites)
+
+    mask = tf.logical_and(
+      tf.logical_and(row_mask[..., :, None], col_mask[..., None, :]),
+      sprite_mask[..., None, None])
+    mask = tf.cast(mask, dtype)
 
+    # --- sample every sprite at every pixel ---
 
-def render_sprites(sprites, n_sprites, scales, offsets, backgrounds, name="render_sprites"):
+    # The pixel locations represented in the sprites' co-ordinate frames
+    y = -0.5 + sprite_height_f * ((img_y + 0.5) / img_height_f - offset_y) / scale_y
+    x = -0.5 + sprite_width_f * ((img_x + 0.5) / img_width_f - offset_x) / scale_x
+
+    weights_y = _interpolation_weights(y, sprite_height)  # (B, N, img_height, sprite_height)
+    weights_x = _interpolation_weights(x, sprite_width)  # (B, N, img_width, sprite_width)
+
+    _sprites = tf.reshape(sprites, (batch_size, max_sprites, sprite_height, sprite_width * sprite_channels))
+    sampled = tf.matmul(weights_y, _sprites)
+    sampled = tf.reshape(sampled, (batch_size, max_sprites, img_height * sprite_width, sprite_channels))
+
+    sampled = tf.reshape(
+      tf.transpose(sampled, (0, 1, 3, 2)),
+      (batch_size, max_sprites, sprite_channels * img_height, sprite_width))
+    sampled = tf.matmul(sampled, weights_x, transpose_b=True)
+    sampled = tf.reshape(sampled, (batch_size, max_sprites, sprite_channels, img_height, img_width))
+    sampled = tf.transpose(sampled, (0, 1, 3, 4, 2))  # (B, N, img_height, img_width, n_channels + 2)
+
+    # Total weight of the sprite pixels used for each image pixel; the rest of the
+    # weight goes to the background, like the kernel's out-of-range reads.
+    coverage = (
+      tf.reduce_sum(weights_y, axis=-1)[..., :, None] *
+      tf.reduce_sum(weights_x, axis=-1)[..., None, :])
+
+    _backgrounds = backgrounds[:, None]
+    colour = sampled[..., :-2] + (1 - coverage[..., None]) * tf.stop_gradient(_backgrounds)
+    alpha = sampled[..., -2:-1]
+    importance = sampled[..., -1:]
+
+    value = alpha * colour + (1 - alpha) * _backgrounds
+
+    # --- composite ---
+
+    mask = mask[..., None]
+    n_writes = tf.zeros_like(backgrounds) + tf.reduce_sum(mask, axis=1)
+
+    single = tf.reduce_sum(mask * value, axis=1)
+
+    importance_sum = tf.zeros_like(backgrounds) + tf.reduce_sum(mask * importance, axis=1)
+    importance_sum = tf.where(n_writes > 1, importance_sum, tf.ones_like(importance_sum))
+    weighted = tf.reduce_sum(mask * importance * value, axis=1) / importance_sum
+
+    return tf.where(
+      tf.equal(n_writes, 0), backgrounds,
+      tf.where(tf.equal(n_writes, 1), single, weighted))
+
+
+def _compact_active_sprites(active, n_sprites, sprites, scales, offsets):
+  """ Move the active sprites of each image to the front of its list of sprites, preserving their order.
+
+  Returns the reordered sprites, scales and offsets, and the number of active sprites in each image.
+  """
+  max_sprites = tf.shape(active)[1]
+
+  active = tf.logical_and(active, tf.sequence_mask(n_sprites, max_sprites))
+  new_n_sprites = tf.reduce_sum(tf.to_int32(active), axis=1)
+
+  # Sort key puts active sprites first, and otherwise preserves the original order.
+  sprite_idx = tf.zeros_like(active, dtype=tf.int32) + tf.range(max_sprites)[None, :]
+  key = tf.where(active, sprite_idx, sprite_idx + max_sprites)
+  _, order = tf.nn.top_k(-key, k=max_sprites, sorted=True)
+
+  batch_idx = tf.zeros_like(order) + tf.range(tf.shape(order)[0])[:, None]
+  indices = tf.stack([batch_idx, order], axis=2)
+
+  return (
+    tf.gather_nd(sprites, indices),
+    tf.gather_nd(scales, indices),
+    tf.gather_nd(offsets, indices),
+    new_n_sprites)
+
+
+def render_sprites(sprites, n_sprites, scales, offsets, backgrounds, active=None, name="render_sprites"):
   """ Render a scene composed of sprites on top of a background.
 
   Currently only supports bilinear interpolation.
@@ -55,7 +209,10 @@ def render_sprites(sprites, n_sprites, scales, offsets, backgrounds, name="rende
 
   Args:
     sprites: Tensor of shape `[batch_size, n_sprites, sprite_height, sprite_width, n_channels+1]`
-      The final channel is priority channel and must be > 0.
+      The final channel is priority channel and must be > 0. May be float32, float16 or bfloat16;
+      the CPU kernels do their arithmetic in float32 regardless. `scales`, `offsets` and
+      `backgrounds` are cast to the dtype of `sprites`. A GPU build of the library has no
+      float16 or bfloat16 kernels, so with one the op runs in float32 and the output is cast back.
     n_sprites: Tensor of shape `[batch_size,]`
       i-th entry gives number of active sprites for the i-th image (the first i sprites are used)
     scales: Tensor of shape `[batch_size, n_sprites, 2]`
@@ -64,22 +221,40 @@ def render_sprites(sprites, n_sprites, scales, offsets, backgrounds, name="rende
       Amount to offset sprites by. Order is y, x.
     backgrounds: Tensor of shape `[batch_size, output_height, output_width, n_channels]`
       The background for each image.
+    active: Optional boolean Tensor of shape `[batch_size, n_sprites]`
+      If supplied, only sprites for which `active` is True are rendered; the rest are
+      dropped before the kernel builds its pixel-to-sprite index, and receive zero gradient.
     name: Optional name of the op.
 
   Returns:
     Tensor giving the stitched images. Shape is
     `[batch_size, output_height, output_width, n_channels]`, same as `backgrounds`.
 
-  Raises:
-    ImportError: if the wrapper generated during compilation is not present when
-    the function is called.
+  If the compiled library is not available, falls back to `render_sprites_tf`.
   """
   with ops.name_scope(name, "render_sprites", [sprites, n_sprites, scales, offsets, backgrounds]):
     sprites_tensor = ops.convert_to_tensor(sprites, name="sprites")
     n_sprites_tensor = ops.convert_to_tensor(n_sprites, dtype=tf.int32, name="n_sprites")
-    scales_tensor = ops.convert_to_tensor(scales, name="scales")
-    offsets_tensor = ops.convert_to_tensor(offsets, name="offsets")
-    backgrounds_tensor = ops.convert_to_tensor(backgrounds, name="backgrounds")
+    scales_tensor = tf.cast(ops.convert_to_tensor(scales, name="scales"), sprites_tensor.dtype)
+    offsets_tensor = tf.cast(ops.convert_to_tensor(offsets, name="offsets"), sprites_tensor.dtype)
+    backgrounds_tensor = tf.cast(ops.convert_to_tensor(backgrounds, name="backgrounds"), sprites_tensor.dtype)
+
+    if active is not None:
+      active_tensor = ops.convert_to_tensor(active, dtype=tf.bool, name="active")
+      sprites_tensor, scales_tensor, offsets_tensor, n_sprites_tensor = _compact_active_sprites(
+        active_tensor, n_sprites_tensor, sprites_tensor, scales_tensor, offsets_tensor)
+
+    if not lib_avail():
+      return render_sprites_tf(
+        sprites_tensor, n_sprites_tensor, scales_tensor, offsets_tensor, backgrounds_tensor)
+
+    dtype = sprites_tensor.dtype
+    if dtype not in supported_dtypes(render_sprites_so(), "RenderSprites"):
+      output = render_sprites_so().render_sprites(
+        tf.cast(sprites_tensor, tf.float32), n_sprites_tensor, tf.cast(scales_tensor, tf.float32),
+        tf.cast(offsets_tensor, tf.float32), tf.cast(backgrounds_tensor, tf.float32))
+      return tf.cast(output, dtype)
+
     return render_sprites_so().render_sprites(
       sprites_tensor, n_sprites_tensor, scales_tensor, offsets_tensor, backgrounds_tensor)
 
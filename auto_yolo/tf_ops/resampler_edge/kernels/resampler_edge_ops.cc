@@ -20,6 +20,8 @@
 #include <algorithm>
 #include <cmath>
 #include <memory>
+#include <type_traits>
+#include <vector>
 
 #include "tensorflow/core/framework/op_kernel.h"
 #include "tensorflow/core/framework/register_types.h"
@@ -35,6 +37,18 @@ using GPUDevice = Eigen::GpuDevice;
 
 namespace functor {
 
+// Type in which the CPU kernels do their arithmetic. Reduced-precision inputs
+// are widened to float, so that interpolation and gradient accumulation don't
+// lose precision.
+template <typename T>
+struct AccumulatorType { typedef T type; };
+
+template <>
+struct AccumulatorType<Eigen::half> { typedef float type; };
+
+template <>
+struct AccumulatorType<bfloat16> { typedef float type; };
+
 template <typename T>
 struct ResamplerEdge2DFunctor<CPUDevice, T> {
   void operator()(::tensorflow::OpKernelContext* ctx, const CPUDevice& d,
@@ -42,14 +56,16 @@ struct ResamplerEdge2DFunctor<CPUDevice, T> {
                   T* __restrict__ output, const int batch_size,
                   const int data_height, const int data_width,
                   const int data_channels, const int num_sampling_points) {
+    typedef typename AccumulatorType<T>::type A;
+
     const int warp_batch_stride = num_sampling_points * 2;
     const int data_batch_stride = data_height * data_width * data_channels;
     const int output_batch_stride = num_sampling_points * data_channels;
-    const T zero = static_cast<T>(0.0);
-    const T one = static_cast<T>(1.0);
+    const A zero = static_cast<A>(0.0);
+    const A one = static_cast<A>(1.0);
 
-    const T hi_x = static_cast<T>(data_width-1);
-    const T hi_y = static_cast<T>(data_height-1);
+    const A hi_x = static_cast<A>(data_width-1);
+    const A hi_y = static_cast<A>(data_height-1);
 
     auto resample_batches = [&](const int start, const int limit) {
       for (int batch_id = start; batch_id < limit; ++batch_id) {
@@ -58,38 +74,38 @@ struct ResamplerEdge2DFunctor<CPUDevice, T> {
         // arithmetics abstracting away the low level details in the
         // main loop over samples. Note that data is stored in NHWC format.
         auto set_output = [&](const int sample_id, const int channel,
-                              const T value) {
+                              const A value) {
           output[batch_id * output_batch_stride + sample_id * data_channels +
-                 channel] = value;
+                 channel] = static_cast<T>(value);
         };
 
         auto get_data_point = [&](const int x, const int y, const int chan) {
           const bool point_is_in_range =
               (x >= 0 && y >= 0 && x <= data_width - 1 && y <= data_height - 1);
           return point_is_in_range
-                     ? data[batch_id * data_batch_stride +
-                            data_channels * (y * data_width + x) + chan]
+                     ? static_cast<A>(data[batch_id * data_batch_stride +
+                                           data_channels * (y * data_width + x) + chan])
                      : zero;
         };
 
         for (int sample_id = 0; sample_id < num_sampling_points; ++sample_id) {
-          const T x = std::min(std::max(warp[batch_id * warp_batch_stride + sample_id * 2], zero), hi_x);
-          const T y = std::min(std::max(warp[batch_id * warp_batch_stride + sample_id * 2 + 1], zero), hi_y);
+          const A x = std::min(std::max(static_cast<A>(warp[batch_id * warp_batch_stride + sample_id * 2]), zero), hi_x);
+          const A y = std::min(std::max(static_cast<A>(warp[batch_id * warp_batch_stride + sample_id * 2 + 1]), zero), hi_y);
 
           // Precompute floor (f) and ceil (c) values for x and y.
           const int fx = std::floor(static_cast<float>(x));
           const int fy = std::floor(static_cast<float>(y));
           const int cx = fx + 1;
           const int cy = fy + 1;
-          const T dx = static_cast<T>(cx) - x;
-          const T dy = static_cast<T>(cy) - y;
+          const A dx = static_cast<A>(cx) - x;
+          const A dy = static_cast<A>(cy) - y;
 
           for (int chan = 0; chan < data_channels; ++chan) {
-            const T img_fxfy = dx * dy * get_data_point(fx, fy, chan);
-            const T img_cxcy =
+            const A img_fxfy = dx * dy * get_data_point(fx, fy, chan);
+            const A img_cxcy =
                 (one - dx) * (one - dy) * get_data_point(cx, cy, chan);
-            const T img_fxcy = dx * (one - dy) * get_data_point(fx, cy, chan);
-            const T img_cxfy = (one - dx) * dy * get_data_point(cx, fy, chan);
+            const A img_fxcy = dx * (one - dy) * get_data_point(fx, cy, chan);
+            const A img_cxfy = (one - dx) * dy * get_data_point(cx, fy, chan);
             set_output(sample_id, chan,
                        img_fxfy + img_cxcy + img_fxcy + img_cxfy);
           }
@@ -173,7 +189,10 @@ class ResamplerEdgeOp : public ::tensorflow::OpKernel {
       Name("ResamplerEdge").Device(DEVICE_CPU).TypeConstraint<TYPE>("T"), \
       ResamplerEdgeOp<CPUDevice, TYPE>);
 
+#if !GOOGLE_CUDA  // see ops/resampler_edge_ops.cc
 TF_CALL_half(REGISTER);
+TF_CALL_bfloat16(REGISTER);
+#endif
 TF_CALL_float(REGISTER);
 TF_CALL_double(REGISTER);
 #undef REGISTER
@@ -198,6 +217,8 @@ struct ResamplerEdgeGrad2DFunctor<CPUDevice, T> {
                   T* __restrict__ grad_warp, const int batch_size,
                   const int data_height, const int data_width,
                   const int data_channels, const int num_sampling_points) {
+    typedef typename AccumulatorType<T>::type A;
+
     // Set gradients to 0, because the kernel incrementally updates the
     // tensor entries by adding partial contributions.
     const int resampler_edge_output_size =
@@ -211,14 +232,31 @@ struct ResamplerEdgeGrad2DFunctor<CPUDevice, T> {
     const auto&& data_batch_stride = data_height * data_width * data_channels;
     const auto&& warp_batch_stride = num_sampling_points * 2;
     const int output_batch_stride = num_sampling_points * data_channels;
-    const T zero = static_cast<T>(0.0);
-    const T one = static_cast<T>(1.0);
+    const A zero = static_cast<A>(0.0);
+    const A one = static_cast<A>(1.0);
 
-    const T hi_x = static_cast<T>(data_width-1);
-    const T hi_y = static_cast<T>(data_height-1);
+    const A hi_x = static_cast<A>(data_width-1);
+    const A hi_y = static_cast<A>(data_height-1);
 
     auto update_grads_for_batches = [&](const int start, const int limit) {
+      // Unless T is its own accumulation type, the gradients for each batch
+      // entry are accumulated in these buffers and then converted to T.
+      std::vector<A> grad_data_acc;
+      std::vector<A> grad_warp_acc;
+
       for (int batch_id = start; batch_id < limit; ++batch_id) {
+        A* __restrict__ g_data;
+        A* __restrict__ g_warp;
+        if (std::is_same<T, A>::value) {
+          g_data = reinterpret_cast<A*>(grad_data + batch_id * data_batch_stride);
+          g_warp = reinterpret_cast<A*>(grad_warp + batch_id * warp_batch_stride);
+        } else {
+          grad_data_acc.assign(data_batch_stride, zero);
+          grad_warp_acc.assign(warp_batch_stride, zero);
+          g_data = grad_data_acc.data();
+          g_warp = grad_warp_acc.data();
+        }
+
         // Utility lambdas to access data and update gradient tensors.
         // The functions take care of performing the relevant pointer
         // arithmetics abstracting away the low level details in the
@@ -227,47 +265,45 @@ struct ResamplerEdgeGrad2DFunctor<CPUDevice, T> {
           const bool point_is_in_range =
               (x >= 0 && y >= 0 && x <= data_width - 1 && y <= data_height - 1);
           return point_is_in_range
-                     ? data[batch_id * data_batch_stride +
-                            data_channels * (y * data_width + x) + chan]
+                     ? static_cast<A>(data[batch_id * data_batch_stride +
+                                           data_channels * (y * data_width + x) + chan])
                      : zero;
         };
 
         auto update_grad_data = [&](const int x, const int y, const int chan,
-                                    const T value) {
+                                    const A value) {
           const bool point_is_in_range =
               (x >= 0 && y >= 0 && x <= data_width - 1 && y <= data_height - 1);
           if (point_is_in_range) {
-            grad_data[batch_id * data_batch_stride +
-                      data_channels * (y * data_width + x) + chan] += value;
+            g_data[data_channels * (y * data_width + x) + chan] += value;
           }
         };
 
         auto update_grad_warp = [&](const int sample_id, const int channel,
-                                    const T value) {
-          grad_warp[batch_id * warp_batch_stride + sample_id * 2 + channel] +=
-              value;
+                                    const A value) {
+          g_warp[sample_id * 2 + channel] += value;
         };
 
         for (int sample_id = 0; sample_id < num_sampling_points; ++sample_id) {
-          const T x = std::min(std::max(warp[batch_id * warp_batch_stride + sample_id * 2], zero), hi_x);
-          const T y = std::min(std::max(warp[batch_id * warp_batch_stride + sample_id * 2 + 1], zero), hi_y);
+          const A x = std::min(std::max(static_cast<A>(warp[batch_id * warp_batch_stride + sample_id * 2]), zero), hi_x);
+          const A y = std::min(std::max(static_cast<A>(warp[batch_id * warp_batch_stride + sample_id * 2 + 1]), zero), hi_y);
 
           // Precompute floor (f) and ceil (c) values for x and y.
           const int fx = std::floor(static_cast<float>(x));
           const int fy = std::floor(static_cast<float>(y));
           const int cx = fx + 1;
           const int cy = fy + 1;
-          const T dx = static_cast<T>(cx) - x;
-          const T dy = static_cast<T>(cy) - y;
+          const A dx = static_cast<A>(cx) - x;
+          const A dy = static_cast<A>(cy) - y;
 
           for (int chan = 0; chan < data_channels; ++chan) {
-            const T grad_output_value =
-                grad_output[batch_id * output_batch_stride +
-                            sample_id * data_channels + chan];
-            const T img_fxfy = get_data_point(fx, fy, chan);
-            const T img_cxcy = get_data_point(cx, cy, chan);
-            const T img_fxcy = get_data_point(fx, cy, chan);
-            const T img_cxfy = get_data_point(cx, fy, chan);
+            const A grad_output_value =
+                static_cast<A>(grad_output[batch_id * output_batch_stride +
+                                           sample_id * data_channels + chan]);
+            const A img_fxfy = get_data_point(fx, fy, chan);
+            const A img_cxcy = get_data_point(cx, cy, chan);
+            const A img_fxcy = get_data_point(fx, cy, chan);
+            const A img_cxfy = get_data_point(cx, fy, chan);
 
             // Update partial gradients wrt relevant warp field entries
             update_grad_warp(
@@ -290,6 +326,15 @@ struct ResamplerEdgeGrad2DFunctor<CPUDevice, T> {
                              grad_output_value * (one - dx) * dy);
           }
         }
+
+        if (!std::is_same<T, A>::value) {
+          for (int i = 0; i < data_batch_stride; ++i) {
+            grad_data[batch_id * data_batch_stride + i] = static_cast<T>(g_data[i]);
+          }
+          for (int i = 0; i < warp_batch_stride; ++i) {
+            grad_warp[batch_id * warp_batch_stride + i] = static_cast<T>(g_warp[i]);
+          }
+        }
       }
     };
     // Rough estimate of work for each batch entry.
@@ -377,7 +422,10 @@ class ResamplerEdgeGradOp : public ::tensorflow::OpKernel {
       Name("ResamplerEdgeGrad").Device(DEVICE_CPU).TypeConstraint<TYPE>("T"), \
       ResamplerEdgeGradOp<CPUDevice, TYPE>);
 
+#if !GOOGLE_CUDA  // see ops/resampler_edge_ops.cc
 TF_CALL_half(REGISTER);
+TF_CALL_bfloat16(REGISTER);
+#endif
 TF_CALL_float(REGISTER);
 TF_CALL_double(REGISTER);
 #undef REGISTER
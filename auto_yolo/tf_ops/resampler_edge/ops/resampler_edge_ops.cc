@@ -21,11 +21,19 @@ namespace tensorflow {
 using ::tensorflow::shape_inference::InferenceContext;
 using ::tensorflow::shape_inference::ShapeHandle;
 
+// The GPU kernels don't support half or bfloat16, so a GPU build doesn't accept them. They are
+// accepted by the CPU-only build, and resampler_edge_ops.py casts them to float for a GPU build.
+#if GOOGLE_CUDA
+#define RESAMPLER_EDGE_TYPES "T: {float, double}"
+#else
+#define RESAMPLER_EDGE_TYPES "T: {half, bfloat16, float, double}"
+#endif
+
 REGISTER_OP("ResamplerEdge")
     .Input("data: T")
     .Input("warp: T")
     .Output("output: T")
-    .Attr("T: {half, float, double}")
+    .Attr(RESAMPLER_EDGE_TYPES)
     .SetShapeFn([](InferenceContext* c) {
       ShapeHandle data;
       ShapeHandle warp;
@@ -48,7 +56,7 @@ REGISTER_OP("ResamplerEdgeGrad")
     .Input("grad_output: T")
     .Output("grad_data: T")
     .Output("grad_warp: T")
-    .Attr("T: {half, float, double}")
+    .Attr(RESAMPLER_EDGE_TYPES)
     .SetShapeFn([](InferenceContext* c) {
       c->set_output(0, c->input(0));
       c->set_output(1, c->input(1));
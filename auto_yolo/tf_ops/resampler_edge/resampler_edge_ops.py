@@ -26,16 +26,15 @@ import traceback
 import tensorflow as tf
 from tensorflow.python.framework import ops
 
+from auto_yolo.tf_ops import load_op_library, supported_dtypes
+
 _resampler_edge_so = None
 
 
 def resampler_edge_so():
     global _resampler_edge_so
     if _resampler_edge_so is None:
-        loc = os.path.join(os.path.split(__file__)[0], "_resampler_edge.so")
-        print("\nLoading resampler_edge library at {}.".format(loc))
-        _resampler_edge_so = tf.load_op_library(loc)
-        print("Success.\n")
+        _resampler_edge_so = load_op_library("resampler_edge", os.path.split(__file__)[0])
     return _resampler_edge_so
 
 
@@ -51,10 +50,15 @@ def resampler_edge(data, warp, name="resampler_edge"):
 
   Args:
     data: Tensor of shape `[batch_size, data_height, data_width,
-      data_num_channels]` containing 2D data that will be resampled.
+      data_num_channels]` containing 2D data that will be resampled. May be
+      float16, bfloat16, float32 or float64; the CPU kernels do their
+      arithmetic in float32 for the reduced-precision types. A GPU build of
+      the library has no float16 or bfloat16 kernels, so with one the op runs
+      in float32 and the output is cast back.
     warp: Tensor of minimum rank 2 containing the coordinates at which
       resampling will be performed. Since only bilinear interpolation is
       currently supported, the last dimension of the `warp` tensor must be 2.
+      Cast to the dtype of `data`.
     name: Optional name of the op.
 
   Returns:
@@ -70,7 +74,14 @@ def resampler_edge(data, warp, name="resampler_edge"):
   """
   with ops.name_scope(name, "resampler_edge", [data, warp]):
     data_tensor = ops.convert_to_tensor(data, name="data")
-    warp_tensor = ops.convert_to_tensor(warp, name="warp")
+    warp_tensor = tf.cast(ops.convert_to_tensor(warp, name="warp"), data_tensor.dtype)
+
+    dtype = data_tensor.dtype
+    if dtype not in supported_dtypes(resampler_edge_so(), "ResamplerEdge"):
+      output = resampler_edge_so().resampler_edge(
+        tf.cast(data_tensor, tf.float32), tf.cast(warp_tensor, tf.float32))
+      return tf.cast(output, dtype)
+
     return resampler_edge_so().resampler_edge(data_tensor, warp_tensor)
 
 
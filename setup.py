@@ -5,7 +5,54 @@ except ImportError:
     from ez_setup import use_setuptools
     setuptools = use_setuptools()
 
-from setuptools import find_packages, setup  # noqa: F811
+import os
+
+from setuptools import find_packages, setup, Extension  # noqa: F811
+from setuptools.command.build_ext import build_ext
+
+
+class build_tf_ops(build_ext):
+    """ Builds the CPU-only versions of the custom TensorFlow ops as `_<op>_cpu.so`,
+        the name that `auto_yolo.tf_ops.load_op_library` looks for. """
+
+    def get_ext_filename(self, ext_name):
+        return os.path.join(*ext_name.split('.')) + '.so'
+
+
+def tf_op_extensions():
+    """ CPU-only builds of the custom ops. Set AUTO_YOLO_NATIVE=1 to optimize for the host machine.
+
+    GPU builds still need to be made using the Makefiles in `auto_yolo/tf_ops/<op>`.
+
+    """
+    try:
+        import tensorflow as tf
+    except ImportError:
+        print("TensorFlow not found, not building custom ops.")
+        return []
+
+    compile_args = ['-std=c++11', '-O3'] + tf.sysconfig.get_compile_flags()
+    if os.environ.get('AUTO_YOLO_NATIVE', '0') == '1':
+        compile_args.append('-march=native')
+
+    extensions = []
+    for op in ['render_sprites', 'resampler_edge']:
+        directory = os.path.join('auto_yolo', 'tf_ops', op)
+        extensions.append(
+            Extension(
+                'auto_yolo.tf_ops.{0}._{0}_cpu'.format(op),
+                sources=[
+                    os.path.join(directory, 'ops', '{}_ops.cc'.format(op)),
+                    os.path.join(directory, 'kernels', '{}_ops.cc'.format(op)),
+                ],
+                include_dirs=[os.path.join(directory, 'kernels')],
+                extra_compile_args=compile_args,
+                extra_link_args=tf.sysconfig.get_link_flags(),
+                language='c++',
+            )
+        )
+    return extensions
+
 
 setup(
     name='auto_yolo',
@@ -13,4 +60,6 @@ setup(
     author_email="eric.crawford@mail.mcgill.ca",
     version='0.1',
     packages=find_packages(),
+    ext_modules=tf_op_extensions(),
+    cmdclass={'build_ext': build_tf_ops},
 )
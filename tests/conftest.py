@@ -0,0 +1,9 @@
+import pytest
+
+from tests import utils
+
+
+@pytest.fixture
+def small_config(tmp_path):
+    """ See `tests.utils.small_config`. """
+    return utils.small_config(tmp_path)
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("dps")
+
+from dps.train import training_loop  # noqa: E402
+
+
+def test_render_hook_with_accumulate_steps(small_config):
+    """ Render hooks fetch from `updater.data_manager`, which must keep the val set (and full batches)
+        when training batches are split into micro-batches. """
+    small_config.update(accumulate_steps=2, render_step=1, max_steps=2)
+
+    with small_config:
+        training_loop()
+
+
+
+@pytest.mark.parametrize("accumulate_steps", [1, 2])
+def test_update_reads_one_batch_per_micro_batch(small_config, accumulate_steps):
+    """ Each update takes exactly `accumulate_steps` batches from the training iterator: applying the
+        gradients must not pull another batch. """
+    from dps.train import Hook
+
+    from tests.utils import upstream_ops
+
+    counts = dict(batches=0, updates=0)
+
+    class CountBatches(Hook):
+        def start_stage(self, training_loop, updater, stage_idx):
+            if accumulate_steps > 1:
+                # The gradients are applied in their own `sess.run`, which must not touch the iterator
+                apply_ops = upstream_ops([updater.train_op] + list(updater.train_records.values()))
+                assert not any(op.type.startswith("IteratorGetNext") for op in apply_ops)
+
+            do_train, run_update = updater.train_data_manager.do_train, updater._run_update
+
+            def counted_do_train(*args, **kwargs):
+                counts['batches'] += 1
+                return do_train(*args, **kwargs)
+
+            def counted_run_update(*args, **kwargs):
+                counts['updates'] += 1
+                return run_update(*args, **kwargs)
+
+            updater.train_data_manager.do_train = counted_do_train
+            updater._run_update = counted_run_update
+
+    small_config.update(accumulate_steps=accumulate_steps, render_step=0, max_steps=3, hooks=[CountBatches()])
+
+    with small_config:
+        training_loop()
+
+    assert counts['updates'] > 0
+    assert counts['batches'] == accumulate_steps * counts['updates']
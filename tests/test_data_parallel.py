@@ -0,0 +1,86 @@
+import os
+import socket
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from auto_yolo.models.data_parallel import AllReduce, spawn  # noqa: E402
+
+
+def free_address():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return "localhost:{}".format(s.getsockname()[1])
+
+
+def _all_reduce_worker(rank, address, world_size=2):
+    all_reduce = AllReduce(rank, world_size, address)
+    try:
+        total = all_reduce.sum([np.full(3, rank + 1.0)])
+        assert np.allclose(total[0], sum(range(1, world_size + 1)))
+
+        mean = all_reduce.mean([np.full(3, rank + 1.0)])
+        assert np.allclose(mean[0], sum(range(1, world_size + 1)) / world_size)
+
+        assert all_reduce.broadcast(rank) == 0
+        assert all_reduce.gather(rank) == list(range(world_size))
+    finally:
+        all_reduce.close()
+
+
+class _AllReduceTarget(object):
+    def __init__(self, address):
+        self.address = address
+
+    def __call__(self, rank):
+        _all_reduce_worker(rank, self.address)
+
+
+def test_all_reduce():
+    spawn(_AllReduceTarget(free_address()), 2)
+
+
+class _TrainTarget(object):
+    """ Train for a few steps as one of two data-parallel workers, and save the trainable variables. """
+
+    def __init__(self, address, experiments_dir, out_dir):
+        self.address = address
+        self.experiments_dir = experiments_dir
+        self.out_dir = out_dir
+
+    def __call__(self, rank):
+        import tensorflow as tf
+        from dps.train import training_loop, Hook
+
+        from tests.utils import small_config
+
+        out_path = os.path.join(self.out_dir, "variables_{}.npz".format(rank))
+
+        class SaveVariables(Hook):
+            def end_stage(self, training_loop, updater, stage_idx):
+                sess = tf.get_default_session()
+                variables = sorted(tf.trainable_variables(), key=lambda v: v.name)
+                np.savez(out_path, **{v.name: value for v, value in zip(variables, sess.run(variables))})
+
+        config = small_config(
+            self.experiments_dir, exp_name="rank={}".format(rank), max_steps=4, render_step=0,
+            data_parallel_workers=2, data_parallel_rank=rank, data_parallel_address=self.address,
+            hooks=[SaveVariables()])
+
+        with config:
+            training_loop()
+
+
+def test_variables_stay_identical(tmp_path):
+    """ Two workers on localhost, each with its own experiment directory, end up with the same variables. """
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("dps")
+
+    spawn(_TrainTarget(free_address(), str(tmp_path / "experiments"), str(tmp_path)), 2)
+
+    values = [np.load(str(tmp_path / "variables_{}.npz".format(rank))) for rank in range(2)]
+    assert values[0].files
+    assert sorted(values[0].files) == sorted(values[1].files)
+    for name in values[0].files:
+        np.testing.assert_array_equal(values[0][name], values[1][name], err_msg=name)
@@ -0,0 +1,78 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("dps")
+
+from dps.utils import Config, Param, Parameterized  # noqa: E402
+
+from auto_yolo.models.core import EvalHook  # noqa: E402
+
+
+class FakeDataset(Parameterized):
+    n_examples = Param()
+    min_chars = Param(1)
+    max_chars = Param(3)
+
+    def __init__(self, **kwargs):
+        super(FakeDataset, self).__init__(**kwargs)
+        self.params = (self.min_chars, self.max_chars)
+
+
+class FakeUpdater(object):
+    obs_shape = (8, 8, 3)
+
+    def __init__(self):
+        self.network = object()
+
+
+class FakeEvalHook(EvalHook):
+    """ Records the datasets that evaluation subgraphs are built for, instead of building them. """
+
+    def _build_eval_graph(self, dataset):
+        self.n_builds = getattr(self, "n_builds", 0) + 1
+        return dict(data_manager=dataset)
+
+
+def run_stages(stage_configs, new_graph_per_stage=False):
+    with Config(n_val=4):
+        hook = FakeEvalHook(FakeDataset)
+
+    updater = FakeUpdater()
+    datasets = []
+    graph = tf.Graph()
+
+    for stage_idx, stage_config in enumerate(stage_configs):
+        if new_graph_per_stage:
+            graph = tf.Graph()
+
+        with graph.as_default(), Config(**stage_config):
+            hook.start_stage(None, updater, stage_idx)
+        datasets.append(hook.data_manager)
+
+    return hook, datasets
+
+
+def test_same_params_reuse_dataset_and_subgraph():
+    hook, datasets = run_stages([dict(min_chars=2), dict(min_chars=2)])
+    assert datasets[0] is datasets[1]
+    assert hook.n_builds == 1
+
+
+def test_default_params_are_resolved():
+    """ A stage that leaves a Param at its default shares the dataset of one that sets it to the default. """
+    hook, datasets = run_stages([dict(), dict(min_chars=1, max_chars=3)])
+    assert datasets[0] is datasets[1]
+
+
+def test_different_params_make_new_dataset():
+    hook, datasets = run_stages([dict(min_chars=2), dict(min_chars=3)])
+    assert datasets[0] is not datasets[1]
+    assert datasets[0].params == (2, 3)
+    assert datasets[1].params == (3, 3)
+
+
+def test_new_graph_reuses_dataset_and_drops_subgraphs():
+    hook, datasets = run_stages([dict(min_chars=2), dict(min_chars=2)], new_graph_per_stage=True)
+    assert datasets[0] is datasets[1]
+    assert hook.n_builds == 2
+    assert len(hook._built) == 1
@@ -0,0 +1,97 @@
+""" Check that evaluating several datasets in one pass (as `MultiEvalHook` does) gives each dataset its own AP.
+
+Builds two datasets whose true APs differ (one whose predictions are close to the ground truth, one whose
+predictions are random), evaluates both together with `Evaluator.run_many`, using a single `AP` object shared
+by both evaluators as the networks' `eval_funcs` are, and compares the AP reported for each dataset with
+`mAP` computed directly on that dataset.
+
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("dps")
+
+from auto_yolo.models.core import AP, Evaluator, mAP  # noqa: E402
+
+
+def random_dataset(n_batches, batch_size, noise, seed, image_size=48, max_boxes=5):
+    """ Returns a list of batches, and the predicted and ground truth boxes of every image in the format of `mAP`.
+
+    Predicted boxes are the ground truth boxes perturbed by `noise` (relative to the size of each box), or
+    random boxes if `noise` is None, with random confidences.
+
+    """
+    rng = np.random.RandomState(seed)
+    batches, all_pred, all_gt = [], [], []
+
+    def random_box():
+        y, x = rng.uniform(0, image_size - 16, 2)
+        h, w = rng.uniform(4, 16, 2)
+        return [y, y+h, x, x+w]
+
+    for _ in range(n_batches):
+        annotations = np.zeros((batch_size, max_boxes, 6))
+        pred_boxes = []
+        pred_splits = [0]
+
+        for i in range(batch_size):
+            gt = [random_box() for _ in range(rng.randint(1, max_boxes+1))]
+            annotations[i, :len(gt)] = [[1, 0, *box] for box in gt]
+
+            if noise is None:
+                pred = [random_box() for _ in range(len(gt))]
+            else:
+                pred = [
+                    [y0 + noise * (y1 - y0) * rng.randn(), y1 + noise * (y1 - y0) * rng.randn(),
+                     x0 + noise * (x1 - x0) * rng.randn(), x1 + noise * (x1 - x0) * rng.randn()]
+                    for y0, y1, x0, x1 in gt]
+            pred = [[0, rng.uniform(0.1, 1.0), *box] for box in pred]
+
+            pred_boxes.extend(pred)
+            pred_splits.append(len(pred_boxes))
+
+            all_pred.append(pred)
+            all_gt.append([[0, *box] for box in gt])
+
+        batches.append(dict(
+            predicted_boxes=np.array(pred_boxes, dtype=np.float64).reshape(-1, 6),
+            predicted_box_splits=np.array(pred_splits, dtype=np.int64),
+            annotations=annotations,
+            batch_size=np.int32(batch_size)))
+
+    return batches, all_pred, all_gt
+
+
+def build(batches):
+    output_types = dict(
+        predicted_boxes=tf.float64, predicted_box_splits=tf.int64, annotations=tf.float64, batch_size=tf.int32)
+    output_shapes = dict(
+        predicted_boxes=(None, 6), predicted_box_splits=(None,), annotations=(None, None, 6), batch_size=())
+    dataset = tf.data.Dataset.from_generator(lambda: iter(batches), output_types, output_shapes)
+    return dataset.make_one_shot_iterator().get_next()
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_multi_eval(pipelined, n_batches=5, batch_size=4):
+    datasets = dict(
+        accurate=random_dataset(n_batches, batch_size, noise=0.05, seed=0),
+        random=random_dataset(n_batches, batch_size, noise=None, seed=1),
+    )
+    expected = {name: mAP(pred, gt, 1) for name, (_, pred, gt) in datasets.items()}
+    assert not np.isclose(expected["accurate"], expected["random"]), "check is not informative"
+
+    ap = AP()
+
+    with tf.Graph().as_default(), tf.Session():
+        runs = {}
+        for name, (batches, _, _) in datasets.items():
+            tensors = build(batches)
+            evaluator = Evaluator(dict(AP=ap), tensors, None, pipelined=pipelined)
+            runs[name] = (evaluator, dict(batch_size=tensors["batch_size"]))
+
+        records = Evaluator.run_many(runs, {})
+
+    assert sorted(records) == sorted(datasets)
+    for name, record in records.items():
+        np.testing.assert_allclose(record["AP"], expected[name], rtol=1e-6, err_msg=name)
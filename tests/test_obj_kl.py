@@ -0,0 +1,158 @@
+""" Check the tf.scan implementation of `GridObjectLayer._compute_obj_kl` against the original per-cell loop.
+
+Both are built on the same random inputs, for several grid sizes, batch sizes and priors, and the
+obj KL and its gradients wrt `obj_pre_sigmoid`, `obj_log_odds`, `obj_prob` and the count prior's log
+odds are compared.
+
+"""
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("dps")
+
+from auto_yolo.models.core import concrete_binary_sample_kl, tf_safe_log  # noqa: E402
+from auto_yolo.models.object_layer import GridObjectLayer  # noqa: E402
+
+from tests.utils import assert_close  # noqa: E402
+
+
+def compute_obj_kl_loop(self, tensors):
+    """ The original implementation of `GridObjectLayer._compute_obj_kl`, with a separate set of ops per cell. """
+    obj_kl_tensors = {}
+
+    # --- compute obj_kl ---
+
+    count_support = tf.range(self.HWB+1, dtype=tf.float32)
+
+    if self.count_prior_dist is not None:
+        if self.count_prior_dist is not None:
+            assert len(self.count_prior_dist) == (self.HWB + 1)
+        count_distribution = tf.constant(self.count_prior_dist, dtype=tf.float32)
+    else:
+        count_prior_prob = tf.nn.sigmoid(self.count_prior_log_odds)
+        count_distribution = (1 - count_prior_prob) * (count_prior_prob ** count_support)
+
+    normalizer = tf.reduce_sum(count_distribution)
+    count_distribution = count_distribution / normalizer
+    count_distribution = tf.tile(count_distribution[None, :], (self.batch_size, 1))
+    count_so_far = tf.zeros((self.batch_size, 1), dtype=tf.float32)
+
+    i = 0
+
+    obj_kl = []
+
+    for h, w, b in itertools.product(range(self.H), range(self.W), range(self.B)):
+        p_z_given_Cz = tf.maximum(count_support[None, :] - count_so_far, 0) / (self.HWB - i)
+
+        # Reshape for batch matmul
+        _count_distribution = count_distribution[:, None, :]
+        _p_z_given_Cz = p_z_given_Cz[:, :, None]
+
+        p_z = tf.matmul(_count_distribution, _p_z_given_Cz)[:, :, 0]
+
+        if self.use_concrete_kl:
+            prior_log_odds = tf_safe_log(p_z) - tf_safe_log(1-p_z)
+            _obj_kl = concrete_binary_sample_kl(
+                tensors["obj_pre_sigmoid"][:, h, w, b, :],
+                prior_log_odds, self.obj_concrete_temp,
+                tensors["obj_log_odds"][:, h, w, b, :],
+                self.obj_concrete_temp
+            )
+        else:
+            prob = tensors["obj_prob"][:, h, w, b, :]
+
+            _obj_kl = (
+                prob * (tf_safe_log(prob) - tf_safe_log(p_z))
+                + (1-prob) * (tf_safe_log(1-prob) - tf_safe_log(1-p_z))
+            )
+
+        obj_kl.append(_obj_kl)
+
+        sample = tf.to_float(tensors["obj"][:, h, w, b, :] > 0.5)
+        mult = sample * p_z_given_Cz + (1-sample) * (1-p_z_given_Cz)
+        count_distribution = mult * count_distribution
+        normalizer = tf.reduce_sum(count_distribution, axis=1, keepdims=True)
+        normalizer = tf.maximum(normalizer, 1e-6)
+        count_distribution = count_distribution / normalizer
+
+        count_so_far += sample
+
+        i += 1
+
+    if "obj" in self.no_gradient:
+        obj_kl = tf.stop_gradient(obj_kl)
+
+    obj_kl_tensors["obj_kl"] = tf.reshape(
+        tf.concat(obj_kl, axis=1),
+        (self.batch_size, self.H, self.W, self.B, 1))
+
+    return obj_kl_tensors
+
+
+def random_inputs(batch_size, H, W, B, seed=0):
+    rng = np.random.RandomState(seed)
+    shape = (batch_size, H, W, B, 1)
+
+    obj_log_odds = rng.normal(size=shape)
+    obj_pre_sigmoid = obj_log_odds + rng.logistic(size=shape)
+    grad_obj_kl = rng.uniform(-0.5, 0.5, size=shape)
+
+    f = lambda x: x.astype('f')
+    return dict(obj_log_odds=f(obj_log_odds), obj_pre_sigmoid=f(obj_pre_sigmoid), grad_obj_kl=f(grad_obj_kl))
+
+
+def build(compute_obj_kl, inputs, batch_size, H, W, B, use_concrete_kl, count_prior_dist):
+    """ Returns obj_kl and its gradients wrt the inputs and the count prior's log odds. """
+    obj_log_odds = tf.constant(inputs["obj_log_odds"])
+    obj_pre_sigmoid = tf.constant(inputs["obj_pre_sigmoid"])
+    obj_prob = tf.nn.sigmoid(obj_log_odds)
+    count_prior_log_odds = tf.constant(np.log(0.1 / 0.9), dtype=tf.float32)
+
+    tensors = dict(
+        obj_log_odds=obj_log_odds,
+        obj_pre_sigmoid=obj_pre_sigmoid,
+        obj_prob=obj_prob,
+        obj=tf.nn.sigmoid(obj_pre_sigmoid),
+    )
+
+    layer = SimpleNamespace(
+        batch_size=batch_size, H=H, W=W, B=B, HWB=H*W*B,
+        count_prior_dist=count_prior_dist, count_prior_log_odds=count_prior_log_odds,
+        use_concrete_kl=use_concrete_kl, obj_concrete_temp=tf.constant(1.0), no_gradient=[])
+
+    obj_kl = compute_obj_kl(layer, tensors)["obj_kl"]
+    xs = [obj_pre_sigmoid, obj_log_odds, obj_prob]
+    if count_prior_dist is None:
+        xs.append(count_prior_log_odds)
+    grads = tf.gradients(obj_kl, xs, grad_ys=inputs["grad_obj_kl"])
+    return [obj_kl] + [g if g is not None else tf.zeros_like(x) for g, x in zip(grads, xs)]
+
+
+configs = [
+    # batch_size, H, W, B
+    (1, 1, 1, 1),
+    (1, 3, 2, 1),
+    (4, 3, 2, 1),
+    (4, 2, 2, 2),
+    (8, 6, 6, 1),
+]
+
+
+@pytest.mark.parametrize("use_concrete_kl", [True, False])
+@pytest.mark.parametrize("use_count_prior_dist", [False, True])
+@pytest.mark.parametrize("batch_size, H, W, B", configs)
+def test_obj_kl(batch_size, H, W, B, use_concrete_kl, use_count_prior_dist, rtol=1e-4):
+    names = ["obj_kl", "grad_obj_pre_sigmoid", "grad_obj_log_odds", "grad_obj_prob", "grad_count_prior_log_odds"]
+    inputs = random_inputs(batch_size, H, W, B)
+    count_prior_dist = list(np.linspace(1.0, 0.1, H * W * B + 1)) if use_count_prior_dist else None
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        args = (inputs, batch_size, H, W, B, use_concrete_kl, count_prior_dist)
+        loop_values = sess.run(build(compute_obj_kl_loop, *args))
+        scan_values = sess.run(build(GridObjectLayer._compute_obj_kl, *args))
+
+    assert_close(names, loop_values, scan_values, rtol)
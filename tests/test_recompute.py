@@ -0,0 +1,61 @@
+""" Check the gradients computed by `recompute_gradients` against those computed by `tf.gradients`.
+
+Builds a small YoloAir network for each of the object layer's `sequential_mode`s that support
+recomputation, and computes the gradients of its loss wrt all trainable variables both ways, using
+the checkpoints in the network's outputs. Both sets of gradients are fetched in a single `sess.run`,
+so that they share the random samples drawn in the forward pass.
+
+"""
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("dps")
+
+from dps import cfg  # noqa: E402
+from dps.config import DEFAULT_CONFIG  # noqa: E402
+
+from auto_yolo.algs import yolo_air_config  # noqa: E402
+from auto_yolo.envs import get_env_config  # noqa: E402
+from auto_yolo.models.recompute import recompute_gradients  # noqa: E402
+
+from tests.utils import assert_close  # noqa: E402
+
+
+@pytest.mark.parametrize("sequential_mode", ["unroll", "wavefront"])
+def test_recompute_gradients(sequential_mode, batch_size=4, image_shape=(48, 48), rtol=1e-4, seed=0):
+    config = DEFAULT_CONFIG.copy()
+    config.update(get_env_config("grid"))
+    config.update(yolo_air_config)
+    config.update(sequential_mode=sequential_mode, batch_size=batch_size, tile_shape=image_shape)
+
+    rng = np.random.RandomState(seed)
+    images = rng.uniform(size=(batch_size, *image_shape, 3)).astype('f')
+
+    with config, tf.Graph().as_default(), tf.Session() as sess:
+        tf.set_random_seed(seed)
+        cfg.prepare_func()
+
+        env = SimpleNamespace(obs_shape=(*image_shape, 3))
+        network = cfg.build_network(env, None, scope="network")
+        outputs = network(dict(image=tf.constant(images)), tf.constant(True))
+        loss = tf.add_n(list(outputs["losses"].values()))
+
+        tvars = tf.trainable_variables()
+        grads = tf.gradients(loss, tvars)
+        recomputed = recompute_gradients(loss, tvars, outputs["checkpoints"])
+
+        missing = [v.name for v, g, r in zip(tvars, grads, recomputed) if (g is None) != (r is None)]
+        assert not missing, "gradient is None for only one of the two: {}".format(missing)
+
+        pairs = [(v, g, r) for v, g, r in zip(tvars, grads, recomputed) if g is not None]
+        assert pairs
+
+        sess.run(tf.global_variables_initializer())
+        values = sess.run([(tf.convert_to_tensor(g), tf.convert_to_tensor(r)) for _, g, r in pairs])
+
+    names = [v.name for v, _, _ in pairs]
+    expected, actual = zip(*values)
+    assert_close(names, expected, actual, rtol)
@@ -0,0 +1,94 @@
+""" Check the compiled render_sprites op against the pure-TensorFlow implementation.
+
+The forward output and the gradients wrt sprites, scales, offsets and backgrounds are compared. Both
+implementations can also be benchmarked:
+
+    python -m tests.test_render_sprites --batch-size=32 --n-sprites=147
+
+"""
+import argparse
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from auto_yolo.tf_ops.render_sprites.render_sprites_ops import (  # noqa: E402
+    lib_avail, render_sprites_so, render_sprites_tf)
+
+from tests.utils import assert_close  # noqa: E402
+
+
+def random_inputs(batch_size, n_sprites, sprite_shape, image_shape, n_channels, seed=0):
+    rng = np.random.RandomState(seed)
+
+    sprites = rng.uniform(size=(batch_size, n_sprites, *sprite_shape, n_channels + 2))
+    sprites[..., -1] += 0.01  # importance must be positive
+    n_sprites = n_sprites - np.arange(batch_size) % 3
+    scales = rng.uniform(0.05, 0.45, size=(batch_size, sprites.shape[1], 2))
+    offsets = rng.uniform(-0.2, 1.0, size=(batch_size, sprites.shape[1], 2))
+    backgrounds = rng.uniform(size=(batch_size, *image_shape, n_channels))
+    grad_output = rng.uniform(-0.5, 0.5, size=backgrounds.shape)
+
+    f = lambda x: x.astype('f')
+    return f(sprites), np.maximum(n_sprites, 0).astype('i'), f(scales), f(offsets), f(backgrounds), f(grad_output)
+
+
+def build(render, inputs):
+    """ Returns the output of `render` and its gradients wrt sprites, scales, offsets and backgrounds. """
+    sprites, n_sprites, scales, offsets, backgrounds, grad_output = [tf.constant(i) for i in inputs]
+    output = render(sprites, n_sprites, scales, offsets, backgrounds)
+    grads = tf.gradients(output, [sprites, scales, offsets, backgrounds], grad_ys=grad_output)
+    return [output] + grads
+
+
+@pytest.mark.skipif("not lib_avail()", reason="render_sprites library has not been built")
+@pytest.mark.parametrize("batch_size, n_sprites, sprite_shape, image_shape, n_channels", [
+    (4, 20, (14, 14), (48, 48), 3),
+    (3, 5, (7, 11), (20, 32), 1),
+])
+def test_render_sprites(batch_size, n_sprites, sprite_shape, image_shape, n_channels, rtol=1e-3):
+    names = ["output", "grad_sprites", "grad_scales", "grad_offsets", "grad_backgrounds"]
+    inputs = random_inputs(batch_size, n_sprites, sprite_shape, image_shape, n_channels)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        op_values = sess.run(build(render_sprites_so().render_sprites, inputs))
+        tf_values = sess.run(build(render_sprites_tf, inputs))
+
+    assert_close(names, tf_values, op_values, rtol)
+
+
+def benchmark(inputs, n_iters):
+    batch_size = inputs[0].shape[0]
+
+    for name, render in [("compiled", render_sprites_so().render_sprites), ("pure tf", render_sprites_tf)]:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            forward = build(render, inputs)
+            train_op = tf.group(*forward)
+
+            for fetch, label in [(forward[0], "forward"), (train_op, "forward + backward")]:
+                sess.run(fetch)  # warm up
+
+                start = time.time()
+                for i in range(n_iters):
+                    sess.run(fetch)
+                duration = (time.time() - start) / n_iters
+
+                print("{:<10} {:<20} {:8.2f} ms/batch {:10.1f} images/s".format(
+                    name, label, 1000 * duration, batch_size / duration))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--n-sprites", type=int, default=20)
+    parser.add_argument("--sprite-shape", type=int, nargs=2, default=(14, 14))
+    parser.add_argument("--image-shape", type=int, nargs=2, default=(48, 48))
+    parser.add_argument("--n-channels", type=int, default=3)
+    parser.add_argument("--n-iters", type=int, default=20)
+    args = parser.parse_args()
+
+    inputs = random_inputs(
+        args.batch_size, args.n_sprites, args.sprite_shape, args.image_shape, args.n_channels)
+    benchmark(inputs, args.n_iters)
@@ -0,0 +1,45 @@
+def small_config(experiments_dir, **kwargs):
+    """ A config for short yolo_air runs on the small grid task, writing experiments to `experiments_dir`.
+
+    Built the way `auto_yolo.envs.run_experiment` builds the config for a local run.
+
+    """
+    from dps.config import DEFAULT_CONFIG
+
+    from auto_yolo.algs import yolo_air_config
+    from auto_yolo.envs import get_env_config
+
+    config = DEFAULT_CONFIG.copy()
+    config.update(get_env_config("grid", image_size="small"))
+    config.update(yolo_air_config)
+    config.update(
+        env_name="test", exp_name="test", local_experiments_dir=str(experiments_dir),
+        use_gpu=False, n_train=32, n_val=8, batch_size=4, tile_shape=(48, 48),
+        max_steps=4, eval_step=2, display_step=2, render_step=2, patience=100,
+        seed=0,
+    )
+    config.update(kwargs)
+    return config
+
+
+def upstream_ops(fetches):
+    """ All ops that running `fetches` (a list of tensors and ops) may run, following data and control inputs. """
+    ops = set()
+    stack = [getattr(f, "op", f) for f in fetches]
+    while stack:
+        op = stack.pop()
+        if op not in ops:
+            ops.add(op)
+            stack.extend(t.op for t in op.inputs)
+            stack.extend(op.control_inputs)
+    return ops
+
+
+def assert_close(names, expected, actual, rtol):
+    """ Assert that each pair of values agrees to within `rtol`, relative to the magnitude of the expected
+        value (at least 1), naming the value that doesn't. """
+    import numpy as np
+
+    for name, a, b in zip(names, expected, actual):
+        scale = max(np.abs(a).max(), 1.0)
+        np.testing.assert_allclose(b, a, rtol=rtol, atol=rtol * scale, err_msg=name)